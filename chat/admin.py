@@ -1,24 +1,216 @@
+from datetime import timedelta
 from django.contrib import admin
 from django.contrib.auth.models import User
-from .models import Message, Thread
+from django.core.paginator import Paginator
+from django.db import connections, models
+from django.db.models import Max, Min, Prefetch
+from django.utils import timezone
+from django.utils.functional import cached_property
+from . import cache, membership, tasks
+from .models import Change, DeadTask, Membership, Message, OutboxTask, Thread
 from .forms import ThreadForm
 
 
+def estimate_count(queryset):
+    """
+    Estimated amount of rows of the table of queryset without scanning it: statistics of PostgreSQL or SQLite
+    (after ANALYZE), otherwise size of the range of primary keys.
+    """
+    connection = connections[queryset.db]
+    table = queryset.model._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute('SELECT reltuples::bigint FROM pg_class WHERE relname = %s', [table])
+            row = cursor.fetchone()
+            if row and row[0] >= 0:
+                return row[0]
+        elif connection.vendor == 'sqlite':
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sqlite_stat1'")
+            if cursor.fetchone():
+                cursor.execute('SELECT stat FROM sqlite_stat1 WHERE tbl = %s ORDER BY idx IS NOT NULL LIMIT 1', [table])
+                row = cursor.fetchone()
+                if row:
+                    return int(row[0].split()[0])
+    bounds = queryset.model._default_manager.using(queryset.db).aggregate(first=Min('pk'), last=Max('pk'))
+    return 0 if bounds['first'] is None else bounds['last'] - bounds['first'] + 1
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator of changelists of big tables. Unfiltered list uses estimated amount of rows when it is above
+    exact_count_limit, so a page does not run COUNT(*) over the whole table. Filtered lists are counted exactly.
+    """
+    exact_count_limit = 100000
+
+    @cached_property
+    def count(self):
+        if not self.object_list.query.where:
+            estimate = estimate_count(self.object_list)
+            if estimate > self.exact_count_limit:
+                return estimate
+        return super().count
+
+
+def next_period(start, kind):
+    if kind == 'year':
+        return start.replace(year=start.year + 1)
+    if kind == 'month':
+        return start.replace(year=start.year + start.month // 12, month=start.month % 12 + 1)
+    return start + timedelta(days=1)
+
+
+class IndexedDatesQuerySet(models.QuerySet):
+    """
+    Queryset of changelists with date_hierarchy. datetimes() finds years, months or days which have rows
+    by one range query per period on the index of the field, instead of DISTINCT of truncated dates of all rows.
+    """
+    periods = {
+        'year': dict(month=1, day=1, hour=0, minute=0, second=0, microsecond=0),
+        'month': dict(day=1, hour=0, minute=0, second=0, microsecond=0),
+        'day': dict(hour=0, minute=0, second=0, microsecond=0),
+    }
+
+    def datetimes(self, field_name, kind, order='ASC', tzinfo=None, is_dst=timezone.NOT_PASSED):
+        if kind not in self.periods or tzinfo is not None:
+            return super().datetimes(field_name, kind, order, tzinfo, is_dst)
+        bounds = self.aggregate(first=Min(field_name), last=Max(field_name))
+        if bounds['first'] is None:
+            return []
+        starts = []
+        start = timezone.localtime(bounds['first']).replace(**self.periods[kind])
+        last = timezone.localtime(bounds['last'])
+        while start <= last:
+            end = next_period(start, kind)
+            if self.filter(**{f'{field_name}__gte': start, f'{field_name}__lt': end}).exists():
+                starts.append(start)
+            start = end
+        return starts if order == 'ASC' else starts[::-1]
+
+
+class LargeTableAdmin(admin.ModelAdmin):
+    """
+    Changelist of a table with millions of rows: estimated count, no second count of filtered lists
+    and date_hierarchy by indexed range queries (date_hierarchy field must be the first field of an index).
+    """
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def get_queryset(self, request):
+        return IndexedDatesQuerySet(self.model, query=super().get_queryset(request).query)
+
+
 class AdminUser(admin.ModelAdmin):
     list_display = ['id', 'username']
 
 
-class AdminThread(admin.ModelAdmin):
+class AdminThread(LargeTableAdmin):
     list_display = ['id', '__str__', 'created', 'updated']
+    date_hierarchy = 'created'
     form = ThreadForm
 
+    def get_queryset(self, request):
+        # __str__ lists usernames of participants
+        return super().get_queryset(request) \
+            .prefetch_related(Prefetch('participants', queryset=User.objects.only('username')))
+
+    def formfield_for_manytomany(self, db_field, request, **kwargs):
+        # admin skips relations with explicit through model, role of Membership has a default, so set() works
+        return db_field.formfield(**kwargs)
+
+    def save_related(self, request, form, formsets, change):
+        old_participant_ids = set(form.instance.participants.values_list('id', flat=True)) if change else set()
+        super().save_related(request, form, formsets, change)
+        new_participant_ids = set(form.instance.participants.values_list('id', flat=True))
+        Change.objects.thread_deleted(form.instance.id, old_participant_ids - new_participant_ids)
+        Change.objects.thread_created(form.instance.id, new_participant_ids - old_participant_ids)
+        membership.invalidate_thread(form.instance.id, old_participant_ids | new_participant_ids)
+        cache.invalidate([form.instance.id], old_participant_ids | new_participant_ids)
+
+    def delete_model(self, request, obj):
+        participant_ids = list(obj.participants.values_list('id', flat=True))
+        thread_id = obj.id
+        Change.objects.thread_deleted(thread_id, participant_ids)
+        super().delete_model(request, obj)
+        membership.invalidate_thread(thread_id, participant_ids)
+        cache.invalidate([thread_id], participant_ids)
 
-class AdminMessage(admin.ModelAdmin):
+    def delete_queryset(self, request, queryset):
+        memberships = list(Thread.participants.through.objects
+                           .filter(thread__in=queryset)
+                           .values_list('thread_id', 'user_id'))
+        for thread_id, user_id in memberships:
+            Change.objects.thread_deleted(thread_id, [user_id])
+        super().delete_queryset(request, queryset)
+        for thread_id, user_id in memberships:
+            membership.invalidate_thread(thread_id, [user_id])
+            cache.invalidate([thread_id], [user_id])
+
+
+class AdminMembership(admin.ModelAdmin):
+    """
+    Roles of participants, participants themselves are edited on thread page.
+    """
+    list_display = ['id', 'thread', 'user', 'role', 'last_read_id']
+    list_filter = ['role']
+    list_select_related = ['user']
+    readonly_fields = ['thread', 'user', 'last_read_id']
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+
+class AdminMessage(LargeTableAdmin):
     list_display = ['id', 'thread', 'sender', 'text', 'created']
+    list_select_related = ['thread', 'sender']
+    date_hierarchy = 'created'
+    # select widgets would load every thread and user
+    raw_id_fields = ['thread', 'sender']
+
+    def get_queryset(self, request):
+        # thread column is Thread.__str__
+        return super().get_queryset(request) \
+            .prefetch_related(Prefetch('thread__participants', queryset=User.objects.only('username')))
+
+
+class AdminOutboxTask(admin.ModelAdmin):
+    """
+    Tasks waiting for the run_tasks worker, read only.
+    """
+    list_display = ['id', 'name', 'status', 'attempts', 'run_after', 'created']
+    list_filter = ['status']
+    readonly_fields = ['name', 'payload', 'status', 'attempts', 'run_after', 'last_error', 'created']
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
+class AdminDeadTask(AdminOutboxTask):
+    """
+    Tasks which failed MAX_ATTEMPTS times, they can be retried or deleted.
+    """
+    list_filter = ['name']
+    actions = ['retry']
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).filter(status=OutboxTask.DEAD)
+
+    @admin.action(description='Retry selected tasks', permissions=['delete'])
+    def retry(self, request, queryset):
+        amount = tasks.retry(queryset)
+        self.message_user(request, f'{amount} tasks are returned to the outbox')
 
 
 admin.site.register(Message, AdminMessage)
 admin.site.register(Thread, AdminThread)
+admin.site.register(Membership, AdminMembership)
+admin.site.register(OutboxTask, AdminOutboxTask)
+admin.site.register(DeadTask, AdminDeadTask)
 
 admin.site.unregister(User)
 admin.site.register(User, AdminUser)
\ No newline at end of file
@@ -0,0 +1,129 @@
+"""
+JWT authentication without signature check and user query for repeated requests.
+
+Verified tokens are kept in an LRU of the process, keyed by hash of the raw token, until their exp.
+Users are cached as (id, is_staff, is_active) snapshots in the Django cache settings.CHAT_AUTH_CACHE['USER_CACHE'],
+so they can be shared between processes. A snapshot is deleted when the user is saved or deleted (deactivation,
+staff flag change), updates by QuerySet.update() bypass it until USER_TIMEOUT.
+"""
+
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models.signals import post_delete, post_save
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+
+# fields of cached user snapshots after the primary key
+SNAPSHOT_FIELDS = ('is_staff', 'is_active')
+
+
+def get_config():
+    config = {'MAX_TOKENS': 10000, 'USER_CACHE': 'default', 'USER_TIMEOUT': 300}
+    config.update(getattr(settings, 'CHAT_AUTH_CACHE', None) or {})
+    return config
+
+
+def is_enabled():
+    return bool(getattr(settings, 'CHAT_AUTH_CACHE', None))
+
+
+class VerifiedTokenCache:
+    """
+    Verified tokens of the process. Expired entries are dropped on access,
+    least recently used ones when there are more than max_entries of them.
+    """
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.tokens = OrderedDict()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.tokens.get(key)
+            if entry is None:
+                return None
+            token, expires = entry
+            if expires <= time.time():
+                del self.tokens[key]
+                return None
+            self.tokens.move_to_end(key)
+            return token
+
+    def set(self, key, token, expires):
+        with self.lock:
+            self.tokens[key] = (token, expires)
+            self.tokens.move_to_end(key)
+            while len(self.tokens) > self.max_entries:
+                self.tokens.popitem(last=False)
+
+
+@lru_cache(maxsize=None)
+def get_token_cache():
+    return VerifiedTokenCache(get_config()['MAX_TOKENS'])
+
+
+def user_key(user_id):
+    return f'chat:auth_user:{user_id}'
+
+
+def invalidate_user(sender, instance, **kwargs):
+    """
+    Removes cached snapshot of the saved or deleted user.
+    """
+    if is_enabled():
+        caches[get_config()['USER_CACHE']].delete(user_key(instance.pk))
+
+
+def connect_signals():
+    user_model = get_user_model()
+    post_save.connect(invalidate_user, sender=user_model, dispatch_uid='chat.authentication.invalidate_user')
+    post_delete.connect(invalidate_user, sender=user_model, dispatch_uid='chat.authentication.invalidate_user')
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    """
+    JWTAuthentication with cached verified tokens and user snapshots, the same as JWTAuthentication
+    if settings.CHAT_AUTH_CACHE is empty.
+    Users of cached snapshots are model instances with deferred fields other than id, is_staff and is_active,
+    they are loaded on access.
+    """
+    def get_validated_token(self, raw_token):
+        if not is_enabled():
+            return super().get_validated_token(raw_token)
+        key = hashlib.sha256(raw_token).digest()
+        token_cache = get_token_cache()
+        validated_token = token_cache.get(key)
+        if validated_token is None:
+            validated_token = super().get_validated_token(raw_token)
+            token_cache.set(key, validated_token, validated_token['exp'])
+        return validated_token
+
+    def get_user(self, validated_token):
+        if not is_enabled():
+            return super().get_user(validated_token)
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken(_('Token contained no recognizable user identification'))
+
+        config = get_config()
+        cache = caches[config['USER_CACHE']]
+        snapshot = cache.get(user_key(user_id))
+        if snapshot is None:
+            # inactive and missing users are not cached, super() raises AuthenticationFailed for them
+            user = super().get_user(validated_token)
+            cache.set(user_key(user_id), (user.pk, user.is_staff, user.is_active), config['USER_TIMEOUT'])
+            return user
+        if not snapshot[2]:
+            raise AuthenticationFailed(_('User is inactive'), code='user_inactive')
+        return self.user_model.from_db(DEFAULT_DB_ALIAS, [self.user_model._meta.pk.attname, *SNAPSHOT_FIELDS],
+                                       snapshot)
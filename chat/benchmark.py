@@ -0,0 +1,152 @@
+"""
+Load generation helpers used by `manage.py benchmark`.
+"""
+
+import random
+import time
+from io import StringIO
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import connection
+from django.db.models import Max, Min
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
+from .models import Membership, Message, Thread
+
+PASSWORD = 'benchmark'
+
+
+def seed(users, threads_per_user, messages_per_thread, batch_size=1000):
+    """
+    Creates users, threads between them (each user starts threads_per_user threads) and messages in every thread.
+    Every participant has read a random part of every thread. Last message pointers are filled by maintenance command.
+    """
+    password = make_password(PASSWORD)
+    User.objects.bulk_create(
+        [User(username=f'bench_user_{i}', password=password) for i in range(users)], batch_size=batch_size)
+    user_ids = list(User.objects.filter(username__startswith='bench_user_').values_list('id', flat=True))
+
+    pairs = set()
+    for i, user_id in enumerate(user_ids):
+        for shift in range(1, min(threads_per_user, len(user_ids) - 1) + 1):
+            other_id = user_ids[(i + shift) % len(user_ids)]
+            pairs.add((min(user_id, other_id), max(user_id, other_id)))
+    Thread.objects.bulk_create(
+        [Thread(min_user_id=low, max_user_id=high) for low, high in pairs], batch_size=batch_size)
+    threads = list(Thread.objects.filter(min_user_id__in=user_ids).values_list('id', 'min_user_id', 'max_user_id'))
+    Membership.objects.bulk_create(
+        [Membership(thread_id=thread_id, user_id=user_id)
+         for thread_id, low, high in threads for user_id in (low, high)], batch_size=batch_size)
+
+    messages = []
+    for thread_id, low, high in threads:
+        for i in range(messages_per_thread):
+            messages.append(Message(thread_id=thread_id, sender_id=random.choice((low, high)),
+                                    text=f'message {i}'))
+            if len(messages) >= batch_size:
+                Message.objects.bulk_create(messages)
+                messages = []
+    Message.objects.bulk_create(messages)
+
+    bounds = {thread_id: (low, high) for thread_id, low, high in Message.objects
+              .filter(thread_id__in=[thread[0] for thread in threads])
+              .values('thread')
+              .annotate(low=Min('id'), high=Max('id'))
+              .values_list('thread', 'low', 'high')}
+    memberships = list(Membership.objects.filter(thread_id__in=list(bounds)).only('id', 'thread_id'))
+    for membership in memberships:
+        low, high = bounds[membership.thread_id]
+        membership.last_read_id = random.randint(low - 1, high)
+    Membership.objects.bulk_update(memberships, ['last_read_id'], batch_size=batch_size)
+
+    call_command('backfill_last_message', stdout=StringIO())
+    return threads
+
+
+class Scenario:
+    """
+    Sends requests to one endpoint. make_request(client, user_id, thread) returns response.
+    """
+    def __init__(self, name, weight, make_request):
+        self.name = name
+        self.weight = weight
+        self.make_request = make_request
+
+
+def get_scenarios(page_size):
+    def list_threads(client, user_id, thread):
+        return client.get('/api/threads/', {'user_id': user_id, 'limit': page_size})
+
+    def list_messages(client, user_id, thread):
+        return client.get('/api/messages/', {'thread_id': thread[0], 'limit': page_size})
+
+    def list_messages_cursor(client, user_id, thread):
+        return client.get('/api/messages/', {'thread_id': thread[0], 'limit': page_size, 'pagination': 'cursor'})
+
+    def create_message(client, user_id, thread):
+        return client.post('/api/messages/', {'thread': thread[0], 'sender': user_id, 'text': 'hello'}, format='json')
+
+    def create_messages_bulk(client, user_id, thread):
+        data = [{'thread': thread[0], 'sender': user_id, 'text': f'bulk {i}'} for i in range(page_size)]
+        return client.post('/api/messages/bulk/', data, format='json')
+
+    def get_or_create_thread(client, user_id, thread):
+        return client.post('/api/thread/', {'participants': [thread[1], thread[2]]}, format='json')
+
+    def mark_read(client, user_id, thread):
+        return client.put('/api/messages/read/', {'thread': thread[0], 'up_to_id': 2 ** 62}, format='json')
+
+    def count_unread(client, user_id, thread):
+        return client.post('/api/messages/unread_amount/', {'user_id': user_id}, format='json')
+
+    return [
+        Scenario('GET /api/threads/', 20, list_threads),
+        Scenario('GET /api/messages/', 15, list_messages),
+        Scenario('GET /api/messages/ (cursor)', 10, list_messages_cursor),
+        Scenario('POST /api/messages/', 15, create_message),
+        Scenario('POST /api/messages/bulk/', 1, create_messages_bulk),
+        Scenario('POST /api/thread/', 4, get_or_create_thread),
+        Scenario('PUT /api/messages/read/', 10, mark_read),
+        Scenario('POST /api/messages/unread_amount/', 25, count_unread),
+    ]
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    if not values:
+        return 0
+    index = min(len(values) - 1, max(0, round(percent / 100 * len(values)) - 1))
+    return values[index]
+
+
+def run(threads, requests_amount, page_size, scenarios=None):
+    """
+    Sends requests_amount requests chosen by scenario weights on behalf of random thread participants.
+    Returns dict: scenario name -> {'latencies': [...], 'queries': [...], 'errors': int}.
+    """
+    scenarios = scenarios or get_scenarios(page_size)
+    users = {user.id: user for user in User.objects.filter(id__in={user_id for t in threads for user_id in t[1:]})}
+    clients = {}
+    stats = {scenario.name: {'latencies': [], 'queries': [], 'errors': 0} for scenario in scenarios}
+    weights = [scenario.weight for scenario in scenarios]
+
+    for scenario in random.choices(scenarios, weights, k=requests_amount):
+        thread = random.choice(threads)
+        user_id = random.choice(thread[1:])
+        client = clients.get(user_id)
+        if client is None:
+            client = clients[user_id] = APIClient()
+            client.force_authenticate(users[user_id])
+
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            response = scenario.make_request(client, user_id, thread)
+            latency = time.perf_counter() - start
+        result = stats[scenario.name]
+        result['latencies'].append(latency)
+        result['queries'].append(len(queries.captured_queries))
+        if response.status_code >= 400:
+            result['errors'] += 1
+    return stats
+
@@ -0,0 +1,200 @@
+"""
+Cache of serialized pages of messages and threads.
+
+Page keys contain versions of scopes the page depends on ('thread:<id>' for messages of thread,
+'user:<id>' for thread lists of user). Writes bump versions after commit, so old pages are never read again
+and expire by timeout or eviction. Versions are initialized with current time, so a version evicted from cache
+is never reused.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.utils.module_loading import import_string
+from rest_framework.response import Response
+from . import replicas
+from .models import Thread
+
+
+class LocalLRUCache:
+    """
+    In-process cache limited by amount of entries, least recently used entries are evicted first.
+    Versions are not shared between processes, use it only with one worker process.
+    """
+    def __init__(self, max_entries=10000, timeout=300):
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get_many(self, keys):
+        now = time.monotonic()
+        result = {}
+        with self.lock:
+            for key in keys:
+                entry = self.entries.get(key)
+                if entry is None:
+                    continue
+                expires, value = entry
+                if expires < now:
+                    del self.entries[key]
+                    continue
+                self.entries.move_to_end(key)
+                result[key] = value
+        return result
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.timeout, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def add(self, key, value):
+        with self.lock:
+            if key in self.entries:
+                return False
+        self.set(key, value)
+        return True
+
+    def incr(self, key):
+        with self.lock:
+            expires, value = self.entries[key]
+            self.entries[key] = (expires, value + 1)
+            self.entries.move_to_end(key)
+            return value + 1
+
+
+class SharedCache:
+    """
+    Django cache (e.g. Redis or Memcached), shared between processes.
+    """
+    def __init__(self, alias='default', timeout=300):
+        self.cache = caches[alias]
+        self.timeout = timeout
+
+    def get_many(self, keys):
+        return self.cache.get_many(keys)
+
+    def set(self, key, value):
+        self.cache.set(key, value, self.timeout)
+
+    def add(self, key, value):
+        return self.cache.add(key, value, self.timeout)
+
+    def incr(self, key):
+        return self.cache.incr(key)
+
+
+class PageCache:
+    def __init__(self, backend):
+        self.backend = backend
+        self.stats_lock = threading.Lock()
+        self.stats = {}
+
+    @staticmethod
+    def version_key(scope):
+        return f'chat:version:{scope}'
+
+    def get_versions(self, scopes):
+        keys = [self.version_key(scope) for scope in scopes]
+        versions = self.backend.get_many(keys)
+        for key in keys:
+            if key not in versions:
+                self.backend.add(key, time.time_ns())
+                versions[key] = self.backend.get_many([key]).get(key, 0)
+        return [versions[key] for key in keys]
+
+    def bump(self, scopes):
+        for scope in scopes:
+            key = self.version_key(scope)
+            try:
+                self.backend.incr(key)
+            except (KeyError, ValueError):
+                self.backend.add(key, time.time_ns())
+
+    def page_key(self, kind, scopes, request):
+        versions = '.'.join(str(version) for version in self.get_versions(scopes))
+        return f'chat:page:{kind}:{versions}:{request.get_host()}{request.get_full_path()}'
+
+    def record(self, kind, hit):
+        with self.stats_lock:
+            hits, misses = self.stats.get(kind, (0, 0))
+            self.stats[kind] = (hits + 1, misses) if hit else (hits, misses + 1)
+
+
+@lru_cache(maxsize=None)
+def get_page_cache():
+    """
+    Returns PageCache with backend configured by settings.CHAT_PAGE_CACHE or None if cache is disabled.
+    """
+    config = getattr(settings, 'CHAT_PAGE_CACHE', None)
+    if not config:
+        return None
+    backend_class = import_string(config['BACKEND'])
+    return PageCache(backend_class(**config.get('OPTIONS', {})))
+
+
+def thread_scope(thread_id):
+    return f'thread:{thread_id}'
+
+
+def user_scope(user_id):
+    return f'user:{user_id}'
+
+
+def cached_response(request, kind, scopes, get_response):
+    """
+    Returns response with cached page data if it exists, otherwise gets response and caches its data.
+    """
+    page_cache = get_page_cache()
+    if page_cache is None:
+        return get_response()
+    key = page_cache.page_key(kind, scopes, request)
+    data = page_cache.backend.get_many([key]).get(key)
+    page_cache.record(kind, data is not None)
+    if data is not None:
+        return Response(data, headers={'X-Cache': 'HIT'})
+    response = get_response()
+    # a lagging replica could return page older than the current versions
+    if response.status_code == 200 and not replicas.is_reading_from_replica():
+        page_cache.backend.set(key, response.data)
+    response['X-Cache'] = 'MISS'
+    return response
+
+
+def invalidate(thread_ids, user_ids=None):
+    """
+    Bumps versions of threads and of their participants (or the given users) after commit.
+    """
+    if get_page_cache() is None:
+        return
+
+    def bump():
+        ids = user_ids
+        if ids is None:
+            ids = set(Thread.participants.through.objects
+                      .filter(thread_id__in=thread_ids)
+                      .values_list('user_id', flat=True))
+        get_page_cache().bump([thread_scope(thread_id) for thread_id in thread_ids] +
+                              [user_scope(user_id) for user_id in ids])
+    transaction.on_commit(bump)
+
+
+def render_metrics():
+    """
+    Returns hit/miss counters in Prometheus text format.
+    """
+    page_cache = get_page_cache()
+    if page_cache is None:
+        return ''
+    lines = ['# HELP chat_page_cache_requests_total Page cache lookups', '# TYPE chat_page_cache_requests_total counter']
+    with page_cache.stats_lock:
+        for kind, (hits, misses) in sorted(page_cache.stats.items()):
+            lines.append(f'chat_page_cache_requests_total{{kind="{kind}",result="hit"}} {hits}')
+            lines.append(f'chat_page_cache_requests_total{{kind="{kind}",result="miss"}} {misses}')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,35 @@
+import django
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+
+def check_connections_health(**kwargs):
+    """
+    Closes persistent connections which can not be used anymore (e.g. database server was restarted),
+    so the request opens a new one instead of failing. Enabled by CONN_HEALTH_CHECKS database option.
+    Django >= 4.1 does the same itself.
+    """
+    for conn in connections.all():
+        if conn.connection is not None and conn.settings_dict.get('CONN_HEALTH_CHECKS') and not conn.is_usable():
+            conn.close()
+
+
+def apply_sqlite_pragmas(sender, connection, **kwargs):
+    """
+    Applies settings.CHAT_SQLITE['PRAGMAS'] to every new SQLite connection.
+    WAL journal lets readers work while a writer commits, synchronous=NORMAL is safe in WAL mode
+    and syncs only on checkpoints.
+    """
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        for name, value in getattr(settings, 'CHAT_SQLITE', {}).get('PRAGMAS', {}).items():
+            cursor.execute(f'PRAGMA {name} = {value}')
+
+
+def connect_signals():
+    connection_created.connect(apply_sqlite_pragmas, dispatch_uid='chat.db.apply_sqlite_pragmas')
+    if django.VERSION < (4, 1):
+        from django.core.signals import request_started
+        request_started.connect(check_connections_health, dispatch_uid='chat.db.check_connections_health')
@@ -0,0 +1,79 @@
+from . import tasks
+from .models import Membership, Thread
+from .pubsub import get_pubsub, user_channel
+
+
+def publish_to_users(user_ids, event):
+    pubsub = get_pubsub()
+    for user_id in user_ids:
+        pubsub.publish(user_channel(user_id), event)
+
+
+def publish_unread_amounts(user_ids):
+    """
+    Sends current total amount of unread messages to every given user.
+    """
+    amounts = Membership.objects.unread_amounts(user_ids)
+    for user_id in user_ids:
+        publish_to_users([user_id], {
+            'type': 'unread_amount',
+            'user_id': user_id,
+            'unread_messages_amount': amounts.get(user_id, 0)})
+
+
+def threads_participant_ids(thread_ids):
+    """
+    Returns dict: thread id -> list of participant ids, by one query.
+    """
+    participants = {}
+    memberships = Thread.participants.through.objects.filter(thread_id__in=thread_ids).values_list('thread_id', 'user_id')
+    for thread_id, user_id in memberships:
+        participants.setdefault(thread_id, []).append(user_id)
+    return participants
+
+
+def message_created(message_data):
+    """
+    Schedules delivery of new message and new unread amounts to thread participants after commit.
+    """
+    messages_created([message_data])
+
+
+def messages_created(messages_data):
+    """
+    Schedules delivery of new messages and new unread amounts to thread participants after commit.
+    """
+    if messages_data:
+        tasks.enqueue('chat.events.publish_messages_created', messages_data=messages_data)
+
+
+def publish_messages_created(messages_data):
+    participants = threads_participant_ids({message_data['thread'] for message_data in messages_data})
+    receivers = set()
+    for message_data in messages_data:
+        participant_ids = participants.get(message_data['thread'], [])
+        publish_to_users(participant_ids, {'type': 'message', 'message': message_data})
+        receivers.update(user_id for user_id in participant_ids if user_id != message_data['sender'])
+    publish_unread_amounts(sorted(receivers))
+
+
+def messages_read(reader_id, cursors):
+    """
+    Schedules delivery of read receipts after commit.
+    cursors is a dict: thread id -> new read cursor of the reader, messages up to it are read.
+    """
+    # pairs instead of dict, JSON keys of the outbox payload are strings
+    tasks.enqueue('chat.events.publish_messages_read', reader_id=reader_id, cursors=list(cursors.items()))
+
+
+def publish_messages_read(reader_id, cursors):
+    cursors = dict(cursors)
+    participants = threads_participant_ids(cursors.keys())
+    for thread_id, up_to_id in cursors.items():
+        publish_to_users(participants.get(thread_id, []), {
+            'type': 'read',
+            'thread': thread_id,
+            'reader': reader_id,
+            'up_to_id': up_to_id})
+    # read cursors are per member, only amount of the reader is changed
+    publish_unread_amounts([reader_id])
@@ -1,4 +1,5 @@
 from django import forms
+from django.conf import settings
 from django.core.exceptions import ValidationError
 from .models import Thread
 
@@ -10,9 +11,17 @@ class ThreadForm(forms.ModelForm):
 
     def clean(self):
         """
-        Checks that thread has exactly 2 participants
+        Checks that thread has from 2 to settings.CHAT_MAX_THREAD_PARTICIPANTS participants
+        and that there is no other thread of the same 2 participants.
         """
         participants = self.cleaned_data.get('participants')
-        if participants is None or len(participants) != 2:
-            raise ValidationError('Each thread must include exactly 2 participants')
+        if participants is None or len(participants) < 2:
+            raise ValidationError('Each thread must include at least 2 participants')
+        if len(participants) > settings.CHAT_MAX_THREAD_PARTICIPANTS:
+            raise ValidationError(f'Thread can include at most {settings.CHAT_MAX_THREAD_PARTICIPANTS} participants')
+        min_user_id, max_user_id = Thread.pair_key(participants)
+        if min_user_id is not None and Thread.objects.filter(min_user_id=min_user_id, max_user_id=max_user_id) \
+                .exclude(pk=self.instance.pk).exists():
+            raise ValidationError('Thread with these participants already exists')
+        self.instance.min_user_id, self.instance.max_user_id = min_user_id, max_user_id
         return self.cleaned_data
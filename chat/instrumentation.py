@@ -0,0 +1,256 @@
+"""
+Per-request SQL and timing instrumentation.
+
+Enabled by settings.CHAT_INSTRUMENTATION['ENABLED']. When disabled the middleware removes itself from the
+middleware chain on startup and serializers are not patched, so there is no overhead.
+"""
+
+import asyncio
+import json
+import logging
+import threading
+import time
+from contextlib import ExitStack
+from contextvars import ContextVar
+from functools import wraps
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.http import Http404, HttpResponse
+from rest_framework import serializers
+from .cache import render_metrics as render_cache_metrics
+
+logger = logging.getLogger('chat.instrumentation')
+
+# buckets of histograms, seconds
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+QUERY_COUNT_BUCKETS = (1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+
+current_metrics = ContextVar('chat_request_metrics', default=None)
+
+
+def get_config():
+    config = {'ENABLED': False, 'SLOW_QUERIES': 3, 'LOG': True, 'METRICS_ALLOWED_IPS': ['127.0.0.1']}
+    config.update(getattr(settings, 'CHAT_INSTRUMENTATION', {}))
+    return config
+
+
+class RequestMetrics:
+    def __init__(self, slow_queries_amount):
+        self.slow_queries_amount = slow_queries_amount
+        self.queries = 0
+        self.db_time = 0.0
+        self.serializer_time = 0.0
+        self.serializer_depth = 0
+        self.slowest = []
+
+    def record_query(self, sql, duration):
+        self.queries += 1
+        self.db_time += duration
+        self.slowest.append((duration, sql))
+        self.slowest.sort(key=lambda item: item[0], reverse=True)
+        del self.slowest[self.slow_queries_amount:]
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.sum += value
+        self.count += 1
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+
+class MetricsRegistry:
+    """
+    Histograms aggregated per view in the current process.
+    """
+    metrics = {
+        'chat_request_duration_seconds': ('Request duration', DURATION_BUCKETS),
+        'chat_request_db_seconds': ('Time spent in database per request', DURATION_BUCKETS),
+        'chat_request_serializer_seconds': ('Time spent in serializers per request', DURATION_BUCKETS),
+        'chat_request_queries': ('Amount of SQL queries per request', QUERY_COUNT_BUCKETS),
+    }
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+
+    def observe(self, view, values):
+        with self.lock:
+            for name, value in values.items():
+                key = (name, view)
+                if key not in self.histograms:
+                    self.histograms[key] = Histogram(self.metrics[name][1])
+                self.histograms[key].observe(value)
+
+    def render(self):
+        """
+        Returns histograms in Prometheus text exposition format.
+        """
+        lines = []
+        with self.lock:
+            for name, (description, buckets) in self.metrics.items():
+                lines.append(f'# HELP {name} {description}')
+                lines.append(f'# TYPE {name} histogram')
+                for (metric_name, view), histogram in sorted(self.histograms.items()):
+                    if metric_name != name:
+                        continue
+                    for bound, count in zip(buckets, histogram.counts):
+                        lines.append(f'{name}_bucket{{view="{view}",le="{bound}"}} {count}')
+                    lines.append(f'{name}_bucket{{view="{view}",le="+Inf"}} {histogram.count}')
+                    lines.append(f'{name}_sum{{view="{view}"}} {histogram.sum}')
+                    lines.append(f'{name}_count{{view="{view}"}} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+
+
+def timed_serializer_data(data_property):
+    """
+    Wraps serializer 'data' property to sum time of outermost serializers of the request.
+    """
+    getter = data_property.fget
+
+    @wraps(getter)
+    def data(self):
+        metrics = current_metrics.get()
+        if metrics is None:
+            return getter(self)
+        metrics.serializer_depth += 1
+        start = time.perf_counter()
+        try:
+            return getter(self)
+        finally:
+            metrics.serializer_depth -= 1
+            if metrics.serializer_depth == 0:
+                metrics.serializer_time += time.perf_counter() - start
+    data.instrumented = True
+    return property(data)
+
+
+def instrument_serializers():
+    for serializer_class in (serializers.BaseSerializer, serializers.Serializer, serializers.ListSerializer):
+        data_property = serializer_class.__dict__['data']
+        if not getattr(data_property.fget, 'instrumented', False):
+            serializer_class.data = timed_serializer_data(data_property)
+
+
+def recording_queries(metrics):
+    """
+    Returns context manager which records queries of all database connections of the request to metrics.
+    """
+    def record_query(execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            metrics.record_query(sql, time.perf_counter() - start)
+
+    stack = ExitStack()
+    for connection in connections.all():
+        stack.enter_context(connection.execute_wrapper(record_query))
+    return stack
+
+
+class InstrumentationMiddleware:
+    """
+    Records query count, database time, serializer time and slowest statements of every view.
+    Adds them to Server-Timing header, writes a structured log line and aggregates histograms for metrics_view.
+
+    Supports async requests, so under ASGI it does not move the chain of async middleware to a thread.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.config = get_config()
+        if not self.config['ENABLED']:
+            raise MiddlewareNotUsed
+        instrument_serializers()
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            # the same marking as django.utils.deprecation.MiddlewareMixin, __call__ returns a coroutine
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        metrics = RequestMetrics(self.config['SLOW_QUERIES'])
+        token = current_metrics.set(metrics)
+        start = time.perf_counter()
+        try:
+            with recording_queries(metrics):
+                response = self.get_response(request)
+        finally:
+            current_metrics.reset(token)
+        return self.finish(request, response, metrics, time.perf_counter() - start)
+
+    async def __acall__(self, request):
+        metrics = RequestMetrics(self.config['SLOW_QUERIES'])
+        token = current_metrics.set(metrics)
+        start = time.perf_counter()
+        # sync views and database work of async views run in the thread of the request, connections are local to it
+        stack = await sync_to_async(recording_queries)(metrics)
+        try:
+            response = await self.get_response(request)
+        finally:
+            await sync_to_async(stack.close)()
+            current_metrics.reset(token)
+        return self.finish(request, response, metrics, time.perf_counter() - start)
+
+    def finish(self, request, response, metrics, duration):
+        """
+        Adds Server-Timing header, records histograms and logs metrics of the request.
+        """
+        view = self.get_view_name(request)
+        response['Server-Timing'] = ', '.join([
+            f'db;dur={metrics.db_time * 1000:.2f};desc="{metrics.queries} queries"',
+            f'serializer;dur={metrics.serializer_time * 1000:.2f}',
+            f'total;dur={duration * 1000:.2f}',
+        ])
+        registry.observe(view, {
+            'chat_request_duration_seconds': duration,
+            'chat_request_db_seconds': metrics.db_time,
+            'chat_request_serializer_seconds': metrics.serializer_time,
+            'chat_request_queries': metrics.queries,
+        })
+        if self.config['LOG']:
+            logger.info(json.dumps({
+                'view': view,
+                'method': request.method,
+                'path': request.path,
+                'status': response.status_code,
+                'duration_ms': round(duration * 1000, 2),
+                'queries': metrics.queries,
+                'db_ms': round(metrics.db_time * 1000, 2),
+                'serializer_ms': round(metrics.serializer_time * 1000, 2),
+                'slowest_queries': [{'ms': round(query_time * 1000, 2), 'sql': sql}
+                                    for query_time, sql in metrics.slowest],
+            }))
+        return response
+
+    @staticmethod
+    def get_view_name(request):
+        match = getattr(request, 'resolver_match', None)
+        return match.view_name if match is not None else 'unresolved'
+
+
+def metrics_view(request):
+    """
+    Internal endpoint with aggregated histograms in Prometheus text format.
+    Available only when instrumentation is enabled and only from METRICS_ALLOWED_IPS.
+    """
+    config = get_config()
+    if not config['ENABLED'] or request.META.get('REMOTE_ADDR') not in config['METRICS_ALLOWED_IPS']:
+        raise Http404
+    return HttpResponse(registry.render() + render_cache_metrics(),
+                        content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,62 @@
+import time
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Exists, OuterRef, Q
+from django.utils import timezone
+from chat import cache
+from chat.models import ArchivedMessage, Membership, Message, Thread
+
+FIELDS = ('id', 'thread_id', 'sender_id', 'text', 'created')
+
+
+class Command(BaseCommand):
+    help = 'Moves read messages older than the given amount of days to the archive table'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=180)
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--pause', type=float, default=0, help='Seconds to sleep between batches')
+
+    def handle(self, *args, **options):
+        border = timezone.now() - timedelta(days=options['days'])
+        # messages unread by any receiver and last messages of threads stay in the hot table,
+        # unread amounts and thread list use them
+        unread = Membership.objects \
+            .filter(thread=OuterRef('thread'), last_read_id__lt=OuterRef('id')) \
+            .exclude(user=OuterRef('sender'))
+        queryset = Message.objects \
+            .filter(~Exists(unread), created__lt=border) \
+            .exclude(id__in=Thread.objects.filter(last_message__isnull=False).values('last_message_id')) \
+            .order_by('id')
+        archived_amount = 0
+        last_id = 0
+        while True:
+            # every batch is moved in its own short transaction, so the command can be stopped and started again
+            with transaction.atomic():
+                rows = list(queryset.filter(id__gt=last_id).values(*FIELDS)[:options['batch_size']])
+                if not rows:
+                    break
+                ArchivedMessage.objects.bulk_create([ArchivedMessage(**row) for row in rows], ignore_conflicts=True)
+                Message.objects.filter(id__in=[row['id'] for row in rows]).delete()
+                self.update_threads(rows)
+            last_id = rows[-1]['id']
+            archived_amount += len(rows)
+            self.stdout.write(f'Archived messages up to id {last_id}')
+            if options['pause']:
+                time.sleep(options['pause'])
+        self.stdout.write(self.style.SUCCESS(f'Archived {archived_amount} messages'))
+
+    @staticmethod
+    def update_threads(rows):
+        """
+        Moves archived_until of threads forward, so message list knows when to read the archive.
+        """
+        newest = {}
+        for row in rows:
+            newest[row['thread_id']] = max(row['created'], newest.get(row['thread_id'], row['created']))
+        for thread_id, created in newest.items():
+            Thread.objects \
+                .filter(Q(archived_until__isnull=True) | Q(archived_until__lt=created), id=thread_id) \
+                .update(archived_until=created)
+        cache.invalidate(list(newest), user_ids=[])
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from django.db.models import OuterRef, Subquery
+from chat.models import Message, Thread
+
+
+class Command(BaseCommand):
+    help = 'Fills Thread.last_message with the newest message of every thread'
+
+    def handle(self, *args, **options):
+        # the same order as writes move the pointer in, by (thread, id) index
+        newest_message = Message.objects \
+            .filter(thread=OuterRef('pk')) \
+            .order_by('-id') \
+            .values('id')[:1]
+        updated_amount = Thread.objects.update(last_message=Subquery(newest_message))
+        self.stdout.write(self.style.SUCCESS(f'Updated {updated_amount} threads'))
@@ -0,0 +1,69 @@
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+from chat import benchmark
+
+# maximum amount of queries per request, exceeding it is reported as regression
+QUERY_BUDGETS = {
+    'GET /api/threads/': 4,
+    'GET /api/messages/': 4,
+    'GET /api/messages/ (cursor)': 3,
+    'POST /api/messages/': 12,
+    'POST /api/messages/bulk/': 11,
+    'POST /api/thread/': 6,
+    'PUT /api/messages/read/': 10,
+    'POST /api/messages/unread_amount/': 2,
+}
+
+
+class Command(BaseCommand):
+    help = 'Seeds a separate test database and measures latency, throughput and queries of every endpoint'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=100)
+        parser.add_argument('--threads-per-user', type=int, default=5)
+        parser.add_argument('--messages-per-thread', type=int, default=50)
+        parser.add_argument('--requests', type=int, default=2000)
+        parser.add_argument('--page-size', type=int, default=10)
+        parser.add_argument('--keepdb', action='store_true', help='Keep test database between runs')
+        parser.add_argument('--no-budget', action='store_true', help='Do not fail on exceeded query budgets')
+
+    def handle(self, *args, **options):
+        setup_test_environment()
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, keepdb=options['keepdb'])
+        try:
+            threads = benchmark.seed(options['users'], options['threads_per_user'], options['messages_per_thread'])
+            self.stdout.write(f'Seeded {options["users"]} users, {len(threads)} threads')
+            start = time.perf_counter()
+            # load comes from a few users, so it must not be throttled
+            with override_settings(CHAT_THROTTLING={'RATES': {}}):
+                stats = benchmark.run(threads, options['requests'], options['page_size'])
+            total_time = time.perf_counter() - start
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=options['keepdb'])
+            teardown_test_environment()
+
+        self.stdout.write(f'{options["requests"]} requests in {total_time:.2f}s, '
+                          f'{options["requests"] / total_time:.1f} req/s')
+        self.stdout.write(f'{"endpoint":36} {"count":>6} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} '
+                          f'{"req/s":>8} {"queries":>8} {"errors":>6}')
+        regressions = []
+        for name, result in stats.items():
+            latencies = result['latencies']
+            if not latencies:
+                continue
+            max_queries = max(result['queries'])
+            self.stdout.write(
+                f'{name:36} {len(latencies):>6} '
+                f'{benchmark.percentile(latencies, 50) * 1000:>8.2f} '
+                f'{benchmark.percentile(latencies, 95) * 1000:>8.2f} '
+                f'{benchmark.percentile(latencies, 99) * 1000:>8.2f} '
+                f'{len(latencies) / sum(latencies):>8.1f} '
+                f'{max_queries:>8} {result["errors"]:>6}')
+            if name in QUERY_BUDGETS and max_queries > QUERY_BUDGETS[name]:
+                regressions.append(f'{name}: {max_queries} queries, budget is {QUERY_BUDGETS[name]}')
+
+        if regressions and not options['no_budget']:
+            raise CommandError('Query budget exceeded:\n' + '\n'.join(regressions))
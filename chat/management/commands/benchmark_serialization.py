@@ -0,0 +1,74 @@
+import time
+from io import StringIO
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+from rest_framework.renderers import JSONRenderer
+from chat import benchmark
+from chat.models import Message, Thread
+from chat.renderers import FastJSONRenderer, orjson
+from chat.serializers import MessageRowSerializer, MessageSerializer, ThreadRowSerializer, ThreadSerializer
+
+
+class Command(BaseCommand):
+    help = 'Measures per-row cost of reading, serializing and rendering list pages by serializers and by rows'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=1000)
+        parser.add_argument('--repeat', type=int, default=20)
+
+    def handle(self, *args, **options):
+        rows = options['rows']
+        setup_test_environment()
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0)
+        try:
+            thread_id, user_id = self.seed(rows)
+            messages = Message.objects.with_read_state().filter(thread=thread_id).order_by('-created', '-id')[:rows]
+            threads = Thread.objects.with_read_state().filter(participants=user_id).order_by('-created', '-id')[:rows]
+            cases = [
+                ('messages', 'serializer', lambda: JSONRenderer().render(
+                    MessageSerializer(list(messages), many=True).data)),
+                ('messages', 'rows', lambda: FastJSONRenderer().render(MessageRowSerializer(
+                    list(messages.values_list(*MessageRowSerializer.fields, named=True)), many=True).data)),
+                ('threads', 'serializer', lambda: JSONRenderer().render(ThreadSerializer(
+                    list(threads.select_related('last_message').prefetch_related('participants')), many=True).data)),
+                ('threads', 'rows', lambda: FastJSONRenderer().render(ThreadRowSerializer(
+                    list(threads.values_list(*ThreadRowSerializer.fields, named=True)), many=True).data)),
+            ]
+            self.stdout.write(f'JSON encoder of rows path: {"orjson" if orjson is not None else "json"}')
+            self.stdout.write(f'{"list":10} {"path":12} {"rows":>6} {"us/row":>8}')
+            for name, path, render in cases:
+                render()
+                start = time.perf_counter()
+                for _ in range(options['repeat']):
+                    render()
+                per_row = (time.perf_counter() - start) / options['repeat'] / rows * 1e6
+                self.stdout.write(f'{name:10} {path:12} {rows:>6} {per_row:>8.2f}')
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+    @staticmethod
+    def seed(rows):
+        """
+        Creates a user with rows threads, every thread has one message, and the first thread has rows messages.
+        """
+        password = make_password(benchmark.PASSWORD)
+        User.objects.bulk_create([User(username=f'bench_user_{i}', password=password) for i in range(rows + 1)])
+        user_ids = [user.id for user in User.objects.filter(username__startswith='bench_user_').order_by('id')]
+        user_id = user_ids[0]
+        Thread.objects.bulk_create([Thread(min_user_id=user_id, max_user_id=other_id) for other_id in user_ids[1:]])
+        thread_ids = list(Thread.objects.order_by('id').values_list('id', flat=True))
+        Membership = Thread.participants.through
+        Membership.objects.bulk_create([Membership(thread_id=thread_id, user_id=participant_id)
+                                        for thread_id, other_id in zip(thread_ids, user_ids[1:])
+                                        for participant_id in (user_id, other_id)])
+        Message.objects.bulk_create(
+            [Message(thread_id=thread_ids[0], sender_id=user_id, text=f'message {i}') for i in range(rows - 1)] +
+            [Message(thread_id=thread_id, sender_id=user_id, text='hello') for thread_id in thread_ids])
+        call_command('backfill_last_message', stdout=StringIO())
+        return thread_ids[0], user_id
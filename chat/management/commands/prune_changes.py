@@ -0,0 +1,26 @@
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from chat.models import Change
+
+
+class Command(BaseCommand):
+    help = 'Deletes sync changes older than the given amount of days, clients with older tokens must resync'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=30)
+        parser.add_argument('--batch-size', type=int, default=10000)
+
+    def handle(self, *args, **options):
+        border = timezone.now() - timedelta(days=options['days'])
+        # the newest change is always kept, sync detects expired tokens by the oldest kept id
+        last_id = Change.objects.order_by('-id').values_list('id', flat=True).first()
+        deleted_amount = 0
+        while True:
+            # delete by small batches of ids to keep write transactions short
+            ids = list(Change.objects.filter(created__lt=border).exclude(id=last_id).order_by('id')
+                       .values_list('id', flat=True)[:options['batch_size']])
+            if not ids:
+                break
+            deleted_amount += Change.objects.filter(id__in=ids).delete()[0]
+        self.stdout.write(self.style.SUCCESS(f'Deleted {deleted_amount} changes'))
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from chat.search import get_search_backend
+
+
+class Command(BaseCommand):
+    help = 'Builds or rebuilds full-text search index of messages by batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        get_search_backend().rebuild(batch_size=options['batch_size'], stdout=self.stdout)
+        self.stdout.write(self.style.SUCCESS('Search index is rebuilt'))
@@ -0,0 +1,45 @@
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import django
+from django.core.management.base import BaseCommand
+from chat import tasks
+
+
+class Command(BaseCommand):
+    help = 'Runs tasks of the outbox (side effects of writes) by a pool of threads or processes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--pool', choices=['thread', 'process'], default='thread')
+        parser.add_argument('--workers', type=int, default=4)
+        parser.add_argument('--batch-size', type=int, help="Default is CHAT_TASKS['BATCH_SIZE']")
+        parser.add_argument('--sleep', type=float, default=1, help='Seconds to wait when no task is due')
+        parser.add_argument('--once', action='store_true', help='Exit when no task is due')
+
+    def handle(self, *args, **options):
+        config = tasks.get_config()
+        if options['batch_size']:
+            config['BATCH_SIZE'] = options['batch_size']
+        if options['pool'] == 'process':
+            # spawned processes set up Django before they load the first task, the writer thread is not forked
+            executor = ProcessPoolExecutor(options['workers'], mp_context=multiprocessing.get_context('spawn'),
+                                           initializer=django.setup)
+        else:
+            executor = ThreadPoolExecutor(options['workers'], thread_name_prefix='chat-task')
+
+        done_amount = failed_amount = 0
+        with executor:
+            while True:
+                results = tasks.run_due_tasks(executor, config)
+                for task, error in results:
+                    if error is None:
+                        done_amount += 1
+                    else:
+                        failed_amount += 1
+                        self.stderr.write(f'Task {task.id} {task.name} failed: {error.splitlines()[-1]}')
+                if results:
+                    continue
+                if options['once']:
+                    break
+                time.sleep(options['sleep'])
+        self.stdout.write(self.style.SUCCESS(f'Done {done_amount} tasks, {failed_amount} failed'))
@@ -0,0 +1,62 @@
+from django.conf import settings
+from django.core.cache import caches
+from .models import Membership, Thread
+
+REQUEST_CACHE_ATTR = '_chat_membership'
+
+
+def get_membership_cache():
+    """
+    Returns cache used across requests or None if it is disabled by settings.CHAT_MEMBERSHIP_CACHE.
+    """
+    config = getattr(settings, 'CHAT_MEMBERSHIP_CACHE', None)
+    if not config:
+        return None
+    return caches[config.get('ALIAS', 'default')]
+
+
+def cache_key(thread_id, user_id):
+    return f'chat:membership:{thread_id}:{user_id}'
+
+
+def is_participant(thread_id, user_id, request=None):
+    """
+    Checks that user is participant of thread by indexed EXISTS query.
+    Result is memoized for the request and, if enabled, cached across requests.
+    """
+    memo = None
+    if request is not None:
+        memo = getattr(request, REQUEST_CACHE_ATTR, None)
+        if memo is None:
+            memo = {}
+            setattr(request, REQUEST_CACHE_ATTR, memo)
+        if (thread_id, user_id) in memo:
+            return memo[(thread_id, user_id)]
+
+    cache = get_membership_cache()
+    result = cache.get(cache_key(thread_id, user_id)) if cache is not None else None
+    if result is None:
+        result = Thread.participants.through.objects.filter(thread_id=thread_id, user_id=user_id).exists()
+        if cache is not None:
+            cache.set(cache_key(thread_id, user_id), result, settings.CHAT_MEMBERSHIP_CACHE.get('TIMEOUT'))
+
+    if memo is not None:
+        memo[(thread_id, user_id)] = result
+    return result
+
+
+def get_role(thread_id, user_id):
+    """
+    Returns role of user in thread or None if user is not participant. Not cached, roles are checked only by
+    rare administrative requests.
+    """
+    return Membership.objects.filter(thread_id=thread_id, user_id=user_id).values_list('role', flat=True).first()
+
+
+def invalidate_thread(thread_id, user_ids):
+    """
+    Removes cached membership of the given users in thread. Must be called when participants of thread are changed.
+    """
+    cache = get_membership_cache()
+    if cache is not None:
+        cache.delete_many([cache_key(thread_id, user_id) for user_id in user_ids])
@@ -0,0 +1,47 @@
+# Generated by Django 4.0.6 on 2026-10-17 22:46
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def backfill_last_message(apps, schema_editor):
+    """
+    Points last message of every existing thread to its message with the newest id, like
+    `manage.py backfill_last_message` does.
+    """
+    db_alias = schema_editor.connection.alias
+    Thread = apps.get_model('chat', 'Thread')
+    Message = apps.get_model('chat', 'Message')
+    newest_message = Message.objects.using(db_alias) \
+        .filter(thread=models.OuterRef('pk')) \
+        .order_by('-id') \
+        .values('id')[:1]
+    Thread.objects.using(db_alias).update(last_message=models.Subquery(newest_message))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('chat', '0002_alter_message_text'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='thread',
+            name='last_message',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='chat.message'),
+        ),
+        migrations.RunPython(backfill_last_message, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='message',
+            name='sender',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_query_name='sent_messages', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='thread',
+            name='participants',
+            field=models.ManyToManyField(related_name='thread', to=settings.AUTH_USER_MODEL),
+        ),
+    ]
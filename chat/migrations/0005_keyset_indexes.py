@@ -0,0 +1,21 @@
+# Generated by Django 4.0.6 on 2026-10-17 22:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0004_unreadcounter'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['thread', 'created', 'id'], name='message_thread_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='thread',
+            index=models.Index(fields=['created', 'id'], name='thread_created_idx'),
+        ),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 4.0.6 on 2026-10-17 22:50
+
+from django.db import migrations, models
+
+
+def fill_pair_keys(apps, schema_editor):
+    """
+    Fills pair key of existing threads with 2 participants. Duplicated threads keep empty key, 0015 merges them.
+    """
+    Thread = apps.get_model('chat', 'Thread')
+    db_alias = schema_editor.connection.alias
+    used_keys = set()
+    for thread in Thread.objects.using(db_alias).prefetch_related('participants').order_by('id').iterator(chunk_size=1000):
+        user_ids = [user.id for user in thread.participants.all()]
+        if len(user_ids) != 2:
+            continue
+        key = (min(user_ids), max(user_ids))
+        if key in used_keys:
+            continue
+        used_keys.add(key)
+        thread.min_user_id, thread.max_user_id = key
+        thread.save(update_fields=['min_user_id', 'max_user_id'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0005_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='thread',
+            name='max_user_id',
+            field=models.BigIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='thread',
+            name='min_user_id',
+            field=models.BigIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.RunPython(fill_pair_keys, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='thread',
+            constraint=models.UniqueConstraint(fields=('min_user_id', 'max_user_id'), name='unique_thread_participants'),
+        ),
+    ]
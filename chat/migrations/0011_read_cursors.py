@@ -0,0 +1,81 @@
+# Generated by Django 4.0.6 on 2026-10-17 23:25
+
+from importlib import import_module
+from django.db import migrations, models
+from django.db.models import Exists, OuterRef, Subquery
+from django.db.models.functions import Coalesce, Greatest
+
+# SQLite removes a column by copying the table, triggers of the search index are dropped with the old table
+search_migration = import_module('chat.migrations.0008_message_search')
+
+
+def fill_read_cursors(apps, schema_editor):
+    """
+    Moves read cursor of every participant to the newest read message received by the participant, archived messages are read.
+    """
+    Membership = apps.get_model('chat', 'Membership')
+    Message = apps.get_model('chat', 'Message')
+    ArchivedMessage = apps.get_model('chat', 'ArchivedMessage')
+    db_alias = schema_editor.connection.alias
+
+    def newest_read(model):
+        messages = model.objects \
+            .filter(thread=OuterRef('thread'), is_read=True) \
+            .exclude(sender=OuterRef('user')) \
+            .order_by('-id') \
+            .values('id')[:1]
+        return Coalesce(Subquery(messages), 0, output_field=models.BigIntegerField())
+    Membership.objects.using(db_alias).update(last_read_id=Greatest(newest_read(Message), newest_read(ArchivedMessage)))
+
+
+def fill_is_read(apps, schema_editor):
+    """
+    Marks as read messages which are below read cursor of a participant other than sender.
+    """
+    Membership = apps.get_model('chat', 'Membership')
+    Message = apps.get_model('chat', 'Message')
+    Message.objects.using(schema_editor.connection.alias).update(is_read=Exists(
+        Membership.objects
+        .filter(thread=OuterRef('thread'), last_read_id__gte=OuterRef('id'))
+        .exclude(user=OuterRef('sender'))))
+
+
+class Migration(migrations.Migration):
+    """
+    Replaces is_read flags of messages and unread counters by read cursors of participants.
+    Unread counters are not restored by reverse migration.
+    """
+
+    dependencies = [
+        ('chat', '0010_membership'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='membership',
+            name='last_read_id',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.RunPython(fill_read_cursors, fill_is_read),
+        migrations.RunPython(migrations.RunPython.noop, search_migration.create_search_index),
+        migrations.RemoveField(
+            model_name='message',
+            name='is_read',
+        ),
+        migrations.RunPython(search_migration.create_search_index, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='archivedmessage',
+            name='is_read',
+        ),
+        migrations.DeleteModel(
+            name='UnreadCounter',
+        ),
+        migrations.AddIndex(
+            model_name='membership',
+            index=models.Index(fields=['thread', 'last_read_id'], name='membership_read_cursor_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['thread', 'id'], name='message_thread_id_idx'),
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 4.0.6 on 2026-10-17 23:30
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0011_read_cursors'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutboxTask',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=200)),
+                ('payload', models.JSONField(blank=True, default=dict)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('dead', 'Dead')], default='pending', max_length=10)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('run_after', models.DateTimeField(default=django.utils.timezone.now)),
+                ('last_error', models.TextField(blank=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='outboxtask',
+            index=models.Index(fields=['status', 'run_after', 'id'], name='outbox_due_idx'),
+        ),
+        migrations.CreateModel(
+            name='DeadTask',
+            fields=[
+            ],
+            options={
+                'verbose_name': 'dead letter',
+                'proxy': True,
+                'indexes': [],
+                'constraints': [],
+            },
+            bases=('chat.outboxtask',),
+        ),
+    ]
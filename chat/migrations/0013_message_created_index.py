@@ -0,0 +1,17 @@
+# Generated by Django 4.0.6 on 2026-10-17 23:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0012_outbox'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['created'], name='message_created_idx'),
+        ),
+    ]
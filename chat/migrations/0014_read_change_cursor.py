@@ -0,0 +1,26 @@
+from django.db import migrations
+
+
+def use_read_cursors(apps, schema_editor):
+    """
+    Replaces ids of read messages in logged read receipts by the read cursor, the newest of them.
+    """
+    Change = apps.get_model('chat', 'Change')
+    changes = Change.objects.using(schema_editor.connection.alias).filter(kind='messages_read', data__has_key='message_ids')
+    for change in changes.iterator():
+        change.data = {'reader': change.data['reader'], 'up_to_id': max(change.data['message_ids'], default=0)}
+        change.save(update_fields=['data'])
+
+
+class Migration(migrations.Migration):
+    """
+    Read receipts of the sync log carry the new read cursor of the reader instead of ids of messages.
+    """
+
+    dependencies = [
+        ('chat', '0013_message_created_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(use_read_cursors, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,71 @@
+from django.db import migrations
+from django.db.models import Max
+
+
+def merge_duplicate_threads(apps, schema_editor):
+    """
+    Merges threads of 2 users which were left without pair key by 0006_thread_pair_key into the thread of the same
+    pair, such threads were treated as groups without owner and could not be deleted. Messages are moved to the kept
+    thread, read cursors of participants are the newest of both threads and the sync log gets the moved messages
+    and deletion of the duplicate.
+    """
+    db_alias = schema_editor.connection.alias
+    Thread = apps.get_model('chat', 'Thread')
+    Membership = apps.get_model('chat', 'Membership')
+    Message = apps.get_model('chat', 'Message')
+    ArchivedMessage = apps.get_model('chat', 'ArchivedMessage')
+    Change = apps.get_model('chat', 'Change')
+
+    members = {}
+    for thread_id, user_id, role in Membership.objects.using(db_alias) \
+            .filter(thread__min_user_id__isnull=True) \
+            .values_list('thread_id', 'user_id', 'role'):
+        members.setdefault(thread_id, []).append((user_id, role))
+    # groups of 2 members created by the API have an owner
+    duplicate_ids = sorted(thread_id for thread_id, thread_members in members.items()
+                           if len(thread_members) == 2 and all(role == 'member' for _, role in thread_members))
+
+    for duplicate_id in duplicate_ids:
+        cursors = dict(Membership.objects.using(db_alias)
+                       .filter(thread=duplicate_id)
+                       .values_list('user_id', 'last_read_id'))
+        key = (min(cursors), max(cursors))
+        kept = Thread.objects.using(db_alias).filter(min_user_id=key[0], max_user_id=key[1]).first()
+        if kept is None:
+            # the thread which had the key was deleted, the duplicate takes its place
+            Thread.objects.using(db_alias).filter(id=duplicate_id).update(min_user_id=key[0], max_user_id=key[1])
+            continue
+
+        message_ids = list(Message.objects.using(db_alias).filter(thread=duplicate_id).values_list('id', flat=True))
+        Message.objects.using(db_alias).filter(thread=duplicate_id).update(thread=kept.id)
+        ArchivedMessage.objects.using(db_alias).filter(thread=duplicate_id).update(thread=kept.id)
+        for user_id, last_read_id in cursors.items():
+            Membership.objects.using(db_alias) \
+                .filter(thread=kept.id, user=user_id, last_read_id__lt=last_read_id) \
+                .update(last_read_id=last_read_id)
+        duplicate = Thread.objects.using(db_alias).get(id=duplicate_id)
+        archived_until = [value for value in (kept.archived_until, duplicate.archived_until) if value is not None]
+        Thread.objects.using(db_alias).filter(id=kept.id).update(
+            last_message=Message.objects.using(db_alias).filter(thread=kept.id).aggregate(id=Max('id'))['id'],
+            archived_until=max(archived_until, default=None),
+            updated=max(kept.updated, duplicate.updated))
+
+        Change.objects.using(db_alias).bulk_create(
+            [Change(kind='message_created', thread_id=kept.id, data={'message_id': message_id})
+             for message_id in message_ids] +
+            [Change(kind='thread_deleted', thread_id=duplicate_id, user_id=user_id) for user_id in cursors])
+        duplicate.delete()
+
+
+class Migration(migrations.Migration):
+    """
+    Merges duplicated threads of 2 users, which the pair key backfill left without key.
+    """
+
+    dependencies = [
+        ('chat', '0014_read_change_cursor'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_threads, migrations.RunPython.noop),
+    ]
@@ -1,30 +1,319 @@
 from django.contrib.auth.models import User
-from django.core.exceptions import ObjectDoesNotExist
 from django.db import models
+from django.db.models import Count, Exists, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+
+class ThreadQuerySet(models.QuerySet):
+    def with_read_state(self):
+        """
+        Annotates threads with last_message_is_read, read state of the last message.
+        """
+        return self.annotate(last_message_is_read=read_state(
+            OuterRef('id'), OuterRef('last_message_id'), OuterRef('last_message__sender_id')))
 
 
 class Thread(models.Model):
     created = models.DateTimeField(auto_now_add=True)
     updated = models.DateTimeField(auto_now=True)
-    participants = models.ManyToManyField(User, related_name='thread')
+    participants = models.ManyToManyField(User, through='Membership', related_name='thread')
+    # denormalized pointer to the newest message, maintained by MessageSerializer.create
+    last_message = models.ForeignKey('Message', null=True, blank=True, on_delete=models.SET_NULL, related_name='+')
+    # normalized ids of both participants, unique key of thread with 2 participants, null for group threads
+    min_user_id = models.BigIntegerField(null=True, blank=True, editable=False)
+    max_user_id = models.BigIntegerField(null=True, blank=True, editable=False)
+    # the newest created time of archived messages, null if messages of thread were never archived
+    archived_until = models.DateTimeField(null=True, blank=True, editable=False)
+
+    objects = ThreadQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # keyset pagination of thread list
+            models.Index(fields=['created', 'id'], name='thread_created_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['min_user_id', 'max_user_id'], name='unique_thread_participants'),
+        ]
 
-    def last_message(self):
-        try:
-            message = Message.objects.filter(thread=self.id).latest('created')
-        except ObjectDoesNotExist:
-            message = None
-        return message
+    @staticmethod
+    def pair_key(participants):
+        """
+        Returns (min_user_id, max_user_id) for pair of users or user ids, (None, None) for group of users.
+        """
+        user_ids = {int(getattr(participant, 'pk', participant)) for participant in participants}
+        if len(user_ids) != 2:
+            return None, None
+        return min(user_ids), max(user_ids)
+
+    @property
+    def is_group(self):
+        return self.min_user_id is None
 
     def __str__(self):
         return ' '.join([user.username for user in self.participants.all()])
 
 
+class MembershipQuerySet(models.QuerySet):
+    def with_unread_amount(self):
+        """
+        Annotates memberships with amount of messages above the read cursor which were not sent by the member,
+        counted by range scan of Message (thread, id) index.
+        """
+        unread = Message.objects \
+            .filter(thread=OuterRef('thread'), id__gt=OuterRef('last_read_id')) \
+            .exclude(sender=OuterRef('user')) \
+            .order_by() \
+            .values('thread') \
+            .annotate(amount=Count('id')) \
+            .values('amount')
+        return self.annotate(unread_amount=Coalesce(Subquery(unread), 0))
+
+    def unread_amounts(self, user_ids):
+        """
+        Returns dict: user id -> total amount of unread messages, users without unread messages are omitted.
+        """
+        amounts = self \
+            .filter(user__in=user_ids) \
+            .with_unread_amount() \
+            .order_by() \
+            .values('user') \
+            .annotate(amount=Sum('unread_amount'))
+        return {row['user']: row['amount'] for row in amounts if row['amount']}
+
+    def mark_read(self, user_id, cursors):
+        """
+        Moves read cursors of the member forward, cursors is dict: thread id -> id of the newest read message.
+        Returns dict: thread id -> amount of received messages which became read, for threads where the cursor
+        was moved. Cursors of all threads are read by one query and moved by one conditional update.
+        """
+        if not cursors:
+            return {}
+        up_to_id = models.Case(*[models.When(thread_id=thread_id, then=models.Value(cursor))
+                                 for thread_id, cursor in cursors.items()],
+                               output_field=models.BigIntegerField())
+        memberships = self.filter(user=user_id, thread__in=list(cursors), last_read_id__lt=up_to_id)
+        newly_read = Message.objects \
+            .filter(thread=OuterRef('thread'), id__gt=OuterRef('last_read_id'), id__lte=OuterRef('up_to_id')) \
+            .exclude(sender=user_id) \
+            .order_by() \
+            .values('thread') \
+            .annotate(amount=Count('id')) \
+            .values('amount')
+        amounts = dict(memberships
+                       .annotate(up_to_id=up_to_id, amount=Coalesce(Subquery(newly_read), 0))
+                       .values_list('thread_id', 'amount'))
+        memberships.update(last_read_id=up_to_id)
+        return amounts
+
+
+class Membership(models.Model):
+    """
+    Participant of thread. Table of the former auto-created many-to-many relation.
+    Owners and admins of group threads can delete them, roles of participants of 2 user threads are not used.
+    last_read_id is the read cursor: messages of thread up to this id are read by the member.
+    """
+    OWNER = 'owner'
+    ADMIN = 'admin'
+    MEMBER = 'member'
+    ROLE_CHOICES = [
+        (OWNER, 'Owner'),
+        (ADMIN, 'Admin'),
+        (MEMBER, 'Member'),
+    ]
+
+    thread = models.ForeignKey(Thread, on_delete=models.CASCADE)
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    role = models.CharField(max_length=10, choices=ROLE_CHOICES, default=MEMBER)
+    last_read_id = models.BigIntegerField(default=0)
+
+    objects = MembershipQuerySet.as_manager()
+
+    class Meta:
+        db_table = 'chat_thread_participants'
+        unique_together = [('thread', 'user')]
+        indexes = [
+            # threads of user, covers membership checks and thread list joins
+            models.Index(fields=['user', 'thread'], name='membership_user_thread_idx'),
+            # read state of messages: members of thread whose cursor reached the message
+            models.Index(fields=['thread', 'last_read_id'], name='membership_read_cursor_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.user_id} [{self.thread_id}]: {self.role}'
+
+
+def read_state(thread, message_id, sender):
+    """
+    Expression which is true if a participant other than the sender has read cursor at the message or above.
+    Arguments are expressions of the message thread, id and sender.
+    """
+    return Exists(Membership.objects
+                  .filter(thread=thread, last_read_id__gte=message_id)
+                  .exclude(user=sender))
+
+
+class MessageQuerySet(models.QuerySet):
+    def with_read_state(self):
+        """
+        Annotates messages with is_read, which is computed from read cursors of thread participants.
+        """
+        return self.annotate(is_read=read_state(OuterRef('thread'), OuterRef('id'), OuterRef('sender')))
+
+
 class Message(models.Model):
+    """
+    Message of thread. Read state is not stored in the row, it is is_read annotation of
+    Message.objects.with_read_state(), see Membership.last_read_id.
+    """
     thread = models.ForeignKey(Thread, on_delete=models.CASCADE, related_query_name='messages')
     sender = models.ForeignKey(User, on_delete=models.CASCADE,  related_query_name='sent_messages')
     text = models.TextField()
     created = models.DateTimeField(auto_now_add=True)
-    is_read = models.BooleanField(default=False)
+
+    objects = MessageQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # keyset pagination of thread history
+            models.Index(fields=['thread', 'created', 'id'], name='message_thread_created_idx'),
+            # unread amounts, range of messages above read cursor
+            models.Index(fields=['thread', 'id'], name='message_thread_id_idx'),
+            # date hierarchy of the admin
+            models.Index(fields=['created'], name='message_created_idx'),
+        ]
 
     def __str__(self):
         return f'[{str(self.thread)}] {self.sender.username}: \"{self.text}\"'
+
+
+class ArchivedMessageQuerySet(models.QuerySet):
+    def with_read_state(self):
+        return self.annotate(is_read=models.Value(True))
+
+
+class ArchivedMessage(models.Model):
+    """
+    Message moved from the hot table by `manage.py archive_messages`, id of the original message is kept.
+    Fields have the same order as in Message, so querysets of both models can be combined by union.
+    Only read messages are archived, with_read_state() annotates them as read.
+    """
+    id = models.BigIntegerField(primary_key=True)
+    thread = models.ForeignKey(Thread, on_delete=models.CASCADE, related_name='+')
+    sender = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    text = models.TextField()
+    created = models.DateTimeField()
+
+    objects = ArchivedMessageQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['thread', 'created', 'id'], name='archived_thread_created_idx'),
+        ]
+
+    def __str__(self):
+        return f'[{self.thread_id}] {self.sender_id}: \"{self.text}\"'
+
+
+class ChangeManager(models.Manager):
+    def messages_created(self, messages):
+        return self.bulk_create([
+            self.model(kind=Change.MESSAGE_CREATED, thread_id=message.thread_id, data={'message_id': message.id})
+            for message in messages])
+
+    def messages_read(self, reader_id, cursors):
+        return self.bulk_create([
+            self.model(kind=Change.MESSAGES_READ, thread_id=thread_id, data={'reader': reader_id, 'up_to_id': up_to_id})
+            for thread_id, up_to_id in cursors.items()])
+
+    def thread_created(self, thread_id, user_ids):
+        return self.bulk_create([
+            self.model(kind=Change.THREAD_CREATED, thread_id=thread_id, user_id=user_id) for user_id in user_ids])
+
+    def thread_deleted(self, thread_id, user_ids):
+        return self.bulk_create([
+            self.model(kind=Change.THREAD_DELETED, thread_id=thread_id, user_id=user_id) for user_id in user_ids])
+
+    def for_user(self, user_id):
+        """
+        Changes of threads where user is participant and changes addressed to the user.
+        """
+        user_thread_ids = Thread.participants.through.objects.filter(user_id=user_id).values('thread_id')
+        return self.filter(models.Q(user_id=user_id) | models.Q(user__isnull=True, thread_id__in=user_thread_ids))
+
+
+class Change(models.Model):
+    """
+    Append-only log of changes used by incremental sync, id is the sequence number.
+    Thread level changes (messages, read receipts) have empty user, changes of thread list are addressed to every
+    participant, so they are available after thread is deleted.
+    thread_id is not a foreign key, rows of deleted threads are kept.
+    """
+    MESSAGE_CREATED = 'message_created'
+    MESSAGES_READ = 'messages_read'
+    THREAD_CREATED = 'thread_created'
+    THREAD_DELETED = 'thread_deleted'
+    KIND_CHOICES = [
+        (MESSAGE_CREATED, 'Message created'),
+        (MESSAGES_READ, 'Messages read'),
+        (THREAD_CREATED, 'Thread created'),
+        (THREAD_DELETED, 'Thread deleted'),
+    ]
+
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    thread_id = models.BigIntegerField()
+    user = models.ForeignKey(User, null=True, blank=True, on_delete=models.CASCADE, related_name='+')
+    data = models.JSONField(default=dict, blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+
+    objects = ChangeManager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['thread_id', 'id'], name='change_thread_idx'),
+            models.Index(fields=['user', 'id'], name='change_user_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.id} {self.kind} [{self.thread_id}]'
+
+
+class OutboxTask(models.Model):
+    """
+    Side effect of a write, saved in the transaction of the write and run by run_tasks worker (see chat.tasks).
+    name is dotted path of the handler, it is called with payload as keyword arguments.
+    Done tasks are deleted, tasks which failed MAX_ATTEMPTS times are kept as dead letters.
+    """
+    PENDING = 'pending'
+    DEAD = 'dead'
+    STATUS_CHOICES = [
+        (PENDING, 'Pending'),
+        (DEAD, 'Dead'),
+    ]
+
+    name = models.CharField(max_length=200)
+    payload = models.JSONField(default=dict, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    # pending task is not run before this time: retry backoff or lease of the worker which runs it
+    run_after = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'run_after', 'id'], name='outbox_due_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.id} {self.name} ({self.status})'
+
+
+class DeadTask(OutboxTask):
+    """
+    Dead letters of the outbox, separate admin page of tasks without attempts left.
+    """
+    class Meta:
+        proxy = True
+        verbose_name = 'dead letter'
@@ -0,0 +1,137 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import OrderedDict
+from datetime import datetime
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import LimitOffsetPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+class KeysetPagination(LimitOffsetPagination):
+    """
+    Limit/offset pagination with optional keyset (cursor) mode.
+    Keyset mode is used when request has 'before' or 'after' param or 'pagination=cursor'.
+    Results are ordered from newest to oldest by view.cursor_ordering fields (timestamp, id).
+    'before' cursor returns older rows, 'after' cursor returns rows newer than cursor, oldest of them first.
+    Keyset mode does not count rows and does not scan skipped rows, so latency does not depend on depth.
+
+    If view has get_archive_queryset() returning queryset of archived rows with the same fields, pages continue into
+    the archive. Rows newer than view.archive_boundary are never archived, so the archive is read only by pages
+    that reach the boundary.
+    """
+    before_query_param = 'before'
+    after_query_param = 'after'
+    mode_query_param = 'pagination'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.keyset_mode = self.is_keyset_mode(request)
+        archive_queryset = self.get_archive_queryset(view)
+        if not self.keyset_mode:
+            if archive_queryset is not None:
+                queryset = queryset.union(archive_queryset, all=True).order_by(*getattr(view, 'cursor_ordering', ()))
+            return super().paginate_queryset(queryset, request, view)
+
+        self.request = request
+        self.limit = self.get_limit(request)
+        self.time_field, self.id_field = getattr(view, 'cursor_ordering', ('created', 'id'))
+        before = self.decode_cursor(request.query_params.get(self.before_query_param))
+        after = self.decode_cursor(request.query_params.get(self.after_query_param))
+        self.after = after
+
+        page = self.get_rows(queryset, before, after)
+        if archive_queryset is not None and self.page_reaches_archive(page, after, view.archive_boundary):
+            page = sorted(page + self.get_rows(archive_queryset, before, after),
+                          key=self.get_key, reverse=after is None)[:self.limit + 1]
+        self.has_more = len(page) > self.limit
+        page = page[:self.limit]
+        if after is not None:
+            page.reverse()
+        self.page = page
+        return page
+
+    def get_rows(self, queryset, before, after):
+        """
+        Returns limit + 1 rows following cursor, newest first for 'before' cursor and oldest first for 'after' cursor.
+        """
+        if after is not None:
+            queryset = queryset.filter(self.newer_than(after)).order_by(self.time_field, self.id_field)
+        else:
+            if before is not None:
+                queryset = queryset.filter(self.older_than(before))
+            queryset = queryset.order_by(f'-{self.time_field}', f'-{self.id_field}')
+        return list(queryset[:self.limit + 1])
+
+    def get_key(self, obj):
+        return getattr(obj, self.time_field), getattr(obj, self.id_field)
+
+    def page_reaches_archive(self, page, after, boundary):
+        if after is not None:
+            return after[0] <= boundary
+        return len(page) <= self.limit or getattr(page[-1], self.time_field) <= boundary
+
+    @staticmethod
+    def get_archive_queryset(view):
+        get_archive_queryset = getattr(view, 'get_archive_queryset', None)
+        return get_archive_queryset() if get_archive_queryset is not None else None
+
+    def is_keyset_mode(self, request):
+        params = request.query_params
+        return self.before_query_param in params or self.after_query_param in params \
+            or params.get(self.mode_query_param) == 'cursor'
+
+    def older_than(self, cursor):
+        timestamp, pk = cursor
+        return Q(**{f'{self.time_field}__lt': timestamp}) | Q(**{self.time_field: timestamp, f'{self.id_field}__lt': pk})
+
+    def newer_than(self, cursor):
+        timestamp, pk = cursor
+        return Q(**{f'{self.time_field}__gt': timestamp}) | Q(**{self.time_field: timestamp, f'{self.id_field}__gt': pk})
+
+    def encode_cursor(self, obj):
+        key = f'{getattr(obj, self.time_field).isoformat()}|{getattr(obj, self.id_field)}'
+        return urlsafe_b64encode(key.encode()).decode()
+
+    def decode_cursor(self, encoded):
+        if not encoded:
+            return None
+        try:
+            timestamp, pk = urlsafe_b64decode(encoded.encode()).decode().split('|')
+            return datetime.fromisoformat(timestamp), int(pk)
+        except (TypeError, ValueError, UnicodeDecodeError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def get_keyset_link(self, param, cursor):
+        url = self.request.build_absolute_uri()
+        url = remove_query_param(url, self.before_query_param)
+        url = remove_query_param(url, self.after_query_param)
+        url = remove_query_param(url, self.offset_query_param)
+        return replace_query_param(url, param, cursor)
+
+    def get_next_link(self):
+        if not self.keyset_mode:
+            return super().get_next_link()
+        # next page contains older rows
+        if not self.page or (self.after is None and not self.has_more):
+            return None
+        return self.get_keyset_link(self.before_query_param, self.encode_cursor(self.page[-1]))
+
+    def get_previous_link(self):
+        if not self.keyset_mode:
+            return super().get_previous_link()
+        # previous page contains newer rows, the link is kept for further sync even if there are no such rows yet
+        if self.page:
+            return self.get_keyset_link(self.after_query_param, self.encode_cursor(self.page[0]))
+        if self.after is not None:
+            return self.request.build_absolute_uri()
+        return None
+
+    def get_paginated_response(self, data):
+        if not self.keyset_mode:
+            return super().get_paginated_response(data)
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data)
+        ]))
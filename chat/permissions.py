@@ -1,5 +1,7 @@
+from django.db.models import Exists, OuterRef, Q
 from rest_framework import permissions
-from .models import Thread, Message
+from . import membership
+from .models import Membership, Message, Thread
 from .serializers import ThreadSerializer, MessageSerializer
 
 
@@ -7,18 +9,21 @@ class IsParticipantOfThreadOrAdmin(permissions.IsAuthenticated):
     """
     Admin user has permissions for all activities.
     Regular users can get or create thread only if they are participants of this thread.
+    Regular users can delete group thread only if they are its owner or admin.
     Regular users can get message only if they are participants of thread with this message.
     Regular users can create message only if they are sender.
     """
     def has_object_permission(self, request, view, obj):
         if request.user and request.user.is_staff:
             return True
+        elif type(obj) == Thread and request.method == 'DELETE' and obj.is_group:
+            return membership.get_role(obj.id, request.user.pk) in (Membership.OWNER, Membership.ADMIN)
         elif type(obj) == Thread:
-            return request.user in obj.participants.all()
+            return membership.is_participant(obj.id, request.user.pk, request)
         elif type(obj) == Message:
-            return request.user in obj.thread.participants.all()
+            return membership.is_participant(obj.thread_id, request.user.pk, request)
         elif type(obj) == ThreadSerializer:
-            return request.user in obj.validated_data['participants']
+            return request.user.pk in obj.validated_data['participants']
         elif type(obj) == MessageSerializer:
             return request.user == obj.validated_data['sender']
 
@@ -27,11 +32,22 @@ class IsMessageReceiverOrAdmin(permissions.IsAuthenticated):
     """
     Admin user has permissions for all activities.
     Regular users can create message only if they are receivers of this message.
+    Regular users can mark messages of thread only if they are participants of this thread.
     """
     def has_object_permission(self, request, view, obj):
         if request.user and request.user.is_staff:
             return True
         elif type(obj) == Message:
-            return request.user != obj.sender and request.user in obj.thread.participants.all()
-
+            return request.user.pk != obj.sender_id and membership.is_participant(obj.thread_id, request.user.pk, request)
+        elif type(obj) == Thread:
+            return membership.is_participant(obj.id, request.user.pk, request)
 
+    def get_messages_condition(self, request):
+        """
+        Returns condition of messages which user can mark as read: messages of threads where user is participant
+        sent by other users, all messages for admin user. Views check all given messages by one query.
+        """
+        if request.user and request.user.is_staff:
+            return Q()
+        is_participant = Thread.participants.through.objects.filter(thread=OuterRef('thread'), user=request.user.pk)
+        return Q(Exists(is_participant)) & ~Q(sender=request.user.pk)
@@ -0,0 +1,102 @@
+import asyncio
+import json
+import threading
+from collections import defaultdict
+from functools import lru_cache
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+
+class BasePubSub:
+    """
+    Publish/subscribe backend used for fan-out of chat events to WebSocket connections.
+    publish() is called from sync views, subscribe() is an async iterator used by WebSocket consumers.
+    """
+    def publish(self, channel, message):
+        raise NotImplementedError
+
+    async def subscribe(self, channel):
+        raise NotImplementedError
+        yield
+
+
+class InMemoryPubSub(BasePubSub):
+    """
+    In-process backend. Delivers events only to connections served by the same process.
+    """
+    def __init__(self, max_queue_size=1000):
+        self.max_queue_size = max_queue_size
+        self._subscribers = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def publish(self, channel, message):
+        with self._lock:
+            subscribers = list(self._subscribers.get(channel, ()))
+        for loop, queue in subscribers:
+            loop.call_soon_threadsafe(self._put, queue, message)
+
+    @staticmethod
+    def _put(queue, message):
+        # slow consumers lose events instead of growing memory without bound
+        if not queue.full():
+            queue.put_nowait(message)
+
+    async def subscribe(self, channel):
+        subscriber = (asyncio.get_running_loop(), asyncio.Queue(self.max_queue_size))
+        with self._lock:
+            self._subscribers[channel].add(subscriber)
+        try:
+            while True:
+                yield await subscriber[1].get()
+        finally:
+            with self._lock:
+                self._subscribers[channel].discard(subscriber)
+                if not self._subscribers[channel]:
+                    del self._subscribers[channel]
+
+
+class RedisPubSub(BasePubSub):
+    """
+    Backend for Redis compatible servers, delivers events across processes and hosts.
+    Clients can be passed explicitly (e.g. a local stand-in in tests), otherwise they are created from url.
+    """
+    def __init__(self, url='redis://localhost:6379/0', prefix='chat', client=None, async_client=None):
+        if client is None or async_client is None:
+            import redis
+            import redis.asyncio
+            client = client or redis.Redis.from_url(url)
+            async_client = async_client or redis.asyncio.Redis.from_url(url)
+        self.prefix = prefix
+        self.client = client
+        self.async_client = async_client
+
+    def _channel_name(self, channel):
+        return f'{self.prefix}:{channel}'
+
+    def publish(self, channel, message):
+        self.client.publish(self._channel_name(channel), json.dumps(message))
+
+    async def subscribe(self, channel):
+        pubsub = self.async_client.pubsub()
+        await pubsub.subscribe(self._channel_name(channel))
+        try:
+            async for item in pubsub.listen():
+                if item['type'] == 'message':
+                    yield json.loads(item['data'])
+        finally:
+            await pubsub.unsubscribe(self._channel_name(channel))
+            await pubsub.close()
+
+
+@lru_cache(maxsize=None)
+def get_pubsub():
+    """
+    Returns backend configured by settings.CHAT_PUBSUB.
+    """
+    config = getattr(settings, 'CHAT_PUBSUB', {})
+    backend_class = import_string(config.get('BACKEND', 'chat.pubsub.InMemoryPubSub'))
+    return backend_class(**config.get('OPTIONS', {}))
+
+
+def user_channel(user_id):
+    return f'user.{user_id}'
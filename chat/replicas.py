@@ -0,0 +1,146 @@
+"""
+Routing of safe reads to read replicas.
+
+Reads go to a replica only inside read_from_replica() blocks and outside transactions, every other query uses
+the primary ('default').
+Replication position is the newest id of Change log, which every write of messages and threads appends to:
+- a replica is used only if it lags behind the primary by less than MAX_LAG seconds;
+- after a write the user's position is remembered for STICKY_SECONDS and only replicas which already have
+  it are used for this user (read-your-writes), otherwise the primary is used.
+Replica state is checked at most once per CHECK_INTERVAL seconds in every process.
+"""
+
+import random
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DatabaseError, connections, transaction
+from django.db.models import Max
+from django.utils import timezone
+from .models import Change
+
+PRIMARY = 'default'
+
+current_alias = ContextVar('chat_read_alias', default=None)
+
+
+def get_config():
+    config = {'ALIASES': [], 'MAX_LAG': 5, 'STICKY_SECONDS': 10, 'CHECK_INTERVAL': 1, 'CACHE': 'default'}
+    config.update(getattr(settings, 'CHAT_REPLICAS', {}))
+    return config
+
+
+class ReplicaRouter:
+    """
+    Sends reads of read_from_replica() blocks to the chosen replica, all writes and migrations to the primary.
+    """
+    def db_for_read(self, model, **hints):
+        # reads of a transaction must see its own writes
+        if connections[PRIMARY].in_atomic_block:
+            return PRIMARY
+        return current_alias.get()
+
+    def db_for_write(self, model, **hints):
+        return PRIMARY
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # replicas contain the same data as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db not in get_config()['ALIASES']
+
+
+class ReplicaState:
+    def __init__(self, alias):
+        self.alias = alias
+        self.lock = threading.Lock()
+        self.checked = 0
+        self.position = 0
+        self.healthy = False
+
+    def refresh(self, config):
+        with self.lock:
+            if time.monotonic() - self.checked < config['CHECK_INTERVAL']:
+                return
+            try:
+                position = get_position(self.alias)
+                # the oldest change which the replica does not have yet
+                missing = Change.objects.using(PRIMARY) \
+                    .filter(id__gt=position) \
+                    .order_by('id') \
+                    .values_list('created', flat=True) \
+                    .first()
+                lag = (timezone.now() - missing).total_seconds() if missing is not None else 0
+                self.position, self.healthy = position, lag <= config['MAX_LAG']
+            except DatabaseError:
+                self.healthy = False
+            self.checked = time.monotonic()
+
+
+states = {}
+states_lock = threading.Lock()
+
+
+def get_state(alias):
+    with states_lock:
+        if alias not in states:
+            states[alias] = ReplicaState(alias)
+        return states[alias]
+
+
+def get_position(alias):
+    return Change.objects.using(alias).aggregate(position=Max('id'))['position'] or 0
+
+
+def position_key(user_id):
+    return f'chat:replica_position:{user_id}'
+
+
+def choose_alias(user_id):
+    """
+    Returns alias of a replica which is fresh enough for the user or the primary alias.
+    """
+    config = get_config()
+    if not config['ALIASES']:
+        return PRIMARY
+    user_position = caches[config['CACHE']].get(position_key(user_id), 0)
+    aliases = []
+    for alias in config['ALIASES']:
+        state = get_state(alias)
+        state.refresh(config)
+        if state.healthy and state.position >= user_position:
+            aliases.append(alias)
+    return random.choice(aliases) if aliases else PRIMARY
+
+
+@contextmanager
+def read_from_replica(user_id):
+    """
+    Routes reads of the block to a replica chosen for the user.
+    """
+    token = current_alias.set(choose_alias(user_id))
+    try:
+        yield
+    finally:
+        current_alias.reset(token)
+
+
+def is_reading_from_replica():
+    return current_alias.get() not in (None, PRIMARY)
+
+
+def remember_write(user_id):
+    """
+    Makes reads of the user sticky to the primary until replicas have the current position, after commit.
+    """
+    config = get_config()
+    if not config['ALIASES']:
+        return
+
+    def remember():
+        caches[config['CACHE']].set(position_key(user_id), get_position(PRIMARY), config['STICKY_SECONDS'])
+    transaction.on_commit(remember)
@@ -0,0 +1,165 @@
+"""
+Full-text search of messages.
+
+Backends keep their own index of Message.text and return (message id, rank) pairs ordered by rank and id,
+lower rank is better. SQLite FTS5 index is kept in sync with chat_message by triggers, Postgres uses
+an expression index, both are created by migration 0008_message_search.
+"""
+
+import re
+from functools import lru_cache
+from django.conf import settings
+from django.db import connection
+from django.utils.module_loading import import_string
+from .models import Message
+
+SQLITE_TABLE = 'chat_message_fts'
+POSTGRES_INDEX = 'chat_message_text_search_idx'
+
+
+def get_terms(query):
+    """
+    Splits user query into words, special characters of query languages are dropped.
+    """
+    return re.findall(r'\w+', query)
+
+
+class BaseSearchBackend:
+    def search(self, query, user_id=None, thread_id=None, after=None, limit=10):
+        """
+        Returns up to limit (message id, rank) pairs matching all words of query, the last word as prefix.
+        user_id limits search to threads of the user, after is (rank, id) of the last result of previous page.
+        """
+        raise NotImplementedError
+
+    def rebuild(self, batch_size=1000, stdout=None):
+        """
+        Rebuilds index from existing messages by batches.
+        """
+
+
+class SQLiteFTSBackend(BaseSearchBackend):
+    """
+    SQLite FTS5 index ranked by bm25.
+    """
+    def search(self, query, user_id=None, thread_id=None, after=None, limit=10):
+        terms = get_terms(query)
+        if not terms:
+            return []
+        match = ' '.join(f'"{term}"' for term in terms[:-1])
+        match = f'{match} "{terms[-1]}"*'.strip()
+
+        sql = [f'SELECT m.id, bm25({SQLITE_TABLE}) FROM {SQLITE_TABLE}',
+               f'JOIN chat_message m ON m.id = {SQLITE_TABLE}.rowid',
+               f'WHERE {SQLITE_TABLE} MATCH %s']
+        params = [match]
+        if user_id is not None:
+            sql.append('AND m.thread_id IN (SELECT thread_id FROM chat_thread_participants WHERE user_id = %s)')
+            params.append(user_id)
+        if thread_id is not None:
+            sql.append('AND m.thread_id = %s')
+            params.append(thread_id)
+        if after is not None:
+            sql.append(f'AND (bm25({SQLITE_TABLE}) > %s OR (bm25({SQLITE_TABLE}) = %s AND m.id > %s))')
+            params.extend([after[0], after[0], after[1]])
+        sql.append(f'ORDER BY bm25({SQLITE_TABLE}), m.id LIMIT %s')
+        params.append(limit)
+        with connection.cursor() as cursor:
+            cursor.execute(' '.join(sql), params)
+            return cursor.fetchall()
+
+    def rebuild(self, batch_size=1000, stdout=None):
+        """
+        Every batch is a separate statement in autocommit mode, so only batch_size messages are read at once
+        and write lock is held only for one batch. Search results are incomplete until rebuild is finished.
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(f"INSERT INTO {SQLITE_TABLE}({SQLITE_TABLE}) VALUES ('delete-all')")
+            last_id = 0
+            while True:
+                cursor.execute(
+                    'SELECT MAX(id) FROM (SELECT id FROM chat_message WHERE id > %s ORDER BY id LIMIT %s)',
+                    [last_id, batch_size])
+                batch_last_id = cursor.fetchone()[0]
+                if batch_last_id is None:
+                    break
+                cursor.execute(
+                    f'INSERT INTO {SQLITE_TABLE}(rowid, text) '
+                    f'SELECT id, text FROM chat_message WHERE id > %s AND id <= %s',
+                    [last_id, batch_last_id])
+                last_id = batch_last_id
+                if stdout is not None:
+                    stdout.write(f'Indexed messages up to id {last_id}')
+            cursor.execute(f"INSERT INTO {SQLITE_TABLE}({SQLITE_TABLE}) VALUES ('optimize')")
+
+
+class PostgresFullTextBackend(BaseSearchBackend):
+    """
+    Postgres full-text search over GIN expression index, ranked by ts_rank.
+    The index is maintained by Postgres, so rebuild only reindexes it.
+    """
+    def search(self, query, user_id=None, thread_id=None, after=None, limit=10):
+        terms = get_terms(query)
+        if not terms:
+            return []
+        ts_query = ' & '.join(terms[:-1] + [f'{terms[-1]}:*'])
+
+        rank = "-ts_rank(to_tsvector('simple', m.text), q)"
+        sql = [f'SELECT m.id, {rank} FROM chat_message m, to_tsquery(\'simple\', %s) q',
+               "WHERE to_tsvector('simple', m.text) @@ q"]
+        params = [ts_query]
+        if user_id is not None:
+            sql.append('AND m.thread_id IN (SELECT thread_id FROM chat_thread_participants WHERE user_id = %s)')
+            params.append(user_id)
+        if thread_id is not None:
+            sql.append('AND m.thread_id = %s')
+            params.append(thread_id)
+        if after is not None:
+            sql.append(f'AND ({rank} > %s OR ({rank} = %s AND m.id > %s))')
+            params.extend([after[0], after[0], after[1]])
+        sql.append(f'ORDER BY {rank}, m.id LIMIT %s')
+        params.append(limit)
+        with connection.cursor() as cursor:
+            cursor.execute(' '.join(sql), params)
+            return cursor.fetchall()
+
+    def rebuild(self, batch_size=1000, stdout=None):
+        with connection.cursor() as cursor:
+            cursor.execute(f'REINDEX INDEX {POSTGRES_INDEX}')
+
+
+class UnindexedSearchBackend(BaseSearchBackend):
+    """
+    Fallback for databases without supported full-text index. Scans messages, all results have rank 0.
+    """
+    def search(self, query, user_id=None, thread_id=None, after=None, limit=10):
+        terms = get_terms(query)
+        if not terms:
+            return []
+        queryset = Message.objects.all()
+        for term in terms:
+            queryset = queryset.filter(text__icontains=term)
+        if user_id is not None:
+            queryset = queryset.filter(thread__participants=user_id)
+        if thread_id is not None:
+            queryset = queryset.filter(thread=thread_id)
+        if after is not None:
+            queryset = queryset.filter(id__gt=after[1])
+        return [(message_id, 0.0) for message_id in queryset.order_by('id').values_list('id', flat=True)[:limit]]
+
+
+VENDOR_BACKENDS = {
+    'sqlite': 'chat.search.SQLiteFTSBackend',
+    'postgresql': 'chat.search.PostgresFullTextBackend',
+}
+
+
+@lru_cache(maxsize=None)
+def get_search_backend():
+    """
+    Returns backend configured by settings.CHAT_SEARCH_BACKEND or default backend for database vendor.
+    """
+    path = getattr(settings, 'CHAT_SEARCH_BACKEND', None) \
+        or VENDOR_BACKENDS.get(connection.vendor, 'chat.search.UnindexedSearchBackend')
+    return import_string(path)()
+
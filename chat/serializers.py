@@ -1,55 +1,229 @@
 from rest_framework import serializers
+from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
+from django.db import transaction
 from django.db.models import Q
+from django.utils import timezone
 from django.contrib.auth.models import User
-from .models import Message, Thread
+from . import cache, events, membership
+from .models import Change, Membership, Message, Thread
 
 
 class MessageSerializer(serializers.ModelSerializer):
+    is_read = serializers.SerializerMethodField()
+
     class Meta:
         model = Message
-        fields = '__all__'
+        # order of model fields, the same as MessageRowSerializer
+        fields = ['id', 'text', 'created', 'is_read', 'thread', 'sender']
+
+    @staticmethod
+    def get_is_read(message):
+        """
+        Uses is_read annotation of Message.objects.with_read_state(), otherwise checks read cursors by one query.
+        """
+        is_read = getattr(message, 'is_read', None)
+        if is_read is None:
+            is_read = Message.objects.filter(id=message.id).with_read_state().values_list('is_read', flat=True).first()
+        return bool(is_read)
 
     def validate(self, attrs):
         """
         Check that sender is participant of this thread
         """
-        participants = User.objects.filter(thread=attrs['thread'])
-        if attrs['sender'] not in participants:
+        if not membership.is_participant(attrs['thread'].id, attrs['sender'].id, self.context.get('request')):
             raise serializers.ValidationError("Sender is not participant of this thread")
         return attrs
 
+    def create(self, validated_data):
+        """
+        Creates message and moves thread's last message pointer to it in the same transaction.
+        Pointer is moved only forward, so concurrent creates can not overwrite a newer message.
+        Change is logged in the same transaction. Participants are notified about the message after commit.
+        """
+        with transaction.atomic():
+            message = super().create(validated_data)
+            # read cursors are never above the last message, so a new message is unread
+            message.is_read = False
+            Thread.objects \
+                .filter(pk=message.thread_id) \
+                .filter(Q(last_message__isnull=True) | Q(last_message__lt=message.id)) \
+                .update(last_message=message, updated=timezone.now())
+            Change.objects.messages_created([message])
+            cache.invalidate([message.thread_id])
+            events.message_created(MessageSerializer(message).data)
+        return message
+
+
+def format_datetime(value):
+    """
+    Formats datetime as serializers.DateTimeField with default ISO 8601 format does.
+    """
+    value = timezone.localtime(value).isoformat()
+    return value[:-6] + 'Z' if value.endswith('+00:00') else value
+
+
+class MessageRowSerializer:
+    """
+    Read-only serializer of rows selected by values_list(*MessageRowSerializer.fields, named=True).
+    Gives the same data as MessageSerializer without per-field serializer machinery, used by list endpoints.
+    """
+    # is_read is annotation of with_read_state()
+    fields = ('id', 'text', 'created', 'is_read', 'thread_id', 'sender_id')
+
+    def __init__(self, instance, many=False):
+        self.instance = instance
+        self.many = many
+
+    @staticmethod
+    def to_representation(row):
+        return {
+            'id': row.id,
+            'text': row.text,
+            'created': format_datetime(row.created),
+            'is_read': row.is_read,
+            'thread': row.thread_id,
+            'sender': row.sender_id,
+        }
+
+    @property
+    def data(self):
+        if self.many:
+            return [self.to_representation(row) for row in self.instance]
+        return self.to_representation(self.instance)
+
+
+class ThreadRowSerializer(MessageRowSerializer):
+    """
+    Read-only serializer of thread rows with fields of the last message, gives the same data as ThreadSerializer.
+    Participants of all rows are loaded by one query.
+    """
+    fields = ('id', 'created', 'updated', 'last_message_id', 'last_message__text', 'last_message__created',
+              'last_message_is_read', 'last_message__thread_id', 'last_message__sender_id')
+
+    def __init__(self, instance, many=False):
+        super().__init__(instance, many)
+        rows = instance if many else [instance]
+        self.participants = {row.id: [] for row in rows}
+        memberships = Thread.participants.through.objects \
+            .filter(thread_id__in=list(self.participants)) \
+            .order_by('thread_id', 'user_id') \
+            .values_list('thread_id', 'user_id')
+        for thread_id, user_id in memberships:
+            self.participants[thread_id].append(user_id)
+
+    def to_representation(self, row):
+        last_message = None
+        if row.last_message_id is not None:
+            last_message = {
+                'id': row.last_message_id,
+                'text': row.last_message__text,
+                'created': format_datetime(row.last_message__created),
+                'is_read': row.last_message_is_read,
+                'thread': row.last_message__thread_id,
+                'sender': row.last_message__sender_id,
+            }
+        return {
+            'id': row.id,
+            'participants': self.participants[row.id],
+            'created': format_datetime(row.created),
+            'updated': format_datetime(row.updated),
+            'last_message': last_message,
+        }
+
+
+class MessageSearchResultSerializer(MessageSerializer):
+    rank = serializers.FloatField(read_only=True)
+
+    class Meta(MessageSerializer.Meta):
+        fields = MessageSerializer.Meta.fields + ['rank']
+
+
+class ParticipantsField(serializers.ListField):
+    """
+    User ids of thread participants. Ids are checked by one query, so large groups do not load every user.
+    """
+    child = serializers.IntegerField()
+
+    def to_internal_value(self, data):
+        user_ids = super().to_internal_value(data)
+        existing_ids = set(User.objects.filter(id__in=user_ids).values_list('id', flat=True))
+        missing_ids = [user_id for user_id in user_ids if user_id not in existing_ids]
+        if missing_ids:
+            raise serializers.ValidationError(f'Users {missing_ids} do not exist')
+        return user_ids
+
+    def to_representation(self, value):
+        # all() uses prefetched participants
+        return [user.pk for user in value.all()]
+
 
 class ThreadSerializer(serializers.ModelSerializer):
+    participants = ParticipantsField()
     last_message = MessageSerializer(read_only=True)
 
     def validate(self, attrs):
         """
-        Check that thread has exactly 2 different participants
+        Check that thread has from 2 to settings.CHAT_MAX_THREAD_PARTICIPANTS different participants
         """
         participants = attrs['participants']
-        if len(participants) != 2 or participants[0] == participants[1]:
-            raise serializers.ValidationError("Thread must include exactly 2 different participants")
-
+        if len(participants) < 2 or len(set(participants)) != len(participants):
+            raise serializers.ValidationError("Thread must include at least 2 different participants")
+        if len(participants) > settings.CHAT_MAX_THREAD_PARTICIPANTS:
+            raise serializers.ValidationError(
+                f"Thread can include at most {settings.CHAT_MAX_THREAD_PARTICIPANTS} participants")
         return attrs
 
+    def to_representation(self, instance):
+        # read state of the last message is with_read_state() annotation of thread
+        if instance.last_message is not None and hasattr(instance, 'last_message_is_read'):
+            instance.last_message.is_read = instance.last_message_is_read
+        return super().to_representation(instance)
+
+    def create(self, validated_data):
+        """
+        Creates thread with participants pair key (empty for group threads) and logs creation for every participant.
+        Current user becomes owner of group thread.
+        """
+        participant_ids = validated_data.pop('participants')
+        validated_data['min_user_id'], validated_data['max_user_id'] = Thread.pair_key(participant_ids)
+        request = self.context.get('request')
+        owner_id = request.user.pk if request is not None and validated_data['min_user_id'] is None else None
+        with transaction.atomic():
+            thread = Thread.objects.create(**validated_data)
+            Membership.objects.bulk_create([
+                Membership(thread=thread, user_id=user_id,
+                           role=Membership.OWNER if user_id == owner_id else Membership.MEMBER)
+                for user_id in participant_ids])
+            Change.objects.thread_created(thread.id, participant_ids)
+        return thread
+
     class Meta:
         model = Thread
         fields = ['id', 'participants', 'created', 'updated', 'last_message']
 
 
 class MessageIdListSerializer(serializers.Serializer):
+    # existence of messages is checked by the view together with permissions
     message_ids = serializers.ListField(child=serializers.IntegerField())
 
-    def validate(self, attrs):
-        """
-        Check that all messages exist
-        """
-        message_id_list = attrs['message_ids']
-        existing_messages_amount = Message.objects.filter(id__in=message_id_list).count()
-        if existing_messages_amount != len(message_id_list):
-            raise serializers.ValidationError("Not all messages exist")
-        return attrs
+
+class BulkMessageItemSerializer(serializers.Serializer):
+    """
+    Item of bulk message upload. Relations are validated set-wise by the view, so they are plain ids here.
+    """
+    thread = serializers.IntegerField()
+    sender = serializers.IntegerField()
+    text = serializers.CharField()
+
+
+class ThreadIdSerializer(serializers.Serializer):
+    id = serializers.IntegerField()
+
+
+class ThreadReadUpToSerializer(serializers.Serializer):
+    thread = serializers.PrimaryKeyRelatedField(queryset=Thread.objects.all())
+    up_to_id = serializers.IntegerField()
 
 
 # Serializers for response
@@ -61,6 +235,20 @@ class UpdatedMessagesAmount(serializers.Serializer):
     updated_messages_amount = serializers.IntegerField()
 
 
+class BulkCreatedMessages(serializers.Serializer):
+    created_messages_amount = serializers.IntegerField()
+    results = serializers.ListField(child=serializers.DictField())
+
+
+class SyncSerializer(serializers.Serializer):
+    token = serializers.CharField()
+    has_more = serializers.BooleanField()
+    messages = MessageSerializer(many=True)
+    read = serializers.ListField(child=serializers.DictField())
+    threads_created = ThreadSerializer(many=True)
+    threads_deleted = serializers.ListField(child=serializers.IntegerField())
+
+
 class UnreadMessagesAmount(serializers.Serializer):
     user_id = serializers.IntegerField()
     unread_messages_amount = serializers.IntegerField()
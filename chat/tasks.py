@@ -0,0 +1,116 @@
+"""
+Outbox of side effects of writes.
+
+enqueue() saves a task in the transaction of the write, so the task exists only if the write is committed,
+and the request does not wait for the side effect. run_tasks management command claims due tasks by batches,
+runs their handlers in a thread or process pool and deletes done tasks. Delivery is at least once: a task of
+a worker which was stopped, or which runs longer than LEASE seconds, is claimed again.
+
+A failed task is retried after BACKOFF * 2 ** (attempts - 1) seconds (at most MAX_BACKOFF), after MAX_ATTEMPTS
+failures it is kept as a dead letter, which can be inspected and retried in the admin.
+
+Enabled by settings.CHAT_TASKS['ENABLED'], otherwise handlers are run after commit in the request.
+"""
+
+import traceback
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from . import writer
+from .models import OutboxTask
+
+
+def get_config():
+    config = {'ENABLED': False, 'BATCH_SIZE': 100, 'MAX_ATTEMPTS': 8, 'BACKOFF': 2, 'MAX_BACKOFF': 600, 'LEASE': 60}
+    config.update(getattr(settings, 'CHAT_TASKS', {}))
+    return config
+
+
+def enqueue(name, **payload):
+    """
+    Schedules handler with dotted path name, it is called with JSON serializable payload as keyword arguments.
+    """
+    if not get_config()['ENABLED']:
+        transaction.on_commit(lambda: import_string(name)(**payload))
+        return
+    OutboxTask.objects.create(name=name, payload=payload)
+
+
+def execute(name, payload):
+    """
+    Runs handler of a task in a pool worker. Returns None or traceback of the error.
+    """
+    try:
+        import_string(name)(**payload)
+    except Exception:
+        return traceback.format_exc()
+    return None
+
+
+def backoff(attempts, config):
+    return min(config['MAX_BACKOFF'], config['BACKOFF'] * 2 ** (attempts - 1))
+
+
+def claim(config):
+    """
+    Returns due pending tasks and moves their run_after by LEASE, so other workers skip them while they run.
+    """
+    def take():
+        now = timezone.now()
+        tasks = list(OutboxTask.objects
+                     .select_for_update(skip_locked=True)
+                     .filter(status=OutboxTask.PENDING, run_after__lte=now)
+                     .order_by('run_after', 'id')[:config['BATCH_SIZE']])
+        OutboxTask.objects \
+            .filter(id__in=[task.id for task in tasks]) \
+            .update(run_after=now + timedelta(seconds=config['LEASE']))
+        return tasks
+    return writer.run(take)
+
+
+def finish(tasks, errors, config):
+    """
+    Deletes done tasks, schedules retries of failed ones and marks ones without attempts left as dead.
+    """
+    now = timezone.now()
+    done_ids = []
+    failed = []
+    for task, error in zip(tasks, errors):
+        if error is None:
+            done_ids.append(task.id)
+            continue
+        task.attempts += 1
+        task.last_error = error
+        if task.attempts >= config['MAX_ATTEMPTS']:
+            task.status = OutboxTask.DEAD
+        else:
+            task.run_after = now + timedelta(seconds=backoff(task.attempts, config))
+        failed.append(task)
+
+    def save():
+        OutboxTask.objects.filter(id__in=done_ids).delete()
+        OutboxTask.objects.bulk_update(failed, ['attempts', 'last_error', 'status', 'run_after'])
+    writer.run(save)
+
+
+def run_due_tasks(executor, config):
+    """
+    Runs one batch of due tasks by executor (concurrent.futures pool). Returns list of (task, error or None).
+    """
+    tasks = claim(config)
+    if not tasks:
+        return []
+    errors = list(executor.map(execute, [task.name for task in tasks], [task.payload for task in tasks]))
+    finish(tasks, errors, config)
+    return list(zip(tasks, errors))
+
+
+def retry(queryset):
+    """
+    Returns dead tasks of queryset to the outbox with all attempts, returns amount of them.
+    """
+    return queryset \
+        .filter(status=OutboxTask.DEAD) \
+        .update(status=OutboxTask.PENDING, attempts=0, run_after=timezone.now())
@@ -1,3 +1,995 @@
-from django.test import TestCase
+import asyncio
+import json
+import runpy
+import sqlite3
+import threading
+from collections import defaultdict
+from datetime import timedelta
+from importlib import import_module
+from io import BytesIO, StringIO
+from types import SimpleNamespace
+from unittest.mock import patch
+from asgiref.sync import sync_to_async
+from django.apps import apps as django_apps
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.core.handlers.asgi import ASGIRequest
+from django.core.management import call_command
+from django.db import connection, connections, transaction
+from django.db.models import Max, Min
+from django.test import AsyncClient, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+from simple_chat import warmup
+from . import (admin, authentication, benchmark, cache, events, instrumentation, pubsub, replicas, tasks, throttling,
+               views, websocket, writer)
+from .models import Change, Membership, Message, OutboxTask, Thread
+from .serializers import MessageRowSerializer, MessageSerializer, ThreadRowSerializer, ThreadSerializer
 
-# Create your tests here.
+last_message_migration = import_module('chat.migrations.0003_thread_last_message')
+merge_migration = import_module('chat.migrations.0015_merge_duplicate_threads')
+
+
+class QueryCountTestCase(TestCase):
+    """
+    Checks that amount of queries of hot endpoints does not depend on amount of data.
+    """
+    @classmethod
+    def setUpTestData(cls):
+        cls.threads = benchmark.seed(users=12, threads_per_user=11, messages_per_thread=15)
+        Membership.objects.update(last_read_id=0)
+        cls.thread_id, cls.user_id, cls.other_user_id = cls.threads[0]
+        cls.user = User.objects.get(id=cls.user_id)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_thread_list_queries_do_not_depend_on_page_size(self):
+        for limit in (1, 5, 11):
+            with self.assertNumQueries(4):
+                response = self.client.get('/api/threads/', {'user_id': self.user_id, 'limit': limit})
+            self.assertEqual(len(response.data['results']), limit)
+            self.assertIsNotNone(response.data['results'][0]['last_message'])
+
+    def test_message_list_queries_do_not_depend_on_page_size(self):
+        for limit in (1, 15):
+            with self.assertNumQueries(4):
+                response = self.client.get('/api/messages/', {'thread_id': self.thread_id, 'limit': limit})
+            self.assertEqual(len(response.data['results']), limit)
+
+    def test_message_cursor_pages_do_not_count_rows(self):
+        response = self.client.get('/api/messages/', {'thread_id': self.thread_id, 'pagination': 'cursor'})
+        seen = [message['id'] for message in response.data['results']]
+        with self.assertNumQueries(3):
+            response = self.client.get(response.data['next'])
+        seen += [message['id'] for message in response.data['results']]
+        self.assertNotIn('count', response.data)
+        self.assertEqual(seen, sorted(Message.objects.filter(thread=self.thread_id).values_list('id', flat=True),
+                                      reverse=True))
+
+    def test_mark_read_queries_do_not_depend_on_amount_of_messages(self):
+        messages = Message.objects.filter(thread=self.thread_id, sender=self.other_user_id).order_by('id')
+        message_ids = list(messages.values_list('id', flat=True))
+        for ids in (message_ids[:1], message_ids[1:]):
+            with self.assertNumQueries(6):
+                response = self.client.put('/api/messages/read/', {'message_ids': ids}, format='json')
+            self.assertEqual(response.data['updated_messages_amount'], len(ids))
+        change = Change.objects.order_by('-id').first()
+        self.assertEqual((change.thread_id, change.data),
+                         (self.thread_id, {'reader': self.user_id, 'up_to_id': message_ids[-1]}))
+
+    def test_mark_read_queries_do_not_depend_on_amount_of_threads(self):
+        received = Message.objects.filter(thread__participants=self.user_id).exclude(sender=self.user_id)
+        thread_ids = list(received.order_by('thread').values_list('thread', flat=True).distinct()[:4])
+        self.assertEqual(len(thread_ids), 4)
+        for group in (thread_ids[:1], thread_ids[1:]):
+            message_ids = [received.filter(thread=thread_id).order_by('-id').values_list('id', flat=True)[0]
+                           for thread_id in group]
+            expected = received.filter(thread__in=group).count()
+            with self.assertNumQueries(6):
+                response = self.client.put('/api/messages/read/', {'message_ids': message_ids}, format='json')
+            self.assertEqual(response.data['updated_messages_amount'], expected)
+        self.assertEqual(self.client.put('/api/messages/read/', {'message_ids': message_ids},
+                                         format='json').data['updated_messages_amount'], 0)
+
+    def test_mark_read_checks_existence_and_permissions_by_one_query(self):
+        messages = Message.objects.filter(thread=self.thread_id).values_list('id', flat=True)
+        received_id = messages.filter(sender=self.other_user_id)[0]
+        sent_id = messages.filter(sender=self.user_id)[0]
+        missing_id = Message.objects.aggregate(Max('id'))['id__max'] + 1
+        with self.assertNumQueries(1):
+            response = self.client.put('/api/messages/read/', {'message_ids': [received_id, missing_id]}, format='json')
+        self.assertEqual(response.status_code, 400)
+        with self.assertNumQueries(1):
+            response = self.client.put('/api/messages/read/', {'message_ids': [received_id, sent_id]}, format='json')
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(Change.objects.filter(kind=Change.MESSAGES_READ).exists())
+
+    def test_unread_amount_queries_do_not_depend_on_amount_of_threads(self):
+        with self.assertNumQueries(2):
+            response = self.client.post('/api/messages/unread_amount/', {'user_id': self.user_id}, format='json')
+        # nothing is read, read cursors are 0
+        expected = Message.objects \
+            .filter(thread__participants=self.user_id) \
+            .exclude(sender=self.user_id) \
+            .count()
+        self.assertEqual(response.data['unread_messages_amount'], expected)
+
+    def test_row_serializers_give_the_same_data(self):
+        last_message_id = Thread.objects.get(id=self.thread_id).last_message_id
+        Membership.objects.filter(thread=self.thread_id).update(last_read_id=last_message_id - 5)
+        messages = Message.objects.with_read_state().filter(thread=self.thread_id).order_by('id')
+        self.assertEqual(
+            MessageRowSerializer(messages.values_list(*MessageRowSerializer.fields, named=True), many=True).data,
+            MessageSerializer(messages, many=True).data)
+        threads = Thread.objects.with_read_state().filter(participants=self.user_id).order_by('id')
+        self.assertEqual(
+            ThreadRowSerializer(threads.values_list(*ThreadRowSerializer.fields, named=True), many=True).data,
+            ThreadSerializer(threads, many=True).data)
+        # rendered JSON is the same only if keys are in the same order
+        row = ThreadRowSerializer(threads.values_list(*ThreadRowSerializer.fields, named=True)[0]).data
+        data = ThreadSerializer(threads[0]).data
+        self.assertEqual((list(row), list(row['last_message'])), (list(data), list(data['last_message'])))
+
+    def test_existing_thread_is_found_by_pair_key(self):
+        with self.assertNumQueries(4):
+            response = self.client.post(
+                '/api/thread/', {'participants': [self.other_user_id, self.user_id]}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['id'], self.thread_id)
+        self.assertEqual(Thread.objects.filter(min_user_id=self.user_id, max_user_id=self.other_user_id).count(), 1)
+
+
+class GroupThreadTestCase(TestCase):
+    """
+    Checks creation and deletion of threads with more than 2 participants.
+    """
+    def setUp(self):
+        self.owner, self.member, self.other = [User.objects.create(username=name) for name in ('a', 'b', 'c')]
+
+    def client_for(self, user):
+        client = APIClient()
+        client.force_authenticate(user)
+        return client
+
+    def test_group_is_created_by_owner_and_deleted_only_by_owner(self):
+        participants = [self.owner.id, self.member.id, self.other.id]
+        responses = [self.client_for(self.owner).post('/api/thread/', {'participants': participants}, format='json')
+                     for _ in range(2)]
+        self.assertEqual([response.status_code for response in responses], [201, 201])
+        thread_id = responses[0].data['id']
+        self.assertEqual(sorted(responses[0].data['participants']), participants)
+        self.assertEqual(dict(Membership.objects.filter(thread=thread_id).values_list('user_id', 'role')),
+                         {self.owner.id: 'owner', self.member.id: 'member', self.other.id: 'member'})
+
+        response = self.client_for(self.member).delete('/api/thread/', {'id': thread_id}, format='json')
+        self.assertEqual(response.status_code, 403)
+        response = self.client_for(self.owner).delete('/api/thread/', {'id': thread_id}, format='json')
+        self.assertEqual(response.status_code, 204)
+        self.assertFalse(Thread.objects.filter(id=thread_id).exists())
+
+    def test_duplicate_threads_of_pair_are_merged(self):
+        thread_id = self.client_for(self.owner).post(
+            '/api/thread/', {'participants': [self.owner.id, self.member.id]}, format='json').data['id']
+        duplicate, group = Thread.objects.create(), Thread.objects.create()
+        Membership.objects.bulk_create([Membership(thread=duplicate, user=self.owner, last_read_id=10**6),
+                                        Membership(thread=duplicate, user=self.member),
+                                        Membership(thread=group, user=self.owner, role=Membership.OWNER),
+                                        Membership(thread=group, user=self.member)])
+        old, new = [Message.objects.create(thread_id=thread.id, sender=self.member, text=text)
+                    for thread, text in ((duplicate, 'old'), (Thread(id=thread_id), 'new'))]
+
+        merge_migration.merge_duplicate_threads(django_apps, SimpleNamespace(connection=connection))
+        self.assertEqual(set(Thread.objects.values_list('id', flat=True)), {thread_id, group.id})
+        self.assertEqual(list(Message.objects.filter(thread=thread_id).order_by('id')), [old, new])
+        self.assertEqual(Thread.objects.get(id=thread_id).last_message_id, new.id)
+        self.assertEqual(Membership.objects.get(thread=thread_id, user=self.owner).last_read_id, 10**6)
+        self.assertEqual(set(Change.objects.filter(kind=Change.THREAD_DELETED).values_list('thread_id', 'user')),
+                         {(duplicate.id, self.owner.id), (duplicate.id, self.member.id)})
+
+
+class LastMessageTestCase(TestCase):
+    """
+    Checks that the last message pointer is the message with the newest id, the same as writes maintain it.
+    """
+    def setUp(self):
+        self.thread_id = benchmark.seed(users=2, threads_per_user=1, messages_per_thread=3)[0][0]
+        self.newest = Message.objects.filter(thread=self.thread_id).latest('id')
+        # created time of messages saved at the same moment can be out of id order
+        Message.objects.filter(thread=self.thread_id).exclude(id=self.newest.id).update(
+            created=self.newest.created + timedelta(seconds=1))
+        Thread.objects.update(last_message=None)
+
+    def test_backfill_points_to_message_with_the_newest_id(self):
+        call_command('backfill_last_message', stdout=StringIO())
+        self.assertEqual(Thread.objects.get(id=self.thread_id).last_message_id, self.newest.id)
+
+    def test_migration_fills_last_message_of_existing_threads(self):
+        last_message_migration.backfill_last_message(django_apps, SimpleNamespace(connection=connection))
+        self.assertEqual(Thread.objects.get(id=self.thread_id).last_message_id, self.newest.id)
+
+
+class SearchTestCase(TestCase):
+    """
+    Checks full-text search of messages and its index.
+    """
+    def setUp(self):
+        self.thread_id, self.user_id, self.other_user_id = benchmark.seed(
+            users=2, threads_per_user=1, messages_per_thread=1)[0]
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.get(id=self.user_id))
+
+    def post_message(self, text):
+        response = self.client.post('/api/messages/', {'thread': self.thread_id, 'sender': self.user_id, 'text': text},
+                                    format='json')
+        self.assertEqual(response.status_code, 201)
+        return response.data
+
+    def search(self, **params):
+        response = self.client.get('/api/messages/search/', params)
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_found_message_has_fields_of_message_and_rank(self):
+        message = self.post_message('weekly report is ready')
+        results = self.search(q='report')['results']
+        self.assertEqual([result['id'] for result in results], [message['id']])
+        self.assertEqual(list(results[0]), list(message) + ['rank'])
+
+    def test_no_match_gives_empty_page(self):
+        self.post_message('weekly report is ready')
+        self.assertEqual(self.search(q='invoice'), {'next': None, 'results': []})
+
+    def test_invalid_limit_gets_400(self):
+        self.post_message('weekly report is ready')
+        for limit in ('0', '-1', 'abc'):
+            response = self.client.get('/api/messages/search/', {'q': 'report', 'limit': limit})
+            self.assertEqual(response.status_code, 400)
+
+    def test_rank_cursor_pages_give_every_match_once(self):
+        expected = {self.post_message(f'report number {i}' + ' report' * (i % 3))['id'] for i in range(7)}
+        self.post_message('something else')
+        page = self.search(q='report', limit=3)
+        found = []
+        while True:
+            found += [result['id'] for result in page['results']]
+            ranks = [result['rank'] for result in page['results']]
+            self.assertEqual(ranks, sorted(ranks))
+            if not page['next']:
+                break
+            response = self.client.get(page['next'])
+            self.assertEqual(response.status_code, 200)
+            page = response.data
+        self.assertEqual(len(found), len(expected))
+        self.assertEqual(set(found), expected)
+
+    def test_messages_of_other_threads_are_not_found(self):
+        outsider = User.objects.create(username='outsider')
+        thread = Thread.objects.create(min_user_id=self.other_user_id, max_user_id=outsider.id)
+        Membership.objects.bulk_create([Membership(thread=thread, user_id=self.other_user_id),
+                                        Membership(thread=thread, user=outsider)])
+        message = Message.objects.create(thread=thread, sender=outsider, text='secret report')
+        self.assertEqual(self.search(q='secret')['results'], [])
+        self.assertEqual(self.search(q='secret', thread_id=thread.id)['results'], [])
+        self.client.force_authenticate(User.objects.create(username='staff', is_staff=True))
+        self.assertEqual([result['id'] for result in self.search(q='secret')['results']], [message.id])
+
+    def test_index_follows_created_updated_and_deleted_messages(self):
+        message_id = self.post_message('draft agenda')['id']
+        self.assertEqual([result['id'] for result in self.search(q='agenda')['results']], [message_id])
+        Message.objects.filter(id=message_id).update(text='final minutes')
+        self.assertEqual(self.search(q='agenda')['results'], [])
+        self.assertEqual([result['id'] for result in self.search(q='minu')['results']], [message_id])
+        Message.objects.filter(id=message_id).delete()
+        self.assertEqual(self.search(q='minutes')['results'], [])
+
+
+@override_settings(CHAT_THROTTLING={'RATES': {}})
+class BulkCreateTestCase(TestCase):
+    """
+    Checks that bulk upload creates valid items of a batch and reports errors of every other item.
+    """
+    def setUp(self):
+        self.user, self.other, self.outsider = [User.objects.create(username=name) for name in ('a', 'b', 'c')]
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.thread_id, self.other_thread_id = [
+            self.client.post('/api/thread/', {'participants': [self.user.id, user.id]}, format='json').data['id']
+            for user in (self.other, self.outsider)]
+
+    def message(self, text, thread_id=None, sender_id=None):
+        return {'thread': thread_id or self.thread_id, 'sender': sender_id or self.user.id, 'text': text}
+
+    def test_invalid_items_do_not_stop_valid_ones(self):
+        items = [
+            self.message('first'),
+            {'thread': self.thread_id, 'sender': self.user.id},
+            self.message('no thread', thread_id=self.other_thread_id + 100),
+            self.message('not participant', sender_id=self.outsider.id),
+            self.message('other sender', sender_id=self.other.id),
+            'text',
+            self.message('second'),
+        ]
+        response = self.client.post('/api/messages/bulk/', items, format='json')
+        self.assertEqual(response.status_code, 200)
+        results = response.data['results']
+        self.assertEqual([(result['index'], result['status']) for result in results],
+                         [(0, 201), (1, 400), (2, 400), (3, 400), (4, 403), (5, 400), (6, 201)])
+        self.assertEqual(results[2]['errors'], {'thread': ['thread not found']})
+        self.assertEqual(results[3]['errors'], {'non_field_errors': ['Sender is not participant of this thread']})
+        self.assertEqual(results[5]['errors'], {'error': 'object expected'})
+        self.assertEqual(response.data['created_messages_amount'], 2)
+        self.assertEqual(list(Message.objects.order_by('id').values_list('text', flat=True)), ['first', 'second'])
+
+    def test_malformed_ndjson_lines_are_reported_by_index(self):
+        body = '\n'.join([json.dumps(self.message('first')), '{"thread": ', '', json.dumps(self.message('second'))])
+        response = self.client.post('/api/messages/bulk/', body.encode(), content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([(result['index'], result['status']) for result in response.data['results']],
+                         [(0, 201), (1, 400), (2, 201)])
+        self.assertEqual(response.data['created_messages_amount'], 2)
+
+    def test_ndjson_without_content_length_is_read(self):
+        body = '\n'.join(json.dumps(self.message(text)) for text in ('first', 'second')).encode()
+        request = ASGIRequest({'type': 'http', 'method': 'POST', 'path': '/api/messages/bulk/',
+                               'headers': [(b'content-type', b'application/x-ndjson')]}, BytesIO(body))
+        request._force_auth_user = self.user
+        response = views.MessageBulkCreateAPIView.as_view()(request)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['created_messages_amount'], 2)
+
+    def test_empty_ndjson_body_gets_400(self):
+        # without Content-Length a WSGI request has no body
+        without_length = (json.dumps(self.message('first')).encode(), {'CONTENT_LENGTH': ''})
+        for body, extra in [(b'', {}), (b'\n', {}), without_length]:
+            response = self.client.generic('POST', '/api/messages/bulk/', body,
+                                           content_type='application/x-ndjson', **extra)
+            self.assertEqual(response.status_code, 400)
+        self.assertFalse(Message.objects.exists())
+
+    def test_threads_and_change_log_follow_created_messages(self):
+        items = [self.message('first'), self.message('other thread', thread_id=self.other_thread_id),
+                 self.message('second')]
+        results = self.client.post('/api/messages/bulk/', items, format='json').data['results']
+        message_ids = [result['message']['id'] for result in results]
+        self.assertEqual(dict(Thread.objects.values_list('id', 'last_message')),
+                         {self.thread_id: message_ids[2], self.other_thread_id: message_ids[1]})
+        self.assertEqual(list(Change.objects.filter(kind=Change.MESSAGE_CREATED)
+                              .order_by('id').values_list('thread_id', 'data')),
+                         [(self.thread_id, {'message_id': message_ids[0]}),
+                          (self.other_thread_id, {'message_id': message_ids[1]}),
+                          (self.thread_id, {'message_id': message_ids[2]})])
+
+
+@override_settings(CHAT_THROTTLING={'RATES': {}})
+class SyncTestCase(TestCase):
+    """
+    Checks that incremental sync returns every change after the token once and detects invalid and expired tokens.
+    """
+    def setUp(self):
+        self.user, self.other = [User.objects.create(username=name) for name in ('a', 'b')]
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.thread_id = self.create_thread([self.user.id, self.other.id])
+
+    def create_thread(self, participants):
+        return self.client.post('/api/thread/', {'participants': participants}, format='json').data['id']
+
+    def post_messages(self, amount):
+        return [self.client.post('/api/messages/', {'thread': self.thread_id, 'sender': self.user.id,
+                                                    'text': f'message {i}'}, format='json').data['id']
+                for i in range(amount)]
+
+    def sync(self, token=None, status_code=200):
+        response = self.client.get('/api/sync/', {'token': token} if token is not None else {})
+        self.assertEqual(response.status_code, status_code)
+        return response.data
+
+    def test_token_gives_changes_made_after_it(self):
+        first = self.sync()
+        self.assertEqual(first['messages'], [])
+        message_ids = self.post_messages(2)
+
+        changes = self.sync(first['token'])
+        self.assertEqual([message['id'] for message in changes['messages']], message_ids)
+        self.assertFalse(changes['has_more'])
+        self.assertEqual(self.sync()['token'], changes['token'])
+        again = self.sync(changes['token'])
+        self.assertEqual((again['token'], again['messages']), (changes['token'], []))
+
+    def test_changes_are_paged_by_max_changes(self):
+        token = self.sync()['token']
+        message_ids = self.post_messages(5)
+        seen, pages = [], []
+        with patch.object(views.SyncAPIView, 'max_changes', 2):
+            while True:
+                changes = self.sync(token)
+                seen += [message['id'] for message in changes['messages']]
+                pages.append(changes['has_more'])
+                token = changes['token']
+                if not changes['has_more']:
+                    break
+        self.assertEqual(seen, message_ids)
+        self.assertEqual(pages, [True, True, False])
+
+    def test_deleted_threads_are_not_returned_as_created(self):
+        token = self.sync()['token']
+        third = User.objects.create(username='c')
+        new_thread_id = self.create_thread([self.user.id, third.id])
+        for thread_id in (self.thread_id, new_thread_id):
+            response = self.client.delete('/api/thread/', {'id': thread_id}, format='json')
+            self.assertEqual(response.status_code, 204)
+
+        changes = self.sync(token)
+        self.assertEqual(changes['threads_created'], [])
+        self.assertEqual(changes['threads_deleted'], [self.thread_id, new_thread_id])
+
+        # deleted thread is not available to its participants anymore, but its deletion is
+        other = APIClient()
+        other.force_authenticate(third)
+        self.assertEqual(other.get('/api/sync/', {'token': token}).data['threads_deleted'], [new_thread_id])
+
+    def test_invalid_token_gets_400_and_expired_token_gets_410(self):
+        self.assertEqual(self.sync('bad', status_code=400), {'error': "param 'token' is not valid"})
+        self.sync(views.SyncAPIView.encode_token('x'), status_code=400)
+
+        token = self.sync()['token']
+        self.post_messages(2)
+        Change.objects.update(created=timezone.now() - timedelta(days=31))
+        call_command('prune_changes', stdout=StringIO())
+        self.assertEqual(self.sync(token, status_code=410), {'error': 'token expired, full resync required'})
+
+
+@override_settings(CHAT_PAGE_CACHE={'BACKEND': 'chat.cache.LocalLRUCache'})
+class PageCacheTestCase(TestCase):
+    """
+    Checks that cached pages are served without queries and are not served after writes.
+    """
+    @classmethod
+    def setUpTestData(cls):
+        cls.thread_id, cls.user_id, cls.other_user_id = benchmark.seed(
+            users=2, threads_per_user=1, messages_per_thread=3)[0]
+        cls.user = User.objects.get(id=cls.user_id)
+
+    def setUp(self):
+        cache.get_page_cache.cache_clear()
+        self.addCleanup(cache.get_page_cache.cache_clear)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_message_page_is_invalidated_by_new_message(self):
+        params = {'thread_id': self.thread_id, 'limit': 10}
+        self.assertEqual(self.client.get('/api/messages/', params)['X-Cache'], 'MISS')
+        with self.assertNumQueries(2):
+            response = self.client.get('/api/messages/', params)
+        self.assertEqual(response['X-Cache'], 'HIT')
+        self.assertEqual(response.data['count'], 3)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post('/api/messages/', {'thread': self.thread_id, 'sender': self.user_id, 'text': 'new'},
+                             format='json')
+        response = self.client.get('/api/messages/', params)
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertEqual(response.data['count'], 4)
+        self.assertEqual(self.client.get('/api/threads/', {'user_id': self.user_id})['X-Cache'], 'MISS')
+
+
+class ArchiveTestCase(TestCase):
+    """
+    Checks that message history continues into the archive.
+    """
+    def test_cursor_pages_continue_into_archive(self):
+        thread_id, user_id, _ = benchmark.seed(users=2, threads_per_user=1, messages_per_thread=12)[0]
+        Message.objects.update(created=timezone.now() - timedelta(days=365))
+        Membership.objects.update(last_read_id=Message.objects.aggregate(Max('id'))['id__max'])
+        client = APIClient()
+        client.force_authenticate(User.objects.get(id=user_id))
+        params = {'thread_id': thread_id, 'limit': 5, 'pagination': 'cursor'}
+
+        def history():
+            message_ids = []
+            response = client.get('/api/messages/', params)
+            while True:
+                message_ids += [message['id'] for message in response.data['results']]
+                if not response.data['next']:
+                    return message_ids
+                response = client.get(response.data['next'])
+
+        expected = history()
+        call_command('archive_messages', days=30, batch_size=5, stdout=StringIO())
+        self.assertEqual(Message.objects.filter(thread=thread_id).count(), 1)
+        self.assertEqual(history(), expected)
+        self.assertEqual(client.get('/api/messages/', {'thread_id': thread_id}).data['count'], 12)
+
+
+@override_settings(CHAT_THROTTLING={'RATES': {'unread_amount': (2, 0.1)}})
+class ThrottlingTestCase(TestCase):
+    def setUp(self):
+        throttling.get_bucket_store.cache_clear()
+        self.addCleanup(throttling.get_bucket_store.cache_clear)
+        self.user = User.objects.create(username='first')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_requests_over_bucket_capacity_get_retry_after(self):
+        responses = [self.client.post('/api/messages/unread_amount/', {'user_id': self.user.id}, format='json')
+                     for _ in range(3)]
+        self.assertEqual([response.status_code for response in responses], [200, 200, 429])
+        self.assertEqual(responses[-1]['Retry-After'], '10')
+
+
+class AuthenticationCacheTestCase(TestCase):
+    """
+    Checks that repeated requests skip the user query and that changed users are not served from the cache.
+    """
+    def setUp(self):
+        authentication.get_token_cache.cache_clear()
+        self.addCleanup(authentication.get_token_cache.cache_clear)
+        caches['default'].clear()
+        self.user = User.objects.create(username='first')
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(self.user)}')
+
+    def unread_amount(self):
+        return self.client.post('/api/messages/unread_amount/', {'user_id': self.user.id}, format='json')
+
+    def test_user_is_cached_until_it_is_changed(self):
+        # user_id of request data is loaded by the serializer
+        with self.assertNumQueries(3):
+            self.assertEqual(self.unread_amount().status_code, 200)
+        with self.assertNumQueries(2):
+            self.assertEqual(self.unread_amount().status_code, 200)
+
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.unread_amount().status_code, 401)
+
+
+@override_settings(CHAT_INSTRUMENTATION={'ENABLED': True, 'SLOW_QUERIES': 2})
+class InstrumentationTestCase(TestCase):
+    """
+    Checks that metrics of a request are recorded under the name of its view.
+    """
+    @classmethod
+    def setUpTestData(cls):
+        cls.thread_id, cls.user_id, cls.other_user_id = benchmark.seed(
+            users=2, threads_per_user=1, messages_per_thread=3)[0]
+        cls.user = User.objects.get(id=cls.user_id)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_request_metrics_are_logged_and_aggregated_per_view(self):
+        with self.assertLogs('chat.instrumentation') as logs, CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/threads/', {'user_id': self.user_id})
+        self.assertEqual(response.status_code, 200)
+        line = json.loads(logs.records[0].getMessage())
+        self.assertEqual((line['view'], line['path'], line['status']),
+                         ('chat.views.ThreadListAPIView', '/api/threads/', 200))
+        self.assertEqual(line['queries'], len(queries))
+        self.assertEqual(len(line['slowest_queries']), 2)
+        self.assertIn(f'desc="{len(queries)} queries"', response['Server-Timing'])
+
+        with self.assertLogs('chat.instrumentation'):
+            metrics = self.client.get('/internal/metrics/', REMOTE_ADDR='127.0.0.1').content.decode()
+            self.assertIn('chat_request_queries_count{view="chat.views.ThreadListAPIView"}', metrics)
+            self.assertEqual(self.client.get('/internal/metrics/', REMOTE_ADDR='10.0.0.1').status_code, 404)
+
+
+@override_settings(CHAT_INSTRUMENTATION={'ENABLED': True, 'LOG': False})
+class AsyncInstrumentationTestCase(TestCase):
+    """
+    Checks that instrumentation middleware records metrics of requests served under ASGI.
+    """
+    @classmethod
+    def setUpTestData(cls):
+        cls.thread_id, cls.user_id, cls.other_user_id = benchmark.seed(
+            users=2, threads_per_user=1, messages_per_thread=3)[0]
+        cls.user = User.objects.get(id=cls.user_id)
+
+    def setUp(self):
+        authentication.get_token_cache.cache_clear()
+        self.addCleanup(authentication.get_token_cache.cache_clear)
+        cache.get_page_cache.cache_clear()
+        self.addCleanup(cache.get_page_cache.cache_clear)
+        self.authorization = f'Bearer {AccessToken.for_user(self.user)}'
+
+    async def test_metrics_of_async_requests_are_recorded_per_view(self):
+        client = AsyncClient()
+        for path, params, view in [('/api/threads/', {'user_id': self.user_id}, 'chat.views.ThreadListAPIView'),
+                                   ('/api/messages/', {'thread_id': self.thread_id},
+                                    'chat.views.MessageListCreateAPIView')]:
+            key = ('chat_request_queries', view)
+            before = instrumentation.registry.histograms.get(key, instrumentation.Histogram(()))
+            count, total = before.count, before.sum
+            response = await client.get(path, params, AUTHORIZATION=self.authorization)
+            histogram = instrumentation.registry.histograms[key]
+            self.assertEqual(histogram.count, count + 1)
+            self.assertIn(f'"{int(histogram.sum - total)} queries"', response['Server-Timing'])
+            self.assertGreater(histogram.sum, total)
+
+
+class LocalRedis:
+    """
+    Stand-in of sync and async Redis clients for RedisPubSub, delivers published messages within the process.
+    """
+    def __init__(self):
+        self.subscribers = defaultdict(list)
+
+    def publish(self, channel, data):
+        for queue in self.subscribers[channel]:
+            queue.put_nowait({'type': 'message', 'channel': channel.encode(), 'data': data.encode()})
+
+    def pubsub(self):
+        return LocalRedisPubSub(self)
+
+
+class LocalRedisPubSub:
+    def __init__(self, server):
+        self.server = server
+        self.queue = asyncio.Queue()
+        self.closed = False
+
+    async def subscribe(self, channel):
+        self.server.subscribers[channel].append(self.queue)
+        self.queue.put_nowait({'type': 'subscribe', 'channel': channel.encode(), 'data': 1})
+
+    async def listen(self):
+        while True:
+            yield await self.queue.get()
+
+    async def unsubscribe(self, channel):
+        self.server.subscribers[channel].remove(self.queue)
+
+    async def close(self):
+        self.closed = True
+
+
+class WebSocketTestCase(TestCase):
+    """
+    Checks authentication of WebSocket connections and fan-out of chat events to them.
+    The ASGI application is driven by queues of received and sent events.
+    """
+    @classmethod
+    def setUpTestData(cls):
+        cls.thread_id, cls.user_id, cls.other_user_id = benchmark.seed(
+            users=2, threads_per_user=1, messages_per_thread=3)[0]
+        Membership.objects.update(last_read_id=0)
+        cls.user, cls.other_user = User.objects.get(id=cls.user_id), User.objects.get(id=cls.other_user_id)
+
+    def setUp(self):
+        authentication.get_token_cache.cache_clear()
+        self.addCleanup(authentication.get_token_cache.cache_clear)
+        pubsub.get_pubsub.cache_clear()
+        self.addCleanup(pubsub.get_pubsub.cache_clear)
+
+    async def connect(self, token):
+        """
+        Starts the application, returns queue of events for it, queue of events sent by it and its task.
+        """
+        received, sent = asyncio.Queue(), asyncio.Queue()
+        scope = {'type': 'websocket', 'path': websocket.WEBSOCKET_PATH, 'query_string': f'token={token}'.encode(),
+                 'headers': []}
+        application = asyncio.create_task(websocket.websocket_application(scope, received.get, sent.put))
+        self.addCleanup(application.cancel)
+        await received.put({'type': 'websocket.connect'})
+        return received, sent, application
+
+    async def connect_user(self, user):
+        received, sent, application = await self.connect(AccessToken.for_user(user))
+        self.assertEqual(await asyncio.wait_for(sent.get(), 1), {'type': 'websocket.accept'})
+        return received, sent, application
+
+    @staticmethod
+    async def wait_for(condition):
+        for _ in range(100):
+            if condition():
+                return
+            await asyncio.sleep(0.01)
+        raise AssertionError('Condition is not met in time')
+
+    async def events(self, sent, amount):
+        messages = [await asyncio.wait_for(sent.get(), 1) for _ in range(amount)]
+        self.assertTrue(sent.empty())
+        return [json.loads(message['text']) for message in messages]
+
+    async def test_invalid_token_closes_connection_with_4401(self):
+        _, sent, application = await self.connect('bad')
+        self.assertEqual(await asyncio.wait_for(sent.get(), 1), {'type': 'websocket.close', 'code': 4401})
+        await asyncio.wait_for(application, 1)
+
+    async def test_new_messages_and_reads_are_sent_to_participants(self):
+        sender_events = (await self.connect_user(self.user))[1]
+        receiver_events = (await self.connect_user(self.other_user))[1]
+        subscribers = pubsub.get_pubsub()._subscribers
+        await self.wait_for(lambda: len(subscribers) == 2)
+
+        @sync_to_async
+        def request(user, method, path, data):
+            client = APIClient()
+            client.force_authenticate(user)
+            with self.captureOnCommitCallbacks(execute=True):
+                return getattr(client, method)(path, data, format='json')
+
+        message_data = {'thread': self.thread_id, 'sender': self.user_id, 'text': 'new'}
+        message = (await request(self.user, 'post', '/api/messages/', message_data)).data
+        unread_amount = await sync_to_async(
+            Message.objects.filter(thread=self.thread_id).exclude(sender=self.other_user_id).count)()
+        self.assertEqual(await self.events(sender_events, 1), [{'type': 'message', 'message': message}])
+        self.assertEqual(await self.events(receiver_events, 2), [
+            {'type': 'message', 'message': message},
+            {'type': 'unread_amount', 'user_id': self.other_user_id, 'unread_messages_amount': unread_amount}])
+
+        await request(self.other_user, 'put', '/api/messages/read/', {'message_ids': [message['id']]})
+        read = {'type': 'read', 'thread': self.thread_id, 'reader': self.other_user_id, 'up_to_id': message['id']}
+        self.assertEqual(await self.events(sender_events, 1), [read])
+        self.assertEqual(await self.events(receiver_events, 2), [
+            read, {'type': 'unread_amount', 'user_id': self.other_user_id, 'unread_messages_amount': 0}])
+
+    async def test_disconnect_unsubscribes(self):
+        received, _, application = await self.connect_user(self.user)
+        subscribers = pubsub.get_pubsub()._subscribers
+        await self.wait_for(lambda: subscribers)
+        await received.put({'type': 'websocket.disconnect', 'code': 1000})
+        await asyncio.wait_for(application, 1)
+        self.assertEqual(dict(subscribers), {})
+
+    async def test_events_are_delivered_by_redis_backend(self):
+        server = LocalRedis()
+        with override_settings(CHAT_PUBSUB={'BACKEND': 'chat.pubsub.RedisPubSub',
+                                            'OPTIONS': {'client': server, 'async_client': server}}):
+            pubsub.get_pubsub.cache_clear()
+            received, sent, application = await self.connect_user(self.user)
+            channel = f'chat:{pubsub.user_channel(self.user_id)}'
+            await self.wait_for(lambda: server.subscribers[channel])
+            events.publish_to_users([self.user_id, self.other_user_id], {'type': 'test'})
+            self.assertEqual(await self.events(sent, 1), [{'type': 'test'}])
+
+            await received.put({'type': 'websocket.disconnect', 'code': 1000})
+            await asyncio.wait_for(application, 1)
+            self.assertEqual(server.subscribers[channel], [])
+
+
+REPLICA = 'replica_test'
+
+
+@override_settings(CHAT_REPLICAS={'ALIASES': [REPLICA], 'MAX_LAG': 5, 'STICKY_SECONDS': 10, 'CHECK_INTERVAL': 0})
+class ReplicaRouterTestCase(TransactionTestCase):
+    """
+    Checks routing of reads to a replica database which has only the rows the tests copy to it.
+    """
+    @classmethod
+    def setUpClass(cls):
+        # the replica has a database of its own instead of a mirror of the primary, so it can lag behind;
+        # it is added only for these tests, after the test runner has set up and checked the databases it knows
+        cls.databases = {'default', REPLICA}
+        connections.settings[REPLICA] = {**connections.settings['default'],
+                                         'TEST': {'NAME': settings.BASE_DIR / 'test_replica_db.sqlite3'}}
+        old_name = connections[REPLICA].settings_dict['NAME']
+        connections[REPLICA].creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        cls.addClassCleanup(cls.remove_replica, old_name)
+        super().setUpClass()
+
+    @classmethod
+    def remove_replica(cls, old_name):
+        connections[REPLICA].creation.destroy_test_db(old_name, verbosity=0)
+        del connections[REPLICA]
+        del connections.settings[REPLICA]
+
+    def setUp(self):
+        replicas.states.clear()
+        self.addCleanup(replicas.states.clear)
+        caches['default'].clear()
+        self.user = User.objects.create(username='first')
+
+    def write_change(self):
+        with transaction.atomic():
+            Change.objects.create(kind=Change.MESSAGE_CREATED, thread_id=1, data={'message_id': 1})
+            replicas.remember_write(self.user.id)
+
+    def replicate(self):
+        Change.objects.using(REPLICA).bulk_create(Change.objects.exclude(
+            id__in=list(Change.objects.using(REPLICA).values_list('id', flat=True))))
+
+    def test_reads_of_block_go_to_replica(self):
+        with replicas.read_from_replica(self.user.id):
+            self.assertTrue(replicas.is_reading_from_replica())
+            self.assertFalse(User.objects.filter(id=self.user.id).exists())
+        self.assertTrue(User.objects.filter(id=self.user.id).exists())
+
+    def test_user_reads_primary_after_write_until_replica_has_it(self):
+        other = User.objects.create(username='second')
+        self.write_change()
+        self.assertEqual(replicas.choose_alias(self.user.id), replicas.PRIMARY)
+        self.assertEqual(replicas.choose_alias(other.id), REPLICA)
+        self.replicate()
+        self.assertEqual(replicas.choose_alias(self.user.id), REPLICA)
+
+    def test_lagging_replica_is_not_used(self):
+        self.write_change()
+        Change.objects.update(created=timezone.now() - timedelta(seconds=10))
+        caches['default'].clear()
+        self.assertEqual(replicas.choose_alias(self.user.id), replicas.PRIMARY)
+
+    def test_writes_and_transactions_use_primary(self):
+        with replicas.read_from_replica(self.user.id):
+            second = User.objects.create(username='second')
+            with transaction.atomic():
+                self.assertTrue(User.objects.filter(id=second.id).exists())
+            self.assertFalse(User.objects.filter(id=second.id).exists())
+        self.assertFalse(User.objects.using(REPLICA).exists())
+
+
+class ServingProfileTestCase(SimpleTestCase):
+    """
+    Checks that several gunicorn workers are refused while some backend is process-local.
+    """
+    def test_several_workers_need_shared_backends(self):
+        when_ready = runpy.run_path(str(settings.BASE_DIR / 'gunicorn.conf.py'))['when_ready']
+        self.assertTrue(warmup.process_local_backends())
+        with self.assertRaisesMessage(RuntimeError, 'CHAT_PUBSUB is chat.pubsub.InMemoryPubSub'):
+            when_ready(SimpleNamespace(cfg=SimpleNamespace(workers=3)))
+
+    @override_settings(
+        CACHES={'default': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+                            'LOCATION': '/tmp/chat_test_cache'}},
+        CHAT_PUBSUB={'BACKEND': 'chat.pubsub.RedisPubSub', 'OPTIONS': {}},
+        CHAT_THROTTLING={'STORE': {'BACKEND': 'chat.throttling.SharedBucketStore'}, 'RATES': {'sync': (1, 1)}})
+    def test_shared_backends_allow_several_workers(self):
+        self.assertEqual(warmup.process_local_backends(), [])
+
+
+class AdminTestCase(TestCase):
+    """
+    Checks that admin changelists of messages and threads do not run queries per row.
+    """
+    def setUp(self):
+        benchmark.seed(users=12, threads_per_user=11, messages_per_thread=15)
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'password'))
+
+    def test_changelist_queries_do_not_depend_on_page_size(self):
+        for url in ('/admin/chat/message/', '/admin/chat/thread/'):
+            with self.assertNumQueries(10):
+                self.assertEqual(self.client.get(url).status_code, 200)
+
+    def test_big_table_count_is_estimated(self):
+        Message.objects.filter(id=Message.objects.aggregate(Min('id'))['id__min'] + 1).delete()
+        admin.EstimatedCountPaginator.exact_count_limit = 0
+        self.addCleanup(setattr, admin.EstimatedCountPaginator, 'exact_count_limit', 100000)
+        response = self.client.get('/admin/chat/message/')
+        self.assertEqual(response.context['cl'].result_count, Message.objects.count() + 1)
+
+
+handled_tasks = []
+
+
+def record_task(value):
+    handled_tasks.append(value)
+
+
+def fail_task():
+    raise ValueError('task failed')
+
+
+@override_settings(CHAT_TASKS={'ENABLED': True, 'MAX_ATTEMPTS': 2, 'BACKOFF': 0})
+class OutboxTestCase(TestCase):
+    """
+    Checks that side effects of message create are saved to the outbox and that failed tasks become dead letters.
+    """
+    def test_message_create_saves_push_task(self):
+        thread_id, user_id, _ = benchmark.seed(users=2, threads_per_user=1, messages_per_thread=1)[0]
+        client = APIClient()
+        client.force_authenticate(User.objects.get(id=user_id))
+        with self.captureOnCommitCallbacks() as callbacks:
+            response = client.post('/api/messages/', {'thread': thread_id, 'sender': user_id, 'text': 'new'},
+                                   format='json')
+        self.assertEqual(response.status_code, 201)
+        task = OutboxTask.objects.get()
+        self.assertEqual(task.name, 'chat.events.publish_messages_created')
+        self.assertEqual(task.payload['messages_data'][0]['id'], response.data['id'])
+        self.assertEqual(callbacks, [])
+
+    def test_failed_task_is_retried_then_dead(self):
+        handled_tasks.clear()
+        tasks.enqueue('chat.tests.record_task', value=1)
+        tasks.enqueue('chat.tests.fail_task')
+        call_command('run_tasks', once=True, workers=2, stdout=StringIO(), stderr=StringIO())
+        self.assertEqual(handled_tasks, [1])
+        task = OutboxTask.objects.get()
+        self.assertEqual((task.name, task.status, task.attempts), ('chat.tests.fail_task', OutboxTask.DEAD, 2))
+        self.assertIn('ValueError: task failed', task.last_error)
+
+
+@override_settings(CHAT_THROTTLING={'RATES': {}}, CHAT_WRITER_QUEUE={'ENABLED': True, 'MAX_BATCH': 100})
+class ConcurrentWritesTestCase(TransactionTestCase):
+    """
+    Checks that concurrent writers of the file test database do not fail on the SQLite write lock.
+    """
+    writers = 8
+    messages_per_writer = 10
+
+    def test_concurrent_writes_do_not_fail(self):
+        threads = benchmark.seed(users=self.writers, threads_per_user=1, messages_per_thread=1)
+        statuses = []
+        errors = []
+
+        def write(thread_id, user_id, other_user_id):
+            try:
+                sender, receiver = APIClient(), APIClient()
+                sender.force_authenticate(User.objects.get(id=user_id))
+                receiver.force_authenticate(User.objects.get(id=other_user_id))
+                for i in range(self.messages_per_writer):
+                    response = sender.post('/api/messages/', {'thread': thread_id, 'sender': user_id, 'text': f'{i}'},
+                                           format='json')
+                    statuses.append(response.status_code)
+                    response = receiver.put('/api/messages/read/',
+                                            {'thread': thread_id, 'up_to_id': response.data['id']}, format='json')
+                    statuses.append(response.status_code)
+                    statuses.append(receiver.get('/api/messages/', {'thread_id': thread_id}).status_code)
+            except Exception as error:
+                errors.append(error)
+            finally:
+                connection.close()
+
+        workers = [threading.Thread(target=write, args=thread) for thread in threads]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(set(statuses), {200, 201})
+        self.assertEqual(len(statuses), len(threads) * self.messages_per_writer * 3)
+        self.assertEqual(Message.objects.count(), len(threads) * (self.messages_per_writer + 1))
+        self.assertFalse(Message.objects.with_read_state().filter(is_read=False)
+                         .exclude(text__startswith='message ').exists())
+
+    def test_failing_on_commit_callback_is_raised_by_its_caller(self):
+        def fail():
+            raise RuntimeError('publish failed')
+
+        def job(username):
+            User.objects.create(username=username)
+            transaction.on_commit(fail)
+
+        with self.assertRaisesMessage(RuntimeError, 'publish failed'):
+            writer.run(lambda: job('first'))
+        # the write is committed and the writer thread serves next jobs
+        self.assertTrue(User.objects.filter(username='first').exists())
+        self.assertEqual(writer.run(lambda: User.objects.create(username='second').username), 'second')
+
+    def test_caller_does_not_wait_for_job_longer_than_timeout(self):
+        release = threading.Event()
+        queue = writer.WriterQueue(timeout=0.1)
+        with self.assertRaises(TimeoutError):
+            queue.run(lambda: release.wait(10))
+        release.set()
+        self.assertEqual(queue.run(lambda: 1), 1)
+
+    def test_writer_takes_write_lock_at_start_of_transaction(self):
+        started, release = threading.Event(), threading.Event()
+
+        def job():
+            # the job does not write, the lock is taken by BEGIN IMMEDIATE
+            started.set()
+            release.wait(10)
+            return Thread.objects.count()
+
+        results = []
+        caller = threading.Thread(target=lambda: results.append(writer.run(job)))
+        caller.start()
+        try:
+            self.assertTrue(started.wait(10))
+            other = sqlite3.connect(connection.settings_dict['NAME'], timeout=0, isolation_level=None)
+            self.addCleanup(other.close)
+            with self.assertRaisesMessage(sqlite3.OperationalError, 'database is locked'):
+                other.execute('BEGIN IMMEDIATE')
+        finally:
+            release.set()
+            caller.join()
+        self.assertEqual(results, [0])
@@ -0,0 +1,148 @@
+"""
+Rate limiting and backpressure of API requests.
+
+TokenBucketThrottle limits requests of every user per endpoint scope and responds 429 with Retry-After.
+WriteLimitMixin makes write requests of the process wait for one of settings.CHAT_WRITE_CONCURRENCY['LIMIT'] slots,
+so bursts of writes queue in the process instead of failing on the database write lock.
+"""
+
+import math
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+from rest_framework import status
+from rest_framework.exceptions import APIException
+from rest_framework.throttling import BaseThrottle
+
+
+def get_config():
+    config = {'STORE': {'BACKEND': 'chat.throttling.LocalBucketStore'}, 'RATES': {}}
+    config.update(getattr(settings, 'CHAT_THROTTLING', {}))
+    return config
+
+
+def refill(bucket, capacity, per_second, now):
+    """
+    Returns (tokens, updated time) of bucket stored as (tokens, time) or None for a new bucket.
+    """
+    if bucket is None:
+        return capacity, now
+    tokens, updated = bucket
+    return min(capacity, tokens + (now - updated) * per_second), now
+
+
+class LocalBucketStore:
+    """
+    Buckets in memory of the process, use it only with one worker process.
+    Least recently used buckets are dropped when there are more than max_entries of them.
+    """
+    def __init__(self, max_entries=100000):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.buckets = OrderedDict()
+
+    def take(self, key, capacity, per_second):
+        """
+        Takes one token from the bucket. Returns 0 if it is taken, otherwise seconds until a token is available.
+        """
+        with self.lock:
+            tokens, now = refill(self.buckets.get(key), capacity, per_second, time.monotonic())
+            wait = 0 if tokens >= 1 else (1 - tokens) / per_second
+            self.buckets[key] = (tokens - 1 if wait == 0 else tokens, now)
+            self.buckets.move_to_end(key)
+            while len(self.buckets) > self.max_entries:
+                self.buckets.popitem(last=False)
+        return wait
+
+
+class SharedBucketStore:
+    """
+    Buckets in Django cache (e.g. Redis or Memcached), shared between processes.
+    Read and write of a bucket are not atomic, so concurrent requests of the same user may sometimes take
+    the same token.
+    """
+    def __init__(self, alias='default'):
+        self.cache = caches[alias]
+
+    def take(self, key, capacity, per_second):
+        tokens, now = refill(self.cache.get(key), capacity, per_second, time.time())
+        wait = 0 if tokens >= 1 else (1 - tokens) / per_second
+        # full bucket is the same as missing one, so it expires when it would be refilled
+        self.cache.set(key, (tokens - 1 if wait == 0 else tokens, now), math.ceil(capacity / per_second) + 1)
+        return wait
+
+
+@lru_cache(maxsize=None)
+def get_bucket_store():
+    store = get_config()['STORE']
+    return import_string(store['BACKEND'])(**store.get('OPTIONS', {}))
+
+
+class TokenBucketThrottle(BaseThrottle):
+    """
+    Token bucket of every user (or client address of anonymous requests) and scope.
+    Scope of request is view.throttle_scopes[request.method]. Rates of scopes are
+    settings.CHAT_THROTTLING['RATES']: scope -> (bucket capacity, tokens added per second),
+    requests of scopes without rate are not throttled.
+    """
+    def allow_request(self, request, view):
+        scope = getattr(view, 'throttle_scopes', {}).get(request.method)
+        rate = get_config()['RATES'].get(scope)
+        if rate is None:
+            return True
+        capacity, per_second = rate
+        ident = request.user.pk if request.user and request.user.is_authenticated else self.get_ident(request)
+        self.retry_after = get_bucket_store().take(f'chat:throttle:{scope}:{ident}', capacity, per_second)
+        return self.retry_after == 0
+
+    def wait(self):
+        return math.ceil(self.retry_after)
+
+
+class WriteQueueTimeout(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = 'Too many concurrent writes, try again later.'
+    default_code = 'write_queue_timeout'
+
+    def __init__(self, wait):
+        super().__init__()
+        # exception handler of DRF sends it as Retry-After header
+        self.wait = wait
+
+
+@lru_cache(maxsize=None)
+def get_write_semaphore():
+    """
+    Returns semaphore of the process limiting concurrent writes or None if the limit is disabled.
+    """
+    limit = getattr(settings, 'CHAT_WRITE_CONCURRENCY', {}).get('LIMIT')
+    return threading.BoundedSemaphore(limit) if limit else None
+
+
+class WriteLimitMixin:
+    """
+    Requests with write_methods wait for a write slot after authentication, permission and throttle checks
+    and keep it until response is finalized. If no slot is free within QUEUE_TIMEOUT seconds, responds 503.
+    """
+    write_methods = ('POST', 'PUT', 'PATCH', 'DELETE')
+    has_write_slot = False
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        semaphore = get_write_semaphore()
+        if semaphore is None or request.method not in self.write_methods:
+            return
+        timeout = settings.CHAT_WRITE_CONCURRENCY.get('QUEUE_TIMEOUT', 10)
+        if not semaphore.acquire(timeout=timeout):
+            raise WriteQueueTimeout(wait=1)
+        self.has_write_slot = True
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        if self.has_write_slot:
+            self.has_write_slot = False
+            get_write_semaphore().release()
+        return super().finalize_response(request, response, *args, **kwargs)
@@ -1,24 +1,57 @@
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
 from rest_framework.generics import GenericAPIView, ListAPIView, ListCreateAPIView
 from rest_framework.views import APIView
 from rest_framework import mixins, permissions
+from rest_framework.renderers import BrowsableAPIRenderer
 from rest_framework.response import Response
 from rest_framework import status
 from rest_framework.exceptions import ValidationError
+from rest_framework.utils.urls import replace_query_param
 from django.core.exceptions import ObjectDoesNotExist
 from django.contrib.auth.models import User
-from .models import Message, Thread
+from django.db import IntegrityError, transaction
+from django.db.models import Count, Max, OuterRef, Q, Subquery, Sum
+from django.utils import timezone
+from . import cache, events, membership, replicas, writer
+from .models import ArchivedMessage, Change, Membership, Message, Thread
+from .search import get_search_backend
 from .permissions import IsMessageReceiverOrAdmin, IsParticipantOfThreadOrAdmin
-from .serializers import MessageSerializer, ThreadSerializer, MessageIdListSerializer,\
-    UpdatedMessagesAmount, UnreadMessagesAmount, UserIdSerializer
+from .renderers import FastJSONRenderer
+from .throttling import WriteLimitMixin
+from .serializers import MessageSerializer, ThreadSerializer, MessageIdListSerializer, ThreadReadUpToSerializer,\
+    BulkMessageItemSerializer, BulkCreatedMessages, UpdatedMessagesAmount, UnreadMessagesAmount, UserIdSerializer,\
+    SyncSerializer, MessageSearchResultSerializer, MessageRowSerializer, ThreadRowSerializer, ThreadIdSerializer
 
 
-class ThreadCreateDeleteAPIView(mixins.CreateModelMixin, mixins.DestroyModelMixin, GenericAPIView):
+class RowListMixin:
     """
-    APIView allows to create/delete or retrieve (if thread with the same users exists) Thread.
+    List action which reads pages as named tuples by values_list() and serializes them by row_serializer_class.
+    Response data is the same as data of serializer_class.
+    """
+    row_serializer_class = None
+    renderer_classes = (FastJSONRenderer, BrowsableAPIRenderer)
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.get_row_queryset(self.filter_queryset(self.get_queryset()))
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response(self.row_serializer_class(page, many=True).data)
+        return Response(self.row_serializer_class(queryset, many=True).data)
+
+    def get_row_queryset(self, queryset):
+        return queryset.prefetch_related(None).values_list(*self.row_serializer_class.fields, named=True)
+
+
+class ThreadCreateDeleteAPIView(WriteLimitMixin, mixins.CreateModelMixin, mixins.DestroyModelMixin, GenericAPIView):
+    """
+    APIView allows to create/delete or retrieve (if thread with the same 2 users exists) Thread.
+    Group threads (more than 2 participants) are always created and are deleted by id.
     """
     serializer_class = ThreadSerializer
     queryset = Thread.objects.all()
     permission_classes = (IsParticipantOfThreadOrAdmin,)
+    throttle_scopes = {'POST': 'thread', 'DELETE': 'thread'}
 
     def post(self, request, *args, **kwargs):
         """
@@ -31,19 +64,27 @@ class ThreadCreateDeleteAPIView(mixins.CreateModelMixin, mixins.DestroyModelMixi
         if serializer.is_valid():
             obj = self.get_object()
             if not obj:
-                return self.create(request, *args, **kwargs)
+                try:
+                    return writer.run(lambda: self.create(request, *args, **kwargs))
+                except IntegrityError:
+                    # thread with the same participants was created by concurrent request
+                    obj = self.get_object()
             serializer = self.get_serializer(obj)
             return Response(serializer.data, status=status.HTTP_200_OK)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
     def delete(self, request, *args, **kwargs):
         """
+        Request data is either {'participants': [...]} of 2 user thread or {'id': id} of any thread.
         If request data is not valid, returns HTTP_400_BAD_REQUEST
         If thread does not exist, returns HTTP_404_NOT_FOUND
         If thread exists, deletes thread and returns HTTP_204_NO_CONTENT
         """
         data = request.data
-        serializer = self.serializer_class(data=data)
+        if 'id' in data:
+            serializer = ThreadIdSerializer(data=data)
+        else:
+            serializer = self.serializer_class(data=data)
         if serializer.is_valid():
             if not self.get_object():
                 return Response(status=status.HTTP_404_NOT_FOUND)
@@ -53,27 +94,51 @@ class ThreadCreateDeleteAPIView(mixins.CreateModelMixin, mixins.DestroyModelMixi
     # redefinition perform_create method to check if user has permission on creating object
     def perform_create(self, serializer):
         self.check_object_permissions(self.request, serializer)
-        serializer.save()
+        thread = serializer.save()
+        participant_ids = serializer.validated_data['participants']
+        membership.invalidate_thread(thread.id, participant_ids)
+        cache.invalidate([thread.id], participant_ids)
+        replicas.remember_write(self.request.user.id)
+
+    def perform_destroy(self, instance):
+        thread_id = instance.id
+        participant_ids = list(instance.participants.values_list('id', flat=True))
+
+        def delete():
+            Change.objects.thread_deleted(thread_id, participant_ids)
+            instance.delete()
+        writer.run(delete)
+        membership.invalidate_thread(thread_id, participant_ids)
+        cache.invalidate([thread_id], participant_ids)
+        replicas.remember_write(self.request.user.id)
 
     def get_object(self):
         try:
-            # try to find thread that have both of participants
-            participant1 = self.request.data.get('participants')[0]
-            participant2 = self.request.data.get('participants')[1]
-            obj = Thread.objects.filter(participants__exact=participant1).get(participants__exact=participant2)
+            queryset = Thread.objects.with_read_state().select_related('last_message')
+            if self.request.method == 'DELETE' and 'id' in self.request.data:
+                obj = queryset.get(id=self.request.data['id'])
+            else:
+                # find thread by unique key of both participants, group threads have no key
+                min_user_id, max_user_id = Thread.pair_key(self.request.data.get('participants'))
+                if min_user_id is None:
+                    return None
+                obj = queryset.get(min_user_id=min_user_id, max_user_id=max_user_id)
             self.check_object_permissions(self.request, obj)
         except ObjectDoesNotExist:
             return None
         return obj
 
 
-class ThreadListAPIView(ListAPIView):
+class ThreadListAPIView(RowListMixin, ListAPIView):
     """
     APIView allows to get list of thread for user (every thread has last message).
     """
     serializer_class = ThreadSerializer
+    row_serializer_class = ThreadRowSerializer
     permission_classes = (permissions.IsAuthenticated,)
+    throttle_scopes = {'GET': 'threads_list'}
     key_name = 'user_id'
+    cursor_ordering = ('created', 'id')
 
     def validate(self):
         """
@@ -84,14 +149,30 @@ class ThreadListAPIView(ListAPIView):
         if not User.objects.filter(pk=self.request.query_params[self.key_name]).exists():
             raise ValidationError({'error': 'user not found'})
 
+    def list(self, request, *args, **kwargs):
+        """
+        Validates params and returns cached page if it exists.
+        """
+        self.validate()
+        user_ids = {str(request.query_params[self.key_name])}
+        if not request.user.is_staff:
+            user_ids.add(str(request.user.id))
+        with replicas.read_from_replica(request.user.id):
+            return cache.cached_response(
+                request, 'threads', [cache.user_scope(user_id) for user_id in sorted(user_ids)],
+                lambda: super(ThreadListAPIView, self).list(request, *args, **kwargs))
+
     def get_queryset(self):
         """
         For admin gets queryset with all threads when user is participant.
         For regular users gets queryset with threads when current user is participant.
         """
-        self.validate()
         user = self.request.query_params[self.key_name]
-        queryset = Thread.objects.filter(participants=user)
+        queryset = Thread.objects \
+            .with_read_state() \
+            .filter(participants=user) \
+            .select_related('last_message') \
+            .prefetch_related('participants')
 
         current_user = self.request.user
         if not current_user.is_staff:
@@ -99,68 +180,326 @@ class ThreadListAPIView(ListAPIView):
         return queryset
 
 
-class MessageListCreateAPIView(ListCreateAPIView):
+class MessageListCreateAPIView(WriteLimitMixin, RowListMixin, ListCreateAPIView):
     """
     APIView allows to create message or get list of messages for thread.
     """
     serializer_class = MessageSerializer
+    row_serializer_class = MessageRowSerializer
     permission_classes = (IsParticipantOfThreadOrAdmin,)
+    throttle_scopes = {'GET': 'messages_list', 'POST': 'messages_post'}
     key_name = 'thread_id'
+    cursor_ordering = ('created', 'id')
 
     def validate(self):
         """
         Validates that param 'thread_id' exists in GET params and thread with this id exists.
+        Returns the thread.
         """
         if self.key_name not in self.request.query_params:
             raise ValidationError({'error': f'param \'{self.key_name}\' must exist'})
-        if not Thread.objects.filter(pk=self.request.query_params[self.key_name]).exists():
+        thread_obj = Thread.objects \
+            .filter(pk=self.request.query_params[self.key_name]) \
+            .only('id', 'archived_until') \
+            .first()
+        if thread_obj is None:
             raise ValidationError({'error': 'thread not found'})
+        return thread_obj
+
+    def list(self, request, *args, **kwargs):
+        """
+        Validates params, checks permissions current user on the thread and returns cached page if it exists.
+        """
+        thread_obj = self.validate()
+        self.check_object_permissions(self.request, thread_obj)
+        self.thread = thread_obj
+        self.archive_boundary = thread_obj.archived_until
+        with replicas.read_from_replica(request.user.id):
+            return cache.cached_response(
+                request, 'messages', [cache.thread_scope(thread_obj.id)],
+                lambda: super(MessageListCreateAPIView, self).list(request, *args, **kwargs))
 
     def get_queryset(self):
         """
         Gets queryset with messages from the given thread.
-        Check permissions current user on this thread.
         """
-        self.validate()
         thread_id = self.request.query_params.get(self.key_name)
-
-        thread_obj = Thread.objects.get(id=thread_id)
-        self.check_object_permissions(self.request, thread_obj)
-
-        queryset = Message.objects.filter(thread__id=thread_id)
+        queryset = Message.objects.with_read_state().filter(thread__id=thread_id)
 
         return queryset
 
+    def get_archive_queryset(self):
+        """
+        Gets queryset with archived messages of the thread, None if messages of the thread were never archived.
+        """
+        if self.archive_boundary is None:
+            return None
+        return self.get_row_queryset(ArchivedMessage.objects.with_read_state().filter(thread=self.thread.id))
+
     # redefinition perform_create method to check if user has permission on creating object
     def perform_create(self, serializer):
         self.check_object_permissions(self.request, serializer)
-        serializer.save()
+        writer.run(serializer.save)
+        replicas.remember_write(self.request.user.id)
+
+
+class MessageBulkCreateAPIView(WriteLimitMixin, APIView):
+    """
+    APIView allows to create many messages (possibly in different threads) by one request.
+    """
+    serializer_class = BulkMessageItemSerializer
+    permission_classes = (permissions.IsAuthenticated,)
+    throttle_scopes = {'POST': 'messages_bulk'}
+    ndjson_content_type = 'application/x-ndjson'
+    batch_size = 500
+
+    def post(self, request, *args, **kwargs):
+        """
+        Request data is a list of messages or NDJSON stream (one message per line), which is processed in batches.
+        Every batch is validated set-wise and inserted in one transaction.
+        Returns amount of created messages, result for every item and HTTP_200_OK.
+        """
+        results = []
+        for batch in self.get_batches(request):
+            results.extend(self.create_batch(batch, start_index=len(results)))
+        res_serializer = BulkCreatedMessages({
+            'created_messages_amount': sum(1 for result in results if result['status'] == status.HTTP_201_CREATED),
+            'results': results})
+        return Response(res_serializer.data, status=status.HTTP_200_OK)
+
+    def get_batches(self, request):
+        """
+        Yields lists of raw items. NDJSON body is read line by line, so memory does not depend on body size.
+        """
+        if request.content_type.split(';')[0].strip() == self.ndjson_content_type:
+            # DRF has no stream without Content-Length (chunked upload), the Django request reads the body anyway
+            batch, read_any = [], False
+            for line in request._request:
+                if not line.strip():
+                    continue
+                read_any = True
+                try:
+                    batch.append(json.loads(line))
+                except ValueError:
+                    batch.append(None)
+                if len(batch) >= self.batch_size:
+                    yield batch
+                    batch = []
+            if batch:
+                yield batch
+            if not read_any:
+                raise ValidationError({'error': 'NDJSON body is empty'})
+            return
+
+        data = request.data
+        if not isinstance(data, list):
+            raise ValidationError({'error': 'list of messages expected'})
+        for start in range(0, len(data), self.batch_size):
+            yield data[start:start + self.batch_size]
+
+    def create_batch(self, batch, start_index):
+        """
+        Validates fields of every item, then checks by two queries that threads exist and senders are participants.
+        Valid items are created by bulk_create, threads are updated by one statement.
+        """
+        results = [None] * len(batch)
+        valid = {}
+        for i, item in enumerate(batch):
+            serializer = self.serializer_class(data=item)
+            if isinstance(item, dict) and serializer.is_valid():
+                valid[i] = serializer.validated_data
+            else:
+                errors = serializer.errors if isinstance(item, dict) else {'error': 'object expected'}
+                results[i] = {'index': start_index + i, 'status': status.HTTP_400_BAD_REQUEST, 'errors': errors}
+
+        thread_ids = {item['thread'] for item in valid.values()}
+        existing_thread_ids = set(Thread.objects.filter(id__in=thread_ids).values_list('id', flat=True))
+        memberships = set(Thread.participants.through.objects
+                          .filter(thread_id__in=existing_thread_ids,
+                                  user_id__in={item['sender'] for item in valid.values()})
+                          .values_list('thread_id', 'user_id'))
+        current_user = self.request.user
+        for i, item in list(valid.items()):
+            if item['thread'] not in existing_thread_ids:
+                errors = {'thread': ['thread not found']}
+            elif (item['thread'], item['sender']) not in memberships:
+                errors = {'non_field_errors': ['Sender is not participant of this thread']}
+            elif not current_user.is_staff and item['sender'] != current_user.id:
+                results[i] = {'index': start_index + i, 'status': status.HTTP_403_FORBIDDEN,
+                              'errors': {'detail': 'You do not have permission to perform this action.'}}
+                del valid[i]
+                continue
+            else:
+                continue
+            results[i] = {'index': start_index + i, 'status': status.HTTP_400_BAD_REQUEST, 'errors': errors}
+            del valid[i]
+
+        with transaction.atomic():
+            messages = Message.objects.bulk_create([
+                Message(thread_id=item['thread'], sender_id=item['sender'], text=item['text'])
+                for item in valid.values()])
+            for message in messages:
+                message.is_read = False
+            self.update_threads(messages)
+            Change.objects.messages_created(messages)
+            cache.invalidate({message.thread_id for message in messages})
+            replicas.remember_write(self.request.user.id)
+            messages_data = MessageSerializer(messages, many=True).data
+            events.messages_created(messages_data)
+        for i, message_data in zip(valid.keys(), messages_data):
+            results[i] = {'index': start_index + i, 'status': status.HTTP_201_CREATED, 'message': message_data}
+        return results
+
+    @staticmethod
+    def update_threads(messages):
+        """
+        Moves last message pointers and updated time of all affected threads by one statement.
+        """
+        if not messages:
+            return
+        thread_ids = {message.thread_id for message in messages}
+        newest_message = Message.objects \
+            .filter(thread=OuterRef('pk')) \
+            .order_by('-id') \
+            .values('id')[:1]
+        Thread.objects.filter(id__in=thread_ids).update(last_message=Subquery(newest_message), updated=timezone.now())
+
+
+class MessageSearchAPIView(APIView):
+    """
+    APIView allows to search messages by text in threads of current user (admin searches in all threads).
+    """
+    permission_classes = (permissions.IsAuthenticated,)
+    throttle_scopes = {'GET': 'messages_search'}
+    key_name = 'q'
+    default_limit = 10
+    max_limit = 100
+
+    def get(self, request):
+        """
+        Params: 'q' - words to search (the last one is used as prefix), optional 'thread_id', 'limit' and 'cursor'.
+        If params are not valid, returns HTTP_400_BAD_REQUEST.
+        Returns messages ordered by rank, link to the next page and HTTP_200_OK.
+        """
+        params = request.query_params
+        if not params.get(self.key_name):
+            raise ValidationError({'error': f'param \'{self.key_name}\' must exist'})
+        try:
+            limit = int(params.get('limit', self.default_limit))
+            if limit < 1:
+                raise ValueError
+            limit = min(limit, self.max_limit)
+            thread_id = int(params['thread_id']) if params.get('thread_id') else None
+            after = self.decode_cursor(params['cursor']) if params.get('cursor') else None
+        except (TypeError, ValueError, UnicodeDecodeError):
+            raise ValidationError({'error': 'params \'limit\', \'thread_id\' and \'cursor\' must be valid'})
+
+        user_id = None if request.user.is_staff else request.user.id
+        found = get_search_backend().search(
+            params[self.key_name], user_id=user_id, thread_id=thread_id, after=after, limit=limit + 1)
+        has_more = len(found) > limit
+        found = found[:limit]
+
+        messages = Message.objects.with_read_state().in_bulk([message_id for message_id, rank in found])
+        results = []
+        for message_id, rank in found:
+            if message_id in messages:
+                messages[message_id].rank = rank
+                results.append(messages[message_id])
 
+        next_link = None
+        if has_more:
+            last_id, last_rank = found[-1]
+            next_link = replace_query_param(
+                request.build_absolute_uri(), 'cursor', self.encode_cursor(last_rank, last_id))
+        return Response({
+            'next': next_link,
+            'results': MessageSearchResultSerializer(results, many=True).data
+        }, status=status.HTTP_200_OK)
 
-class MessageListMarkIsReadAPIView(APIView):
+    @staticmethod
+    def encode_cursor(rank, message_id):
+        return urlsafe_b64encode(f'{rank!r}|{message_id}'.encode()).decode()
+
+    @staticmethod
+    def decode_cursor(cursor):
+        rank, message_id = urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return float(rank), int(message_id)
+
+
+class MessageListMarkIsReadAPIView(WriteLimitMixin, APIView):
     """
     APIView allows to mark that messages from list messages have already been read
+    or that all messages of thread up to the given message have already been read.
     """
     serializer_class = MessageIdListSerializer
+    thread_serializer_class = ThreadReadUpToSerializer
     permission_classes = (IsMessageReceiverOrAdmin,)
+    throttle_scopes = {'PUT': 'messages_read'}
 
     def put(self, request, *args, **kwargs):
         """
+        Request data is either {'message_ids': [...]} or {'thread': id, 'up_to_id': id}.
+        Read state is a cursor of current user in every thread, so messages of the thread before the newest
+        marked message are marked as read too.
         If request data is not valid, returns HTTP_400_BAD_REQUEST.
         Checks that current user has permissions on updating this messages.
-        If request data is valid and user has permissions, updates messages returns messages and HTTP_200_OK
+        If request data is valid and user has permissions, moves read cursors, returns amount of received messages
+        which became read and HTTP_200_OK
         """
         data = request.data
-        serializer = self.serializer_class(data=data)
+        if 'thread' in data:
+            serializer = self.thread_serializer_class(data=data)
+        else:
+            serializer = self.serializer_class(data=data)
         if serializer.is_valid():
-            messages_queryset = Message.objects.filter(id__in=serializer.validated_data['message_ids'])
-            for message in messages_queryset.all():
-                self.check_object_permissions(self.request, message)
-            updated_amount = messages_queryset.update(is_read=True)
+            if 'thread' in serializer.validated_data:
+                cursors = self.get_thread_cursors(**serializer.validated_data)
+            else:
+                cursors = self.get_messages_cursors(request, serializer.validated_data['message_ids'])
+
+            def mark_read():
+                amounts = Membership.objects.mark_read(request.user.id, cursors)
+                moved = {thread_id: cursors[thread_id] for thread_id in amounts}
+                Change.objects.messages_read(request.user.id, moved)
+                cache.invalidate(list(moved))
+                replicas.remember_write(request.user.id)
+                events.messages_read(request.user.id, moved)
+                return sum(amounts.values())
+            updated_amount = writer.run(mark_read)
             res_serializer = UpdatedMessagesAmount({'updated_messages_amount': updated_amount})
             return Response(res_serializer.data, status=status.HTTP_200_OK)
         return Response(data=serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
+    def get_thread_cursors(self, thread, up_to_id):
+        """
+        Checks permissions current user on the thread.
+        Returns dict: thread id -> new read cursor. Cursor is not moved above the last message of thread,
+        so messages created later stay unread.
+        """
+        self.check_object_permissions(self.request, thread)
+        return {thread.id: min(up_to_id, thread.last_message_id or 0)}
+
+    def get_messages_cursors(self, request, message_ids):
+        """
+        Checks by one query that all messages exist and current user has permissions on all of them.
+        Returns dict: thread id -> id of the newest given message of the thread.
+        """
+        condition = Q()
+        for permission in self.get_permissions():
+            condition &= permission.get_messages_condition(request)
+        rows = list(Message.objects
+                    .filter(id__in=message_ids)
+                    .order_by()
+                    .values('thread')
+                    .annotate(up_to_id=Max('id'), total=Count('id'),
+                              allowed=Count('id', filter=condition) if condition else Count('id')))
+        if sum(row['total'] for row in rows) != len(message_ids):
+            raise ValidationError({'non_field_errors': ['Not all messages exist']})
+        if any(row['allowed'] != row['total'] for row in rows):
+            self.permission_denied(request)
+        return {row['thread']: row['up_to_id'] for row in rows}
+
 
 class UserCountUnreadMessagesAPIView(APIView):
     """
@@ -168,6 +507,7 @@ class UserCountUnreadMessagesAPIView(APIView):
     """
     serializer_class = UserIdSerializer
     permission_classes = (permissions.IsAuthenticated,)
+    throttle_scopes = {'POST': 'unread_amount'}
 
     def post(self, request):
         """
@@ -179,8 +519,9 @@ class UserCountUnreadMessagesAPIView(APIView):
         if serializer.is_valid():
             user = serializer.validated_data['user_id']
 
-            queryset = self.get_queryset(user)
-            unread_messages_amount = queryset.count()
+            queryset = self.get_queryset(user).with_unread_amount()
+            with replicas.read_from_replica(request.user.id):
+                unread_messages_amount = queryset.aggregate(amount=Sum('unread_amount'))['amount'] or 0
 
             res_serializer = UnreadMessagesAmount({
                 'user_id': user.id,
@@ -190,17 +531,87 @@ class UserCountUnreadMessagesAPIView(APIView):
 
     def get_queryset(self, user):
         """
-        For admin gets full queryset of unread messages for the given user.
-        For regular user gets queryset of unread messages only for thread when current user is participant
+        For admin gets queryset of memberships (read cursors) of the given user in all threads.
+        For regular user gets queryset of memberships only in threads when current user is participant
         """
-        queryset = Message.objects
+        queryset = Membership.objects.filter(user=user)
         current_user = self.request.user
         if not current_user.is_staff:
             queryset = queryset.filter(thread__participants=current_user)
 
-        user_threads = Thread.objects.filter(participants=user)
-        queryset = queryset \
-            .filter(thread__in=user_threads, is_read=False) \
-            .exclude(sender=user.id)
-
         return queryset
+
+
+class SyncAPIView(APIView):
+    """
+    APIView allows to get everything that changed for current user since the given token.
+    """
+    permission_classes = (permissions.IsAuthenticated,)
+    throttle_scopes = {'GET': 'sync'}
+    key_name = 'token'
+    max_changes = 500
+
+    def get(self, request):
+        """
+        Without token returns token of the current state and no changes.
+        If token is not valid, returns HTTP_400_BAD_REQUEST.
+        If changes after token were pruned, returns HTTP_410_GONE, client must load everything again.
+        Otherwise returns up to max_changes changes, new token and HTTP_200_OK. If has_more is true, client repeats
+        request with the new token.
+        """
+        user_id = request.user.id
+        if self.key_name not in request.query_params:
+            last_id = Change.objects.order_by('-id').values_list('id', flat=True).first() or 0
+            return Response(self.get_response_data(last_id, False, []), status=status.HTTP_200_OK)
+
+        since = self.decode_token(request.query_params[self.key_name])
+        first_id = Change.objects.order_by('id').values_list('id', flat=True).first()
+        if first_id is not None and first_id > since + 1:
+            return Response({'error': 'token expired, full resync required'}, status=status.HTTP_410_GONE)
+
+        changes = list(Change.objects.for_user(user_id).filter(id__gt=since).order_by('id')[:self.max_changes + 1])
+        has_more = len(changes) > self.max_changes
+        changes = changes[:self.max_changes]
+        last_id = changes[-1].id if changes else since
+        return Response(self.get_response_data(last_id, has_more, changes), status=status.HTTP_200_OK)
+
+    def get_response_data(self, last_id, has_more, changes):
+        message_ids, read, created_thread_ids, deleted_thread_ids = [], [], set(), []
+        for change in changes:
+            if change.kind == Change.MESSAGE_CREATED:
+                message_ids.append(change.data['message_id'])
+            elif change.kind == Change.MESSAGES_READ:
+                read.append({'thread': change.thread_id, **change.data})
+            elif change.kind == Change.THREAD_CREATED:
+                created_thread_ids.add(change.thread_id)
+            elif change.kind == Change.THREAD_DELETED:
+                created_thread_ids.discard(change.thread_id)
+                deleted_thread_ids.append(change.thread_id)
+
+        messages = Message.objects.with_read_state().filter(id__in=message_ids).order_by('id') if message_ids else []
+        threads = Thread.objects \
+            .with_read_state() \
+            .filter(id__in=created_thread_ids) \
+            .select_related('last_message') \
+            .prefetch_related('participants') if created_thread_ids else []
+        return SyncSerializer({
+            'token': self.encode_token(last_id),
+            'has_more': has_more,
+            'messages': messages,
+            'read': read,
+            'threads_created': threads,
+            'threads_deleted': deleted_thread_ids,
+        }).data
+
+    @staticmethod
+    def encode_token(change_id):
+        return urlsafe_b64encode(f'v1:{change_id}'.encode()).decode()
+
+    def decode_token(self, token):
+        try:
+            version, change_id = urlsafe_b64decode(token.encode()).decode().split(':')
+            if version != 'v1':
+                raise ValueError
+            return int(change_id)
+        except (TypeError, ValueError, UnicodeDecodeError):
+            raise ValidationError({'error': f'param \'{self.key_name}\' is not valid'})
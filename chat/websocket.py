@@ -0,0 +1,73 @@
+import asyncio
+import json
+from urllib.parse import parse_qs
+from asgiref.sync import sync_to_async
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from .authentication import CachedJWTAuthentication
+from .pubsub import get_pubsub, user_channel
+
+WEBSOCKET_PATH = '/ws/chat/'
+
+
+def get_raw_token(scope):
+    """
+    Gets JWT from 'token' query param (browsers can not set headers on WebSocket) or from Authorization header.
+    """
+    query = parse_qs(scope.get('query_string', b'').decode())
+    if query.get('token'):
+        return query['token'][0].encode()
+    authentication = CachedJWTAuthentication()
+    for name, value in scope.get('headers', []):
+        if name == b'authorization':
+            return authentication.get_raw_token(value)
+    return None
+
+
+@sync_to_async
+def authenticate(raw_token):
+    """
+    Validates token the same way as REST API does, returns active user or None.
+    """
+    authentication = CachedJWTAuthentication()
+    try:
+        user = authentication.get_user(authentication.get_validated_token(raw_token))
+    except (InvalidToken, AuthenticationFailed):
+        return None
+    return user if user.is_active else None
+
+
+async def websocket_application(scope, receive, send):
+    """
+    ASGI application which pushes events (new messages, read receipts, unread amounts) of the current user.
+    Incoming frames are ignored, the connection is used only for server to client events.
+    """
+    if scope['path'] != WEBSOCKET_PATH:
+        await send({'type': 'websocket.close', 'code': 4404})
+        return
+    event = await receive()
+    if event['type'] != 'websocket.connect':
+        return
+
+    raw_token = get_raw_token(scope)
+    user = await authenticate(raw_token) if raw_token else None
+    if user is None:
+        await send({'type': 'websocket.close', 'code': 4401})
+        return
+    await send({'type': 'websocket.accept'})
+
+    async def forward_events():
+        async for message in get_pubsub().subscribe(user_channel(user.id)):
+            await send({'type': 'websocket.send', 'text': json.dumps(message)})
+
+    forwarder = asyncio.create_task(forward_events())
+    try:
+        while True:
+            event = await receive()
+            if event['type'] == 'websocket.disconnect':
+                break
+    finally:
+        forwarder.cancel()
+        try:
+            await forwarder
+        except asyncio.CancelledError:
+            pass
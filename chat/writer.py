@@ -0,0 +1,139 @@
+"""
+Single-writer queue of the process.
+
+Write jobs of views are run by one writer thread with its own database connection. Jobs which wait in the queue
+are run in one transaction, every job in its own savepoint, so the whole batch is committed at once and concurrent
+requests never compete for the SQLite write lock inside the process. The transaction is managed manually
+(autocommit off) and started by BEGIN IMMEDIATE, so the writer waits for writers of other processes
+(busy_timeout) instead of failing when it upgrades a read transaction.
+
+on_commit callbacks of a job are not run by the writer thread, they are handed back and run by the caller after
+commit, so a failing callback (e.g. of a publish to an unavailable server) is raised in its request the same way
+as in an inline write. A caller waits for its job at most TIMEOUT seconds.
+
+Enabled by settings.CHAT_WRITER_QUEUE['ENABLED']. Jobs are run inline when the queue is disabled and when
+the caller is inside a transaction, because the writer connection can not see its uncommitted data.
+"""
+
+import logging
+import queue
+import threading
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+
+logger = logging.getLogger('chat.writer')
+
+
+class Job:
+    def __init__(self, func):
+        self.func = func
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.callbacks = []
+
+
+class WriterQueue:
+    def __init__(self, max_batch=100, timeout=30):
+        self.max_batch = max_batch
+        self.timeout = timeout
+        self.jobs = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def run(self, func):
+        """
+        Runs func in a transaction (savepoint) of the writer thread and returns its result after commit.
+        Exceptions of func and of its on_commit callbacks are raised in the calling thread. If the job is not
+        finished in timeout seconds, raises TimeoutError, the job can still be committed later.
+        """
+        if threading.current_thread() is self.thread or transaction.get_connection().in_atomic_block:
+            with transaction.atomic():
+                return func()
+        self.start()
+        job = Job(func)
+        self.jobs.put(job)
+        if not job.done.wait(self.timeout):
+            raise TimeoutError(f'Write job is not finished in {self.timeout} seconds')
+        if job.error is not None:
+            raise job.error
+        for callback in job.callbacks:
+            callback()
+        return job.result
+
+    def start(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.loop, name='chat-writer', daemon=True)
+                self.thread.start()
+
+    def loop(self):
+        while True:
+            batch = [self.jobs.get()]
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.jobs.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.run_batch(batch)
+            except Exception:
+                # jobs of the batch are finished with errors, the thread serves the next batches
+                logger.exception('Write batch failed')
+
+    @staticmethod
+    def run_batch(batch):
+        connection = connections[DEFAULT_DB_ALIAS]
+        try:
+            transaction.set_autocommit(False)
+            try:
+                if connection.vendor == 'sqlite':
+                    # take the write lock at the start of transaction
+                    with connection.cursor() as cursor:
+                        cursor.execute('BEGIN IMMEDIATE')
+                for job in batch:
+                    callbacks_start = len(connection.run_on_commit)
+                    try:
+                        with transaction.atomic():
+                            job.result = job.func()
+                    except Exception as error:
+                        job.error = error
+                    else:
+                        job.callbacks = [callback for _, callback in connection.run_on_commit[callbacks_start:]]
+                transaction.commit()
+            except Exception as error:
+                # commit failed, none of jobs is saved
+                transaction.rollback()
+                for job in batch:
+                    job.error = job.error or error
+            finally:
+                # callbacks are run by callers of the jobs
+                connection.run_on_commit = []
+                transaction.set_autocommit(True)
+                connection.close_if_unusable_or_obsolete()
+        except Exception as error:
+            for job in batch:
+                job.error = job.error or error
+            raise
+        finally:
+            for job in batch:
+                job.done.set()
+
+
+writer_queue = None
+writer_queue_lock = threading.Lock()
+
+
+def run(func):
+    """
+    Runs write job func through the writer queue of the process or inline if the queue is disabled.
+    """
+    global writer_queue
+    config = getattr(settings, 'CHAT_WRITER_QUEUE', {})
+    if not config.get('ENABLED'):
+        with transaction.atomic():
+            return func()
+    with writer_queue_lock:
+        if writer_queue is None:
+            writer_queue = WriterQueue(config.get('MAX_BATCH', 100), config.get('TIMEOUT', 30))
+    return writer_queue.run(func)
@@ -0,0 +1,53 @@
+"""
+Gunicorn configuration for production serving.
+
+    gunicorn -c gunicorn.conf.py simple_chat.asgi:application   # HTTP + WebSocket (uvicorn workers)
+    SERVER_MODE=wsgi gunicorn -c gunicorn.conf.py simple_chat.wsgi:application   # HTTP only (sync workers)
+
+Settings are read from .env file and environment variables.
+"""
+
+import multiprocessing
+import os
+from dotenv import dotenv_values
+
+# the same sources as Django settings, environment has priority
+config = {**dotenv_values(), **os.environ}
+
+bind = config.get('BIND', '0.0.0.0:8000')
+
+# each worker is a separate process with its own DB connection. Events, caches and token buckets are shared
+# between workers only through Redis, so without REDIS_URL there is one worker, with it 2 workers per core + 1
+default_workers = multiprocessing.cpu_count() * 2 + 1 if config.get('REDIS_URL') else 1
+workers = int(config.get('WEB_CONCURRENCY', default_workers))
+
+if config.get('SERVER_MODE', 'asgi') == 'asgi':
+    worker_class = 'uvicorn.workers.UvicornWorker'
+else:
+    worker_class = 'sync'
+
+# load Django once in the master process, workers are forked with apps already loaded
+preload_app = True
+
+# restart workers periodically to limit memory growth, jitter prevents restarting all of them at once
+max_requests = int(config.get('MAX_REQUESTS', 10000))
+max_requests_jitter = int(config.get('MAX_REQUESTS_JITTER', 1000))
+
+timeout = int(config.get('TIMEOUT', 30))
+graceful_timeout = int(config.get('GRACEFUL_TIMEOUT', 30))
+keepalive = int(config.get('KEEPALIVE', 5))
+
+accesslog = '-'
+errorlog = '-'
+
+
+def when_ready(server):
+    """
+    Warm-up: runs in the master process after the application is preloaded and before workers are forked.
+    Several workers are refused if some backend keeps its state in the worker process.
+    """
+    from simple_chat.warmup import process_local_backends, warm_up
+    backends = process_local_backends()
+    if server.cfg.workers > 1 and backends:
+        raise RuntimeError(f'{server.cfg.workers} workers need shared backends (set REDIS_URL): ' + '; '.join(backends))
+    warm_up()
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.0/ref/settings/
 """
 
+import os
 from pathlib import Path
 from datetime import timedelta
 from dotenv import dotenv_values
@@ -21,15 +22,22 @@ BASE_DIR = Path(__file__).resolve().parent.parent
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/4.0/howto/deployment/checklist/
 
-config = dotenv_values()
+# values from .env file can be overridden by environment variables
+config = {**dotenv_values(), **os.environ}
+
+
+def config_bool(name, default):
+    return config.get(name, str(default)).lower() in ('1', 'true', 'yes', 'on')
+
 
 # SECURITY WARNING: keep the secret key used in production secret!
 SECRET_KEY = config["SECRET_KEY"]
 
 # SECURITY WARNING: don't run with debug turned on in production!
-DEBUG = True
+# DEBUG also makes Django keep every executed query in memory.
+DEBUG = config_bool('DEBUG', True)
 
-ALLOWED_HOSTS = []
+ALLOWED_HOSTS = [host for host in config.get('ALLOWED_HOSTS', '').split(',') if host]
 
 
 # Application definition
@@ -46,6 +54,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'chat.instrumentation.InstrumentationMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -83,9 +92,73 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # seconds to keep connection open between requests, 0 closes it after every request
+        'CONN_MAX_AGE': int(config.get('CONN_MAX_AGE', 0)),
+        # check persistent connection before reusing it (see chat.db.check_connections_health)
+        'CONN_HEALTH_CHECKS': config_bool('CONN_HEALTH_CHECKS', False),
+        # tests use a file, so concurrent test connections work as in production
+        'TEST': {'NAME': BASE_DIR / 'test_db.sqlite3'},
     }
 }
 
+# Redis server shared by worker processes, e.g. REDIS_URL=redis://localhost:6379/0 (requires 'redis' package).
+# It becomes the default cache (cached users, replica positions, shared token buckets) and the pubsub backend.
+# Without it caches, token buckets and events are process-local, so gunicorn runs one worker (see gunicorn.conf.py).
+REDIS_URL = config.get('REDIS_URL', '')
+if REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_URL,
+        },
+    }
+
+# Pragmas applied to every SQLite connection (see chat.db.apply_sqlite_pragmas)
+CHAT_SQLITE = {
+    'PRAGMAS': {
+        'busy_timeout': 5000,
+        'mmap_size': 256 * 1024 * 1024,
+        'cache_size': -64 * 1024,
+        'temp_store': 'MEMORY',
+    } if config_bool('SQLITE_TUNED', True) else {},
+}
+# WAL journal mode is stored in the database file and leaves -wal/-shm files next to it, so it is enabled
+# explicitly (the docker image does), the database file of the repository is not switched by management commands
+if config_bool('SQLITE_WAL', False):
+    CHAT_SQLITE['PRAGMAS'].update({'journal_mode': 'WAL', 'synchronous': 'NORMAL'})
+
+# Writes of messages, read receipts and threads are run by one writer thread of the process in batches
+# (see chat.writer)
+CHAT_WRITER_QUEUE = {
+    'ENABLED': config_bool('CHAT_WRITER_QUEUE', True),
+    'MAX_BATCH': 100,
+    # seconds a request waits for its write job, then it fails with TimeoutError
+    'TIMEOUT': 30,
+}
+
+# Side effects of writes (push events) are saved to the outbox table and run by `manage.py run_tasks` (see chat.tasks).
+# The worker publishes events from its own process, so it needs a cross-process CHAT_PUBSUB backend.
+CHAT_TASKS = {
+    'ENABLED': config_bool('CHAT_TASKS', False),
+    'BATCH_SIZE': 100,
+    'MAX_ATTEMPTS': 8,
+    # seconds, delay of n-th retry is BACKOFF * 2 ** (n - 1), at most MAX_BACKOFF
+    'BACKOFF': 2,
+    'MAX_BACKOFF': 600,
+    # seconds, a claimed task is run again by another worker if it is not finished within LEASE
+    'LEASE': 60,
+}
+
+# Read replicas: comma separated SQLite files, e.g. DATABASE_REPLICAS=replica.sqlite3 (see chat.replicas)
+for i, name in enumerate(name for name in config.get('DATABASE_REPLICAS', '').split(',') if name):
+    DATABASES[f'replica_{i + 1}'] = {
+        **DATABASES['default'],
+        'NAME': BASE_DIR / name,
+        'TEST': {'MIRROR': 'default'},
+    }
+
+DATABASE_ROUTERS = ['chat.replicas.ReplicaRouter']
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.0/ref/settings/#auth-password-validators
@@ -129,12 +202,119 @@ STATIC_URL = 'static/'
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 REST_FRAMEWORK = {
-    'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.LimitOffsetPagination',
+    'DEFAULT_PAGINATION_CLASS': 'chat.pagination.KeysetPagination',
     'PAGE_SIZE': 10,
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
-    )
+        'chat.authentication.CachedJWTAuthentication',
+    ),
+    'DEFAULT_THROTTLE_CLASSES': (
+        'chat.throttling.TokenBucketThrottle',
+    ),
 }
 SIMPLE_JWT = {
     'ACCESS_TOKEN_LIFETIME': timedelta(minutes=60),
-}
\ No newline at end of file
+}
+
+# Verified access tokens (LRU of the process) and user snapshots (Django cache alias) of
+# chat.authentication.CachedJWTAuthentication, None makes it verify every token and load every user.
+CHAT_AUTH_CACHE = {
+    'MAX_TOKENS': 10000,
+    'USER_CACHE': 'default',
+    # seconds
+    'USER_TIMEOUT': 300,
+} if config_bool('CHAT_AUTH_CACHE', True) else None
+
+# Token buckets of every user per endpoint scope (see throttle_scopes of views), exceeded requests get 429.
+# Store is 'local' (one worker process only) or 'shared' (default Django cache, e.g. Redis).
+CHAT_THROTTLING = {
+    'STORE': {
+        'local': {'BACKEND': 'chat.throttling.LocalBucketStore', 'OPTIONS': {'max_entries': 100000}},
+        'shared': {'BACKEND': 'chat.throttling.SharedBucketStore', 'OPTIONS': {'alias': 'default'}},
+    }[config.get('CHAT_THROTTLE_STORE', 'shared' if REDIS_URL else 'local')],
+    # scope: (bucket capacity, tokens added per second)
+    'RATES': {
+        'messages_post': (30, 2),
+        'messages_bulk': (5, 0.1),
+        'messages_read': (30, 2),
+        'messages_list': (60, 5),
+        'threads_list': (60, 5),
+        'unread_amount': (20, 1),
+        'messages_search': (20, 1),
+        'sync': (20, 1),
+        'thread': (20, 1),
+    } if config_bool('CHAT_THROTTLING', True) else {},
+}
+
+# Process-wide limit of concurrent write requests, others wait in queue up to QUEUE_TIMEOUT seconds and then get 503.
+CHAT_WRITE_CONCURRENCY = {
+    'LIMIT': int(config.get('CHAT_WRITE_CONCURRENCY', 4)),
+    'QUEUE_TIMEOUT': 10,
+}
+
+# Backend used to push chat events to WebSocket connections.
+# Use chat.pubsub.RedisPubSub (requires 'redis' package) when running several processes.
+CHAT_PUBSUB = {
+    'BACKEND': 'chat.pubsub.RedisPubSub',
+    'OPTIONS': {'url': REDIS_URL},
+} if REDIS_URL else {
+    'BACKEND': 'chat.pubsub.InMemoryPubSub',
+    'OPTIONS': {},
+}
+
+# Threads with more than 2 participants are group threads
+CHAT_MAX_THREAD_PARTICIPANTS = 5000
+
+# Cache of thread membership shared between requests, None disables it.
+# Example: {'ALIAS': 'default', 'TIMEOUT': 300}
+CHAT_MEMBERSHIP_CACHE = None
+
+# Routing of thread list, message list and unread amount reads to DATABASES replicas
+CHAT_REPLICAS = {
+    'ALIASES': [alias for alias in DATABASES if alias != 'default'],
+    # seconds, more lagging replicas are not used
+    'MAX_LAG': 5,
+    # seconds after write when user reads only from replicas which have the write
+    'STICKY_SECONDS': 10,
+    # seconds between checks of replica position in every process
+    'CHECK_INTERVAL': 1,
+    # Django cache with positions of users, must be shared between processes (e.g. Redis) in production
+    'CACHE': 'default',
+}
+
+# Per-request SQL and timing instrumentation (Server-Timing header, log lines, /internal/metrics/)
+CHAT_INSTRUMENTATION = {
+    'ENABLED': config_bool('CHAT_INSTRUMENTATION', False),
+    # amount of slowest statements written to log
+    'SLOW_QUERIES': 3,
+    'LOG': True,
+    'METRICS_ALLOWED_IPS': ['127.0.0.1'],
+}
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'chat': {
+            'handlers': ['console'],
+            'level': 'INFO',
+        },
+    },
+}
+
+# Cache of serialized pages of messages and threads: 'local' (one worker process only), 'shared' (default Django cache)
+# or empty to disable.
+CHAT_PAGE_CACHE = {
+    'local': {
+        'BACKEND': 'chat.cache.LocalLRUCache',
+        'OPTIONS': {'max_entries': 10000, 'timeout': 300},
+    },
+    'shared': {
+        'BACKEND': 'chat.cache.SharedCache',
+        'OPTIONS': {'alias': 'default', 'timeout': 300},
+    },
+}.get(config.get('CHAT_PAGE_CACHE', ''))
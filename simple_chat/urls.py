@@ -1,8 +1,10 @@
 from django.urls import include, path
 from django.contrib import admin
 from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView, TokenVerifyView
+from chat.instrumentation import metrics_view
 urlpatterns = [
     path('admin/', admin.site.urls),
+    path('internal/metrics/', metrics_view),
     path('api/token/', TokenObtainPairView.as_view(), name='token_obtain_pair'),
     path('api/token/refresh/', TokenRefreshView.as_view(), name='token_refresh'),
     path('api/token/verify/', TokenVerifyView.as_view(), name='token_verify'),
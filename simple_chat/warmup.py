@@ -0,0 +1,47 @@
+"""
+Warm-up of the application before serving requests.
+
+With gunicorn ``preload_app`` (see gunicorn.conf.py) it runs once in the master process,
+so forked workers share already imported apps, views and compiled URL patterns
+instead of loading them on the first request of every worker.
+"""
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import connections
+from django.urls import get_resolver
+
+
+def warm_up():
+    # loads URLconf, imports all views and compiles URL patterns
+    resolver = get_resolver()
+    resolver.reverse_dict
+    # connections must not be shared between forked workers
+    connections.close_all()
+
+
+def process_local_backends():
+    """
+    Returns descriptions of configured backends which keep state in memory of the worker process.
+    With several workers, events, rate limits and invalidation of cached users do not reach other workers.
+    """
+    def is_local_cache(alias):
+        return isinstance(caches[alias], (LocMemCache, DummyCache))
+
+    backends = []
+    if settings.CHAT_PUBSUB['BACKEND'] == 'chat.pubsub.InMemoryPubSub':
+        backends.append('CHAT_PUBSUB is chat.pubsub.InMemoryPubSub')
+    if settings.CHAT_THROTTLING.get('RATES') \
+            and settings.CHAT_THROTTLING['STORE']['BACKEND'] == 'chat.throttling.LocalBucketStore':
+        backends.append('CHAT_THROTTLING store is chat.throttling.LocalBucketStore')
+    if settings.CHAT_AUTH_CACHE and is_local_cache(settings.CHAT_AUTH_CACHE.get('USER_CACHE', 'default')):
+        backends.append('CHAT_AUTH_CACHE uses a process-local cache')
+    if settings.CHAT_REPLICAS['ALIASES'] and is_local_cache(settings.CHAT_REPLICAS['CACHE']):
+        backends.append('CHAT_REPLICAS uses a process-local cache')
+    if settings.CHAT_MEMBERSHIP_CACHE and is_local_cache(settings.CHAT_MEMBERSHIP_CACHE.get('ALIAS', 'default')):
+        backends.append('CHAT_MEMBERSHIP_CACHE uses a process-local cache')
+    if settings.CHAT_PAGE_CACHE and settings.CHAT_PAGE_CACHE['BACKEND'] == 'chat.cache.LocalLRUCache':
+        backends.append('CHAT_PAGE_CACHE is chat.cache.LocalLRUCache')
+    return backends